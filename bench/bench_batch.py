@@ -0,0 +1,128 @@
+"""
+Chat message rate with and without batching
+
+Sets up a chat between two clients over loopback exactly as the client does,
+then has one send a burst of short messages as fast as it can and measures
+how many arrive per second and how many datagrams carried them.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from client import Chat  # noqa: E402
+from codec import FEATURE_BATCHES, FEATURE_FRAGMENTS, FEATURE_RELIABLE  # noqa: E402
+from reactor import Reactor  # noqa: E402
+
+
+def open_chat(features, batch_delay):
+    """Returns the sending and receiving ends of a new chat"""
+    reactor = Reactor()
+    reactor.start()
+    host = Chat("requester", reactor, features)
+    requester = Chat("host", reactor, features, batch_delay)
+
+    address = host.open_endpoint("127.0.0.1")
+    hosting = threading.Thread(target=host.start_answering)
+    hosting.start()
+    requester.start_hello(address)
+    hosting.join()
+    return requester, host, reactor
+
+
+def run(args, batch_delay):
+    features = FEATURE_FRAGMENTS | FEATURE_BATCHES
+    if args.reliable:
+        features |= FEATURE_RELIABLE
+    sender, receiver, reactor = open_chat(features, batch_delay)
+
+    received = 0
+    last = None
+    done = threading.Event()
+
+    def count(number, message, current_time):
+        nonlocal received, last
+        received += 1
+        last = time.perf_counter()
+        if received == args.messages:
+            done.set()
+
+    receiver.on_message = count
+
+    started = time.perf_counter()
+    for i in range(args.messages):
+        sender.send_message(f"line {i} of a paste that goes on for a while")
+    if sender.batcher is not None:
+        sender.batcher.flush()
+    done.wait(args.timeout)
+    # Up to the last arrival, as plain datagrams that are lost never arrive
+    elapsed = (last or time.perf_counter()) - started
+
+    datagrams = sender.batcher.datagrams if sender.batcher is not None else args.messages
+    sender.close()
+    receiver.close()
+    reactor.stop()
+
+    return {
+        "batching": batch_delay is not None,
+        "messages": args.messages,
+        "delivered": received,
+        "datagrams": datagrams,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(received / elapsed),
+    }
+
+
+def main():
+    args = parse_args()
+    results = [run(args, None), run(args, args.batch_delay / 1000)]
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"{'Batching':<10}{'delivered':>11}{'datagrams':>11}{'seconds':>9}{'msg/s':>10}")
+    for result in results:
+        print(f"{str(result['batching']):<10}{result['delivered']:>11}"
+              f"{result['datagrams']:>11}{result['seconds']:>9}"
+              f"{result['messages_per_second']:>10}")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_batch",
+        description="Chat message rate with and without batching")
+
+    parser.add_argument("-n", "--messages",
+                        default=50000,
+                        help="Messages in the burst (50000)",
+                        type=int)
+
+    parser.add_argument("-b", "--batch_delay",
+                        default=2.0,
+                        help="Milliseconds a batch waits for more messages (2.0)",
+                        type=float)
+
+    parser.add_argument("-r", "--reliable",
+                        action="store_true",
+                        help="Send through the reliability layer (False)")
+
+    parser.add_argument("-t", "--timeout",
+                        default=30.0,
+                        help="Seconds to wait for the burst to arrive (30.0)",
+                        type=float)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the results as a JSON list (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Presence convergence and command forwarding across a cluster of servers
+
+Starts several servers over loopback as the nodes of one cluster, each told
+only of the first node, and drives simulated clients through the real protocol.
+Signs users up on random nodes and times how long until every node's user list
+shows them, then times chat requests between users on the same node and on
+different nodes, so the difference is what forwarding between nodes adds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from loadgen import SRC, SimulatedClient, percentile
+from codec import Message  # noqa: E402
+
+HOST = "127.0.0.1"
+
+
+def start_nodes(args):
+    """Returns the server processes, every node seeded with the first"""
+    seed = f"{HOST}:{args.cluster_port}"
+    processes = []
+    for i in range(args.nodes):
+        command = [
+            sys.executable, os.path.join(SRC, "server.py"),
+            "--port", str(args.port + i),
+            "--node", f"{HOST}:{args.cluster_port + i}",
+            "--peers", seed,
+            "--gossip_interval", str(args.gossip_interval),
+            # User lists are polled far more often than any client would
+            "--no_rate_limits",
+        ]
+        processes.append(subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    time.sleep(args.startup_delay)
+    return processes
+
+
+async def lists(watcher, username):
+    """Returns whether the user list the watcher's node sends includes username"""
+    watcher.command(Message.REQUEST_USER_LIST.value)
+    transfer = await watcher.transfers.get()
+    return username in transfer.split(b", ")
+
+
+async def measure_convergence(args, watchers, next_index):
+    """Returns the seconds until every node lists each of several new users"""
+    times = []
+    for _ in range(args.trials):
+        node = random.randrange(args.nodes)
+        client = SimulatedClient(next(next_index), HOST, args.port + node, {})
+        await client.connect()
+        started = time.perf_counter()
+
+        async def converge(watcher):
+            while not await lists(watcher, client.username):
+                await asyncio.sleep(args.poll_interval)
+
+        await asyncio.gather(*(converge(watcher) for watcher in watchers))
+        times.append(time.perf_counter() - started)
+        await client.close()
+    return times
+
+
+async def forward_times(requester, target, count):
+    """Returns the seconds from each chat request until the target is told of it"""
+    times = []
+    for _ in range(count):
+        started = time.perf_counter()
+        requester.command(Message.REQUEST_PTP_CONNECTION.value, target.username)
+        await target.expect(Message.RELAY_PTP_REQUEST.value)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def summary(times):
+    samples = sorted(times)
+    return {
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+async def run(args):
+    indices = iter(range(1_000_000))
+    # Every node is watched by a client signed in to it
+    watchers = [SimulatedClient(next(indices), HOST, args.port + i, {}) for i in range(args.nodes)]
+    for watcher in watchers:
+        await watcher.connect()
+
+    convergence = await measure_convergence(args, watchers, indices)
+
+    requester, local_target, remote_target = (
+        SimulatedClient(next(indices), HOST, args.port + node, {}) for node in (0, 0, 1))
+    for client in (requester, local_target, remote_target):
+        await client.connect()
+    # A user on another node can only be sent requests once gossip has brought them here
+    while not await lists(requester, remote_target.username):
+        await asyncio.sleep(args.poll_interval)
+    # The first request to another node also opens the link to it
+    await forward_times(requester, remote_target, 1)
+    local = await forward_times(requester, local_target, args.requests)
+    remote = await forward_times(requester, remote_target, args.requests)
+
+    for client in (*watchers, requester, local_target, remote_target):
+        await client.close()
+
+    converged = summary(convergence)
+    converged["median_rounds"] = round(
+        statistics.median(convergence) / args.gossip_interval, 1)
+    return {
+        "nodes": args.nodes,
+        "gossip_interval_s": args.gossip_interval,
+        "convergence": converged,
+        "request_same_node": summary(local),
+        "request_other_node": summary(remote),
+    }
+
+
+def main():
+    args = parse_args()
+    processes = start_nodes(args)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    converged = results["convergence"]
+    print(f"{results['nodes']} nodes gossiping every {results['gossip_interval_s']} s")
+    print(f"Every node listed a new user after {converged['median_ms']} ms median "
+          f"({converged['median_rounds']} rounds), {converged['max_ms']} ms at most")
+    for name, label in (("request_same_node", "same node"), ("request_other_node", "other node")):
+        result = results[name]
+        print(f"Chat request to a user on the {label}: {result['median_ms']} ms median, "
+              f"{result['p99_ms']} ms p99")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_cluster",
+        description="Presence convergence and command forwarding across a cluster of servers")
+
+    parser.add_argument("-n", "--nodes",
+                        default=4,
+                        help="Servers in the cluster (4)",
+                        type=int)
+
+    parser.add_argument("-p", "--port",
+                        default=46000,
+                        help="The client port of the first node, the others following it (46000)",
+                        type=int)
+
+    parser.add_argument("--cluster_port",
+                        default=46100,
+                        help="The cluster port of the first node, the others following it (46100)",
+                        type=int)
+
+    parser.add_argument("-g", "--gossip_interval",
+                        default=0.1,
+                        help="Seconds between gossip rounds (0.1)",
+                        type=float)
+
+    parser.add_argument("-t", "--trials",
+                        default=20,
+                        help="Users signed up to time convergence (20)",
+                        type=int)
+
+    parser.add_argument("-r", "--requests",
+                        default=500,
+                        help="Chat requests timed to each target (500)",
+                        type=int)
+
+    parser.add_argument("--poll_interval",
+                        default=0.005,
+                        help="Seconds between user list requests while waiting (0.005)",
+                        type=float)
+
+    parser.add_argument("--startup_delay",
+                        default=2.0,
+                        help="Seconds to wait for the nodes to listen (2.0)",
+                        type=float)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the results as a JSON object (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Microbenchmarks for the wire codec
+
+Compares the shared codec against the bytes concatenation and slicing the
+server and clients used before it.
+"""
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from codec import (  # noqa: E402
+    COMMAND_BYTE_COUNT,
+    decode_command,
+    decode_conn_info,
+    encode_command,
+    encode_conn_info,
+    encode_data_transfer,
+    iter_commands,
+    pack_command_into,
+)
+
+
+# The implementations the codec replaced
+
+def legacy_pad_bytes(bytes, length):
+    return bytes + b"\x00" * (length - len(bytes))
+
+
+def legacy_encode_command(command_num, param_1=b"\x00" * 8, param_2=b"\x00" * 8):
+    return (
+        b"\x01"
+        + command_num.to_bytes(1, "little")
+        + legacy_pad_bytes(param_1, 8)
+        + legacy_pad_bytes(param_2, 8)
+    )
+
+
+def legacy_decode_command(frame):
+    command_bytes = frame[1:]
+    return command_bytes[0], command_bytes[1:9], command_bytes[9:17]
+
+
+def legacy_encode_data_transfer(message, identifier_length, data_length, data):
+    return (
+        (b"\x00" if message else b"\x40")
+        + identifier_length.to_bytes(1, "little")
+        + data_length.to_bytes(4, "little")
+        + data
+    )
+
+
+def legacy_encode_conn_info(ip_address, port):
+    ip = struct.unpack("!L", socket.inet_aton(ip_address))[0]
+    return legacy_pad_bytes(ip.to_bytes(4, "little") + port.to_bytes(2, "little"), 8)
+
+
+def legacy_decode_conn_info(param):
+    ip = socket.inet_ntoa(struct.pack("!L", int.from_bytes(param[:4], "little")))
+    return ip, int.from_bytes(param[4:6], "little")
+
+
+def legacy_decode_burst(buffer):
+    commands = []
+    for start in range(0, len(buffer), COMMAND_BYTE_COUNT):
+        commands.append(legacy_decode_command(buffer[start:start + COMMAND_BYTE_COUNT]))
+    return commands
+
+
+def codec_decode_burst(buffer):
+    with memoryview(buffer) as view:
+        return list(iter_commands(view))
+
+
+def cases():
+    frame = encode_command(6, b"alice", b"bob")
+    buffer = bytearray(COMMAND_BYTE_COUNT)
+    burst = bytearray(frame * 200)
+    data = b"x" * 1024
+    conn_info = encode_conn_info("127.0.0.1", 40000)
+
+    return [
+        ("encode command",
+         lambda: legacy_encode_command(6, b"alice", b"bob"),
+         lambda: encode_command(6, b"alice", b"bob")),
+        ("encode command into buffer",
+         lambda: legacy_encode_command(6, b"alice", b"bob"),
+         lambda: pack_command_into(buffer, 0, 6, b"alice", b"bob")),
+        ("decode command",
+         lambda: legacy_decode_command(frame),
+         lambda: decode_command(frame)),
+        ("decode burst of 200 commands",
+         lambda: legacy_decode_burst(burst),
+         lambda: codec_decode_burst(burst)),
+        ("encode 1 KiB data transfer",
+         lambda: legacy_encode_data_transfer(True, 0, len(data), data),
+         lambda: encode_data_transfer(True, b"", data)),
+        ("encode connection info",
+         lambda: legacy_encode_conn_info("127.0.0.1", 40000),
+         lambda: encode_conn_info("127.0.0.1", 40000)),
+        ("decode connection info",
+         lambda: legacy_decode_conn_info(conn_info),
+         lambda: decode_conn_info(conn_info)),
+    ]
+
+
+def measure(function, number, repeat):
+    """Returns the best time per call in nanoseconds"""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e9
+
+
+def main():
+    args = parse_args()
+
+    results = []
+    for name, legacy, codec in cases():
+        legacy_time = measure(legacy, args.number, args.repeat)
+        codec_time = measure(codec, args.number, args.repeat)
+        results.append({
+            "case": name,
+            "legacy_ns": round(legacy_time, 1),
+            "codec_ns": round(codec_time, 1),
+            "speedup": round(legacy_time / codec_time, 2),
+        })
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"{'Case':<32}{'legacy ns':>12}{'codec ns':>12}{'speedup':>10}")
+    for result in results:
+        print(f"{result['case']:<32}{result['legacy_ns']:>12}"
+              f"{result['codec_ns']:>12}{result['speedup']:>9}x")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_codec",
+        description="Microbenchmarks for the wire codec")
+
+    parser.add_argument("-n", "--number",
+                        default=20000,
+                        help="Calls per timing run (20000)",
+                        type=int)
+
+    parser.add_argument("-r", "--repeat",
+                        default=5,
+                        help="Timing runs per case, the best is reported (5)",
+                        type=int)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the results as a JSON list (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
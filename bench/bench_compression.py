@@ -0,0 +1,130 @@
+"""
+Bytes on the wire for chat messages with and without compression
+
+Generates log-like chat messages and encodes them as the client would with
+compression off, with each message compressed on its own against the preset
+dictionary, and with one stream for the whole chat as used alongside the
+reliability layer. Every message is decompressed again to check it survives.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from codec import encode_data_transfer  # noqa: E402
+from compression import MessageCompressor, MessageDecompressor  # noqa: E402
+
+LEVELS = ("DEBUG", "INFO", "INFO", "INFO", "WARNING", "ERROR")
+MODULES = ("server", "registry", "auth", "store", "metrics", "client")
+EVENTS = (
+    "Accepted connection from 127.0.0.1:{port}",
+    "User lg{user:06d} signed in after {ms} ms",
+    "Relayed REQUEST_PTP_CONNECTION from lg{user:06d} to lg{other:06d}",
+    "GET /metrics HTTP/1.1\" 200 {size}",
+    "Could not append to the credential log: [Errno 28] No space left on device",
+    "Wrote a snapshot of {size} accounts",
+)
+
+
+def log_messages(count, lines, seed):
+    """Returns count messages, each a paste of several log lines"""
+    generator = random.Random(seed)
+    messages = []
+    for i in range(count):
+        paste = []
+        for j in range(lines):
+            event = generator.choice(EVENTS).format(
+                port=generator.randint(1024, 65535), user=generator.randint(0, 999999),
+                other=generator.randint(0, 999999), ms=generator.randint(1, 500),
+                size=generator.randint(100, 100000))
+            paste.append(
+                f"2024-05-{1 + i % 28:02d}T12:{j % 60:02d}:{generator.randint(0, 59):02d}.{generator.randint(0, 999):03d}Z "
+                f"{generator.choice(LEVELS):<7} {generator.choice(MODULES)}: {event}")
+        messages.append("\n".join(paste).encode("utf-8"))
+    return messages
+
+
+def run(messages, mode):
+    compressor = decompressor = None
+    if mode != "off":
+        compressor = MessageCompressor(mode == "streaming")
+        decompressor = MessageDecompressor(mode == "streaming")
+
+    wire = 0
+    compressed_count = 0
+    started = time.perf_counter()
+    for message in messages:
+        compressed = compressor.compress(message) if compressor is not None else None
+        if compressed is None:
+            frame = encode_data_transfer(True, b"", message)
+        else:
+            compressed_count += 1
+            frame = encode_data_transfer(True, b"", compressed, compressed=True)
+            if decompressor.decompress(compressed) != message:
+                raise AssertionError("A message did not survive compression")
+        wire += len(frame)
+    elapsed = time.perf_counter() - started
+
+    original = sum(len(message) for message in messages)
+    return {
+        "mode": mode,
+        "messages": len(messages),
+        "compressed": compressed_count,
+        "original_bytes": original,
+        "wire_bytes": wire,
+        "ratio": round(original / wire, 2),
+        "microseconds_per_message": round(elapsed / len(messages) * 1e6, 1),
+    }
+
+
+def main():
+    args = parse_args()
+    messages = log_messages(args.messages, args.lines, args.seed)
+    results = [run(messages, mode) for mode in ("off", "per message", "streaming")]
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"{'Mode':<13}{'compressed':>11}{'original':>11}{'wire':>10}{'ratio':>8}{'us/msg':>9}")
+    for result in results:
+        print(f"{result['mode']:<13}{result['compressed']:>11}{result['original_bytes']:>11}"
+              f"{result['wire_bytes']:>10}{result['ratio']:>8}"
+              f"{result['microseconds_per_message']:>9}")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_compression",
+        description="Bytes on the wire for chat messages with and without compression")
+
+    parser.add_argument("-n", "--messages",
+                        default=2000,
+                        help="Messages to encode (2000)",
+                        type=int)
+
+    parser.add_argument("-l", "--lines",
+                        default=5,
+                        help="Log lines in each message, where 1 makes many fall under "
+                             "the compression threshold (5)",
+                        type=int)
+
+    parser.add_argument("--seed",
+                        default=1,
+                        help="Seed for the generated messages (1)",
+                        type=int)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the results as a JSON list (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Forwarding rate and added latency of the server's chat relays
+
+Runs the server's relays on an event loop of their own, opens several relays
+on loopback and has one client of each stream datagrams at the other through
+it, counting how many arrive per second. Then times round trips of a single
+datagram through a relay and directly, so the difference is what the relay
+adds to each message.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from relay import Relays  # noqa: E402
+
+HOST = "127.0.0.1"
+RECEIVE_BUFFER_BYTE_COUNT = 4 * 1024 * 1024
+
+
+def start_relays(limit):
+    """Returns relays served by an event loop on another thread, and that loop"""
+    relays = Relays(HOST, limit)
+    loop = asyncio.new_event_loop()
+    relays.start(loop)
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return relays, loop
+
+
+def open_relay(relays, loop, number):
+    """Returns the two client sockets of a new relay, each connected to its side"""
+    relay = asyncio.run_coroutine_threadsafe(
+        allocate(relays, f"a{number}", f"b{number}"), loop).result()
+
+    clients = []
+    for port in relay.ports:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTE_COUNT)
+        sock.bind((HOST, 0))
+        sock.connect((HOST, port))
+        clients.append(sock)
+
+    # Each side's first datagram tells the relay where it is
+    for sock in clients:
+        sock.send(b"hello")
+    clients[0].recv(16)
+    return clients, relay
+
+
+async def allocate(relays, first, second):
+    return relays.allocate(first, second)
+
+
+def stream(sender, receiver, count, size, window, timeout, results, index):
+    """Sends count datagrams of size bytes, at most window ahead of those that arrive"""
+    payload = b"x" * size
+    done = threading.Event()
+    received = 0
+
+    def receive():
+        nonlocal received
+        receiver.settimeout(timeout)
+        buffer = bytearray(65536)
+        try:
+            while received < count:
+                receiver.recv_into(buffer)
+                received += 1
+        except socket.timeout:
+            pass
+        done.set()
+
+    threading.Thread(target=receive).start()
+    started = time.perf_counter()
+    for i in range(count):
+        # A sender without any flow control would only measure how fast datagrams are dropped
+        while i - received >= window and not done.is_set():
+            time.sleep(0)
+        sender.send(payload)
+    done.wait()
+    results[index] = (received, time.perf_counter() - started)
+
+
+def measure_rate(args, relays, loop):
+    pairs = [open_relay(relays, loop, i) for i in range(args.relays)]
+    results = [None] * len(pairs)
+    threads = [
+        threading.Thread(target=stream, args=(
+            clients[0], clients[1], args.messages, args.size, args.window, 1.0, results, i))
+        for i, (clients, _) in enumerate(pairs)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    delivered = sum(received for received, _ in results)
+    per_relay = [relay.byte_counts[0] for _, relay in pairs]
+    for clients, relay in pairs:
+        asyncio.run_coroutine_threadsafe(close(relays, relay), loop).result()
+        for sock in clients:
+            sock.close()
+    # Less the second the receivers waited for stragglers
+    seconds = max(elapsed - 1.0, 1e-6) if delivered < args.messages * args.relays else elapsed
+    return {
+        "relays": args.relays,
+        "sent": args.messages * args.relays,
+        "delivered": delivered,
+        "seconds": round(seconds, 3),
+        "messages_per_second": round(delivered / seconds),
+        "bytes_per_relay": per_relay,
+    }
+
+
+async def close(relays, relay):
+    relays.close(relay)
+
+
+def round_trips(first, second, count):
+    """Returns the round trip times in microseconds of count single datagrams"""
+    times = []
+    buffer = bytearray(65536)
+    for _ in range(count):
+        started = time.perf_counter()
+        first.send(b"ping")
+        second.recv_into(buffer)
+        second.send(b"pong")
+        first.recv_into(buffer)
+        times.append((time.perf_counter() - started) * 1e6)
+    return times
+
+
+def measure_latency(args, relays, loop):
+    (first, second), relay = open_relay(relays, loop, "latency")
+    relayed = round_trips(first, second, args.round_trips)
+    asyncio.run_coroutine_threadsafe(close(relays, relay), loop).result()
+
+    direct_first = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    direct_second = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    direct_first.bind((HOST, 0))
+    direct_second.bind((HOST, 0))
+    direct_first.connect(direct_second.getsockname())
+    direct_second.connect(direct_first.getsockname())
+    direct = round_trips(direct_first, direct_second, args.round_trips)
+
+    for sock in (first, second, direct_first, direct_second):
+        sock.close()
+
+    relayed_median = statistics.median(relayed)
+    direct_median = statistics.median(direct)
+    return {
+        "round_trips": args.round_trips,
+        "direct_median_us": round(direct_median, 1),
+        "relayed_median_us": round(relayed_median, 1),
+        "relayed_p99_us": round(statistics.quantiles(relayed, n=100)[98], 1),
+        # Each round trip passes through the relay twice
+        "added_per_message_us": round((relayed_median - direct_median) / 2, 1),
+    }
+
+
+def main():
+    args = parse_args()
+    relays, loop = start_relays(args.relays + 1)
+    results = {"rate": measure_rate(args, relays, loop), "latency": measure_latency(args, relays, loop)}
+    loop.call_soon_threadsafe(loop.stop)
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    rate = results["rate"]
+    latency = results["latency"]
+    print(f"{rate['relays']} relays forwarded {rate['delivered']} of {rate['sent']} "
+          f"{args.size} byte datagrams in {rate['seconds']} s: {rate['messages_per_second']} msg/s")
+    print(f"Round trip median: {latency['direct_median_us']} us direct, "
+          f"{latency['relayed_median_us']} us relayed (p99 {latency['relayed_p99_us']} us)")
+    print(f"Added latency per message: {latency['added_per_message_us']} us")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_relay",
+        description="Forwarding rate and added latency of the server's chat relays")
+
+    parser.add_argument("-n", "--messages",
+                        default=50000,
+                        help="Datagrams streamed through each relay (50000)",
+                        type=int)
+
+    parser.add_argument("-s", "--size",
+                        default=100,
+                        help="Bytes in each datagram (100)",
+                        type=int)
+
+    parser.add_argument("-w", "--window",
+                        default=256,
+                        help="Datagrams each sender may have in flight (256)",
+                        type=int)
+
+    parser.add_argument("-r", "--relays",
+                        default=4,
+                        help="Relays streaming at once (4)",
+                        type=int)
+
+    parser.add_argument("--round_trips",
+                        default=2000,
+                        help="Round trips timed for the latency (2000)",
+                        type=int)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the results as a JSON object (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
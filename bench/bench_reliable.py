@@ -0,0 +1,153 @@
+"""
+Checks and times the chat reliability layer through the lossy proxy
+
+Sends a burst of chat messages from one socket to another with the proxy
+dropping, duplicating and reordering them in both directions, then verifies
+every message arrived exactly once and in order. The same burst sent as plain
+datagrams shows what is lost without the layer.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from codec import decode_data_transfer, encode_data_transfer  # noqa: E402
+from lossy_proxy import LossyProxy  # noqa: E402
+from reactor import Reactor  # noqa: E402
+from reliable import ReliableChannel  # noqa: E402
+
+
+def udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+def run(args, reliable):
+    """Sends the burst once, returning the report"""
+    proxy = LossyProxy(args.loss, args.duplicate, 0.0, args.jitter, args.seed)
+    sender, receiver = udp_socket(), udp_socket()
+    to_receiver = proxy.add_route(receiver.getsockname())
+    to_sender = proxy.add_route(sender.getsockname())
+    proxy.start()
+
+    reactor = Reactor()
+    received = []
+    done = threading.Event()
+
+    def deliver(frame):
+        _, _, data = decode_data_transfer(memoryview(frame))
+        received.append(int(data))
+        if len(received) == args.messages:
+            done.set()
+
+    sending = ReliableChannel(sender, to_receiver, reactor, deliver)
+    receiving = ReliableChannel(receiver, to_sender, reactor, deliver)
+    if reliable:
+        reactor.register(sender, lambda: sending.receive(memoryview(sender.recv(2048))))
+        reactor.register(receiver, lambda: receiving.receive(memoryview(receiver.recv(2048))))
+    else:
+        reactor.register(receiver, lambda: deliver(receiver.recv(2048)))
+    reactor.start()
+
+    started = time.perf_counter()
+    for i in range(args.messages):
+        frame = encode_data_transfer(True, b"", str(i).encode())
+        if reliable:
+            sending.send(frame)
+        else:
+            sender.sendto(frame, to_receiver)
+
+    # Plain datagrams that are lost never arrive, so only wait for them to settle
+    done.wait(args.timeout if reliable else 1.0)
+    elapsed = time.perf_counter() - started
+
+    sending.close()
+    receiving.close()
+    reactor.stop()
+    proxy.stop()
+    sender.close()
+    receiver.close()
+
+    delivered = len(received)
+    return {
+        "mode": "reliable" if reliable else "plain",
+        "messages": args.messages,
+        "delivered": delivered,
+        "unique": len(set(received)),
+        "in_order": received == sorted(received),
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(delivered / elapsed),
+        "retransmits": sending.retransmits,
+        "dropped_by_proxy": proxy.dropped,
+    }
+
+
+def main():
+    args = parse_args()
+    results = [run(args, False), run(args, True)]
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"{'Mode':<10}{'delivered':>11}{'unique':>8}{'in order':>10}"
+          f"{'seconds':>9}{'msg/s':>9}{'resent':>8}{'dropped':>9}")
+    for result in results:
+        print(f"{result['mode']:<10}{result['delivered']:>11}{result['unique']:>8}"
+              f"{str(result['in_order']):>10}{result['seconds']:>9}"
+              f"{result['messages_per_second']:>9}{result['retransmits']:>8}"
+              f"{result['dropped_by_proxy']:>9}")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_reliable",
+        description="Checks and times the chat reliability layer through the lossy proxy")
+
+    parser.add_argument("-n", "--messages",
+                        default=10000,
+                        help="Messages in the burst (10000)",
+                        type=int)
+
+    parser.add_argument("-l", "--loss",
+                        default=0.1,
+                        help="Chance of the proxy dropping a datagram (0.1)",
+                        type=float)
+
+    parser.add_argument("--duplicate",
+                        default=0.01,
+                        help="Chance of the proxy sending a datagram twice (0.01)",
+                        type=float)
+
+    parser.add_argument("-j", "--jitter",
+                        default=0.005,
+                        help="Up to this many seconds the proxy holds a datagram (0.005)",
+                        type=float)
+
+    parser.add_argument("--seed",
+                        default=1,
+                        help="Seed for the proxy's random impairments (1)",
+                        type=int)
+
+    parser.add_argument("-t", "--timeout",
+                        default=60.0,
+                        help="Seconds to wait for the reliable burst to arrive (60.0)",
+                        type=float)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the results as a JSON list (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
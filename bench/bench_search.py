@@ -0,0 +1,135 @@
+"""
+Search latency over a large number of chat messages
+
+Indexes generated messages, spread over several chats, as the client does
+when they are sent and received, then times searches for common and rare
+words, for several words at once and for prefixes, each across every chat.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from search import RESULTS, SearchIndex  # noqa: E402
+
+# Queries timed, each made of words from the generated vocabulary
+QUERIES = (
+    ("common word", "w0"),
+    ("rare word", "w{rare}"),
+    ("two words", "w1 w2"),
+    ("common and rare", "w0 w{rare}"),
+    ("prefix", "w12*"),
+    ("wide prefix", "w1*"),
+    ("no match", "absent"),
+)
+
+
+def generate(count, vocabulary, words, seed):
+    """Yields count messages of words chosen with a Zipf-like skew, as real chats have"""
+    generator = random.Random(seed)
+    # Word i is about i times rarer than the most common word
+    cumulative = list(itertools.accumulate(1 / (i + 1) for i in range(vocabulary)))
+    names = [f"w{i}" for i in range(vocabulary)]
+    for _ in range(count):
+        yield " ".join(generator.choices(names, cum_weights=cumulative, k=words))
+
+
+def main():
+    args = parse_args()
+    indexes = [SearchIndex() for _ in range(args.chats)]
+
+    started = time.perf_counter()
+    for i, message in enumerate(generate(args.messages, args.vocabulary, args.words, args.seed)):
+        # Numbered from 1 within each chat, as a history numbers them
+        indexes[i % args.chats].add(i // args.chats + 1, message)
+    indexing = time.perf_counter() - started
+
+    results = {
+        "messages": args.messages,
+        "chats": args.chats,
+        "index_seconds": round(indexing, 2),
+        "messages_indexed_per_second": round(args.messages / indexing),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024),
+        "queries": [],
+    }
+    for name, query in QUERIES:
+        query = query.format(rare=args.vocabulary // 2)
+        # The first prefix search sorts the words added since the last one
+        for index in indexes:
+            index.search(query)
+
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            found = sum(len(index.search(query, RESULTS)) for index in indexes)
+        elapsed = (time.perf_counter() - started) / args.repeat
+        results["queries"].append({
+            "query": name,
+            "text": query,
+            "results": min(found, RESULTS),
+            "milliseconds": round(elapsed * 1000, 3),
+        })
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"Indexed {results['messages']} messages in {results['chats']} chats in "
+          f"{results['index_seconds']} s ({results['messages_indexed_per_second']} msg/s, "
+          f"{results['max_rss_mb']} MB peak RSS)")
+    print(f"{'Query':<18}{'text':<14}{'results':>8}{'ms':>10}")
+    for query in results["queries"]:
+        print(f"{query['query']:<18}{query['text']:<14}{query['results']:>8}"
+              f"{query['milliseconds']:>10}")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_search",
+        description="Search latency over a large number of chat messages")
+
+    parser.add_argument("-n", "--messages",
+                        default=1000000,
+                        help="Messages to index (1000000)",
+                        type=int)
+
+    parser.add_argument("-c", "--chats",
+                        default=8,
+                        help="Chats the messages are spread over (8)",
+                        type=int)
+
+    parser.add_argument("-v", "--vocabulary",
+                        default=50000,
+                        help="Distinct words the messages are made from (50000)",
+                        type=int)
+
+    parser.add_argument("-w", "--words",
+                        default=8,
+                        help="Words in each message (8)",
+                        type=int)
+
+    parser.add_argument("--repeat",
+                        default=20,
+                        help="Times each query is timed (20)",
+                        type=int)
+
+    parser.add_argument("--seed",
+                        default=1,
+                        help="Seed for the generated messages (1)",
+                        type=int)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the results as a JSON object (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
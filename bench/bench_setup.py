@@ -0,0 +1,115 @@
+"""
+Time to the first chat message with each way of setting up a chat
+
+Sets up chats between two clients over loopback, once over TCP as older
+clients do and once with a UDP hello, timing each from the moment the
+accepting client opens its endpoint until the first message sent by the
+requesting client arrives. The server's relay of the request and its
+acceptance is the same for both, so it is left out.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from client import Chat  # noqa: E402
+from codec import FEATURE_BATCHES, FEATURE_COMPRESSION, FEATURE_FRAGMENTS  # noqa: E402
+from reactor import Reactor  # noqa: E402
+
+FEATURES = FEATURE_FRAGMENTS | FEATURE_BATCHES | FEATURE_COMPRESSION
+
+
+def set_up_over_tcp(host, requester):
+    host.get_conn_info("127.0.0.1")
+    hosting = threading.Thread(target=host.start_host)
+    hosting.start()
+    requester.host, requester.tcp_port = host.ip_address, host.tcp_port
+    requester.start_requester()
+    return hosting
+
+
+def set_up_with_hello(host, requester):
+    address = host.open_endpoint("127.0.0.1")
+    hosting = threading.Thread(target=host.start_answering)
+    hosting.start()
+    requester.start_hello(address)
+    return hosting
+
+
+def time_first_message(reactor, set_up):
+    """Returns the seconds from starting the setup until the first message arrives"""
+    host = Chat("requester", reactor, FEATURES)
+    requester = Chat("host", reactor, FEATURES)
+    arrived = threading.Event()
+    host.on_message = lambda number, message, current_time: arrived.set()
+
+    started = time.perf_counter()
+    hosting = set_up(host, requester)
+    requester.send_message("hello")
+    arrived.wait()
+    elapsed = time.perf_counter() - started
+
+    hosting.join()
+    host.close()
+    requester.close()
+    return elapsed
+
+
+def run(reactor, name, set_up, trials):
+    # The first setup pays for imports and the reactor starting
+    time_first_message(reactor, set_up)
+    times = sorted(time_first_message(reactor, set_up) * 1e6 for _ in range(trials))
+    return {
+        "setup": name,
+        "trials": trials,
+        "median_us": round(statistics.median(times)),
+        "p90_us": round(times[int(len(times) * 0.9) - 1]),
+        "min_us": round(times[0]),
+    }
+
+
+def main():
+    args = parse_args()
+    reactor = Reactor()
+    reactor.start()
+    results = [
+        run(reactor, "tcp", set_up_over_tcp, args.trials),
+        run(reactor, "hello", set_up_with_hello, args.trials),
+    ]
+    reactor.stop()
+
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"{'Setup':<8}{'median us':>11}{'p90 us':>9}{'min us':>9}")
+    for result in results:
+        print(f"{result['setup']:<8}{result['median_us']:>11}{result['p90_us']:>9}"
+              f"{result['min_us']:>9}")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_setup",
+        description="Time to the first chat message with each way of setting up a chat")
+
+    parser.add_argument("-n", "--trials",
+                        default=200,
+                        help="Chats set up each way (200)",
+                        type=int)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the results as a JSON list (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
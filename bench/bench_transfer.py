@@ -0,0 +1,167 @@
+"""
+Throughput of peer to peer file transfer over loopback
+
+Sends a generated file between two lukes_client connections in one process,
+each reading its socket on its own thread as the client does, then checks the
+received file matches. With --resume the first attempt is cancelled halfway
+and the file offered again, which should only send the chunks still missing.
+"""
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import lukes_client  # noqa: E402
+from lukes_client import Connection  # noqa: E402
+
+BLOCK_BYTE_COUNT = 1024 * 1024
+
+
+def peak_rss_kb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return None
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(BLOCK_BYTE_COUNT):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_file(path, size):
+    """Writes size bytes that do not repeat within a chunk"""
+    block = os.urandom(BLOCK_BYTE_COUNT)
+    with open(path, "wb") as file:
+        for start in range(0, size, BLOCK_BYTE_COUNT):
+            file.write(block[:min(BLOCK_BYTE_COUNT, size - start)])
+
+
+def connect():
+    """Returns a pair of connections to each other, each read on its own thread"""
+    sockets = []
+    for _ in range(2):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sockets.append(sock)
+
+    connections = [
+        Connection(sockets[0], None, "receiver", sockets[1].getsockname()),
+        Connection(sockets[1], None, "sender", sockets[0].getsockname()),
+    ]
+    for connection in connections:
+        threading.Thread(target=read, args=(connection,), daemon=True).start()
+    return connections
+
+
+def read(connection):
+    # Closing the connection waits for this thread, as it would for Connection.run
+    connection.reader = threading.current_thread()
+    try:
+        while connection.active:
+            connection.recieve_message()
+    except OSError:
+        pass
+
+
+def main():
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "payload.bin")
+        write_file(path, args.size * 1024 * 1024)
+        lukes_client.DOWNLOAD_DIRECTORY = os.path.join(directory, "downloads")
+
+        sending, receiving = connect()
+
+        if args.resume:
+            # Cancel the first attempt once half the file has arrived
+            def cancel_halfway():
+                while not sending.sending:
+                    time.sleep(0.001)
+                sender = next(iter(sending.sending.values()))
+                while not receiving.receiving or next(
+                        iter(receiving.receiving.values())).bytes_received < sender.size // 2:
+                    time.sleep(0.001)
+                sender.cancel()
+
+            canceller = threading.Thread(target=cancel_halfway)
+            canceller.start()
+            sending.send_file("receiver", path)
+            canceller.join()
+
+            # The receiver gives up on the transfer, keeping what it has
+            # Chunks still in flight are ignored rather than written to a closed file
+            receivers = list(receiving.receiving.values())
+            receiving.receiving.clear()
+            time.sleep(0.1)
+            for receiver in receivers:
+                receiver.close()
+
+        started = time.perf_counter()
+        sending.send_file("receiver", path)
+        elapsed = time.perf_counter() - started
+
+        # The sender can see the last ack before the receiver has moved the download aside
+        while not receiving.received:
+            time.sleep(0.001)
+        (receiver,) = receiving.received.values()
+        received = os.path.join(lukes_client.DOWNLOAD_DIRECTORY, "payload.bin")
+        result = {
+            "megabytes": args.size,
+            "seconds": round(elapsed, 3),
+            # Only what was sent this time, which excludes any resumed chunks
+            "megabytes_per_second": round(receiver.bytes_received / elapsed / 1e6, 1),
+            "resumed_chunks": receiver.resumed,
+            "chunks": receiver.count,
+            "corrupt_chunks": receiver.corrupt,
+            "matches": file_digest(path) == file_digest(received),
+            "peak_rss_kb": peak_rss_kb(),
+        }
+
+        sending.close()
+        receiving.close()
+
+    if args.json:
+        print(json.dumps(result))
+        return
+
+    for name, value in result.items():
+        print(f"{name:<24}{value}")
+
+
+def parse_args():
+    """Parses all command-line arguments for the benchmark"""
+    parser = argparse.ArgumentParser(
+        prog="bench_transfer",
+        description="Throughput of peer to peer file transfer over loopback")
+
+    parser.add_argument("-s", "--size",
+                        default=256,
+                        help="Size of the file in MiB (256)",
+                        type=int)
+
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Cancel the first attempt halfway and send the file again (False)")
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the result as a JSON object (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+Load generator for the rendezvous server
+
+Runs simulated clients over loopback through the real wire protocol and
+reports connection rate, per-command latency and server resource usage.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from codec import Message, decode_transfer_header, encode_command  # noqa: E402
+
+PASSWORD = b"loadgen"
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not samples:
+        return None
+    index = max(0, int(round(fraction * len(samples) + 0.5)) - 1)
+    return samples[min(index, len(samples) - 1)]
+
+
+def process_stats(pid):
+    """Reads the resident set size and thread count of a process"""
+    stats = {"rss_kb": None, "threads": None}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    stats["rss_kb"] = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    stats["threads"] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+class SimulatedClient:
+    """A single client speaking the wire protocol to the server"""
+    def __init__(self, index, host, port, latencies):
+        self.username = f"lg{index:06d}".encode()
+        self.host = host
+        self.port = port
+        self.latencies = latencies
+
+        # Replies are demultiplexed by type so relayed commands can interleave
+        self.commands = {}
+        self.transfers = asyncio.Queue()
+
+    def record(self, message, started):
+        self.latencies.setdefault(message.name, []).append(time.perf_counter() - started)
+
+    def command(self, command_type, param_1=b"", param_2=b""):
+        self.writer.write(encode_command(command_type, param_1, param_2))
+
+    def queue(self, command_type):
+        if command_type not in self.commands:
+            self.commands[command_type] = asyncio.Queue()
+        return self.commands[command_type]
+
+    async def expect(self, *command_types):
+        """Waits for the first reply of any of the given types"""
+        getters = {
+            asyncio.ensure_future(self.queue(t).get()): t for t in command_types
+        }
+        done, pending = await asyncio.wait(getters, return_when=asyncio.FIRST_COMPLETED)
+        for getter in pending:
+            getter.cancel()
+        getter = done.pop()
+        # Put back any reply that raced in alongside the one we return
+        for other in done:
+            self.queue(getters[other]).put_nowait(other.result())
+        return getters[getter], getter.result()
+
+    async def read_frames(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(1)
+                if header[0] == 1:
+                    command = await self.reader.readexactly(17)
+                    self.queue(command[0]).put_nowait(command[1:])
+                else:
+                    header = header + await self.reader.readexactly(5)
+                    _, identifier_length, data_length = decode_transfer_header(header)
+                    await self.transfers.put(
+                        await self.reader.readexactly(identifier_length + data_length))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def connect(self):
+        """Performs the port handoff and signs up, or in if already registered"""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        port = int.from_bytes(await self.reader.readexactly(2), "little")
+        if port != 0:
+            self.writer.close()
+            self.reader, self.writer = await asyncio.open_connection(self.host, port)
+        self.reader_task = asyncio.ensure_future(self.read_frames())
+
+        started = time.perf_counter()
+        self.command(Message.SIGN_UP.value, self.username, PASSWORD)
+        reply, _ = await self.expect(Message.ACCEPT_SIGN_IN.value, Message.DECLINE_SIGN_UP.value)
+        if reply == Message.ACCEPT_SIGN_IN.value:
+            self.record(Message.SIGN_UP, started)
+            return
+
+        # Registered by a previous run against the same server
+        started = time.perf_counter()
+        self.command(Message.SIGN_IN.value, self.username, PASSWORD)
+        reply, _ = await self.expect(
+            Message.ACCEPT_SIGN_IN.value,
+            Message.DECLINE_SIGN_IN.value,
+            Message.ALREADY_LOGGED_IN.value,
+        )
+        if reply != Message.ACCEPT_SIGN_IN.value:
+            raise RuntimeError(f"{self.username.decode()} could not sign in: {Message(reply).name}")
+        self.record(Message.SIGN_IN, started)
+
+    async def request_user_list(self):
+        started = time.perf_counter()
+        self.command(Message.REQUEST_USER_LIST.value)
+        await self.transfers.get()
+        self.record(Message.REQUEST_USER_LIST, started)
+
+    async def close(self):
+        self.writer.close()
+        self.reader_task.cancel()
+
+
+async def exchange(requester, accepter):
+    """Runs one request/accept exchange between two simulated clients"""
+    started = time.perf_counter()
+    requester.command(Message.REQUEST_PTP_CONNECTION.value, accepter.username)
+    await accepter.expect(Message.RELAY_PTP_REQUEST.value)
+    requester.record(Message.REQUEST_PTP_CONNECTION, started)
+
+    started = time.perf_counter()
+    # Placeholder connection info, the requester never connects to it
+    accepter.command(Message.ACCEPT_PTP_CONNECTION.value, requester.username, b"\x7f\x00\x00\x01")
+    await requester.expect(Message.ACCEPT_PTP_CONNECTION.value)
+    accepter.record(Message.ACCEPT_PTP_CONNECTION, started)
+
+
+async def run_clients(indices, args):
+    """Drives a group of clients through every phase and returns the raw samples"""
+    latencies = {}
+    clients = [SimulatedClient(i, args.host, args.port, latencies) for i in indices]
+
+    started = time.perf_counter()
+    # Bound the number of handshakes in flight so the listen backlog is not overrun
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def connect(client):
+        async with limit:
+            await client.connect()
+
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_time = time.perf_counter() - started
+
+    async def poll(client):
+        for _ in range(args.user_lists):
+            await client.request_user_list()
+
+    await asyncio.gather(*(poll(client) for client in clients))
+
+    async def pair(requester, accepter):
+        for _ in range(args.exchanges):
+            await exchange(requester, accepter)
+
+    await asyncio.gather(*(
+        pair(clients[i], clients[i + 1]) for i in range(0, len(clients) - 1, 2)
+    ))
+
+    for client in clients:
+        await client.close()
+
+    return {"connected": len(clients), "connect_time": connect_time, "latencies": latencies}
+
+
+def run_worker(indices, args):
+    return asyncio.run(run_clients(indices, args))
+
+
+def summarise(results, args, server_stats, elapsed):
+    latencies = {}
+    for result in results:
+        for name, samples in result["latencies"].items():
+            latencies.setdefault(name, []).extend(samples)
+
+    connected = sum(result["connected"] for result in results)
+    # Workers connect concurrently, so the slowest one bounds the rate
+    connect_time = max(result["connect_time"] for result in results)
+
+    report = {
+        "clients": args.clients,
+        "processes": args.processes,
+        "connected": connected,
+        "elapsed_s": round(elapsed, 3),
+        "connections_per_sec": round(connected / connect_time, 1) if connect_time else None,
+        "latency_ms": {},
+        "server": server_stats,
+    }
+    for name in sorted(latencies, key=lambda name: Message[name].value):
+        samples = sorted(latencies[name])
+        report["latency_ms"][name] = {
+            "count": len(samples),
+            "p50": round(percentile(samples, 0.50) * 1000, 3),
+            "p99": round(percentile(samples, 0.99) * 1000, 3),
+        }
+    return report
+
+
+def print_report(report):
+    print(f"Clients:          {report['connected']}/{report['clients']} "
+          f"over {report['processes']} process(es)")
+    print(f"Elapsed:          {report['elapsed_s']} s")
+    print(f"Connections/sec:  {report['connections_per_sec']}")
+    server = report["server"]
+    if server:
+        print(f"Server RSS:       {server['rss_kb']} kB")
+        print(f"Server threads:   {server['threads']}")
+    print()
+    print(f"{'Message':<26}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, stats in report["latency_ms"].items():
+        print(f"{name:<26}{stats['count']:>8}{stats['p50']:>10}{stats['p99']:>10}")
+
+
+def start_server(args):
+    # Every simulated client is driven as fast as it goes, so none are limited
+    command = [sys.executable, os.path.join(SRC, "server.py"), "--port", str(args.port),
+               "--no_rate_limits"]
+    if args.handoff:
+        command.append("--handoff")
+    if args.data_dir:
+        command += ["--data_dir", args.data_dir]
+    if args.workers > 1:
+        command += ["--workers", str(args.workers)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(args.startup_delay)
+    return process
+
+
+def main():
+    args = parse_args()
+
+    server = start_server(args) if args.spawn else None
+    server_pid = server.pid if server else args.server_pid
+
+    # Keep request/accept pairs inside one process
+    per_process = -(-args.clients // args.processes)
+    per_process += per_process % 2
+    groups = [
+        range(start, min(start + per_process, args.clients))
+        for start in range(0, args.clients, per_process)
+    ]
+
+    try:
+        started = time.perf_counter()
+        if len(groups) == 1:
+            results = [run_worker(groups[0], args)]
+        else:
+            with multiprocessing.Pool(len(groups)) as pool:
+                results = pool.starmap(run_worker, [(group, args) for group in groups])
+        elapsed = time.perf_counter() - started
+
+        # Sampled while the server still holds every session's state
+        server_stats = process_stats(server_pid) if server_pid else None
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report = summarise(results, args, server_stats, elapsed)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
+
+
+def parse_args():
+    """Parses all command-line arguments for the load generator"""
+    parser = argparse.ArgumentParser(
+        prog="loadgen",
+        description="A load generator for the rendezvous server")
+
+    parser.add_argument("-c", "--clients",
+                        default=100,
+                        help="The number of simulated clients (100)",
+                        type=int)
+
+    parser.add_argument("-P", "--processes",
+                        default=1,
+                        help="The number of processes to spread the clients over (1)",
+                        type=int)
+
+    parser.add_argument("-u", "--user_lists",
+                        default=10,
+                        help="User list requests per client (10)",
+                        type=int)
+
+    parser.add_argument("-e", "--exchanges",
+                        default=5,
+                        help="PTP request/accept exchanges per pair of clients (5)",
+                        type=int)
+
+    parser.add_argument("--concurrency",
+                        default=100,
+                        help="The number of handshakes in flight per process (100)",
+                        type=int)
+
+    parser.add_argument("-a", "--host",
+                        default="127.0.0.1",
+                        help="The IP address of the server (127.0.0.1)")
+
+    parser.add_argument("-p", "--port",
+                        default=65432,
+                        help="The port number of the server (65432)",
+                        type=int)
+
+    parser.add_argument("--spawn",
+                        action="store_true",
+                        help="Start a server subprocess for the run (False)")
+
+    parser.add_argument("--handoff",
+                        action="store_true",
+                        help="Start the spawned server in port handoff mode (False)")
+
+    parser.add_argument("--data_dir",
+                        help="Persist the spawned server's accounts in this directory (in memory)")
+
+    parser.add_argument("--workers",
+                        default=1,
+                        help="Worker processes of the spawned server, whose RSS and threads "
+                             "are then those of its broker process (1)",
+                        type=int)
+
+    parser.add_argument("--startup_delay",
+                        default=0.5,
+                        help="Seconds to wait for a spawned server to listen (0.5)",
+                        type=float)
+
+    parser.add_argument("--server_pid",
+                        help="The pid of an already running server to sample",
+                        type=int)
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Print the report as a single JSON object (False)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+A UDP proxy that loses, duplicates and reorders datagrams
+
+Each route listens on a local port and forwards what arrives to a target. Two
+routes pointing at each other's peers put the proxy between both directions of
+a chat, which is how the reliability layer is exercised without a real network.
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from reactor import Reactor  # noqa: E402
+
+
+class LossyProxy:
+    """Forwards datagrams along routes, impairing them on the way"""
+    def __init__(self, loss=0.0, duplicate=0.0, delay=0.0, jitter=0.0, seed=None):
+        """
+        loss and duplicate are the chances of a datagram being dropped or sent twice
+        Each datagram is held for delay plus up to jitter seconds, so jitter reorders them
+        """
+        self.loss = loss
+        self.duplicate = duplicate
+        self.delay = delay
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+        self.reactor = Reactor()
+        self.sockets = []
+
+        self.forwarded = 0
+        self.dropped = 0
+        self.duplicated = 0
+
+    def add_route(self, target, host="127.0.0.1", port=0):
+        """Forwards datagrams arriving at (host, port) to target, returning the bound address"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        self.sockets.append(sock)
+        self.reactor.register(sock, lambda: self.forward(sock, target))
+        return sock.getsockname()
+
+    def forward(self, sock, target):
+        datagram, _ = sock.recvfrom(65535)
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        copies = 1
+        if self.random.random() < self.duplicate:
+            copies = 2
+            self.duplicated += 1
+
+        for _ in range(copies):
+            self.forwarded += 1
+            held = self.delay + self.random.random() * self.jitter
+            if held <= 0:
+                sock.sendto(datagram, target)
+            else:
+                self.reactor.call_later(held, lambda: sock.sendto(datagram, target))
+
+    def start(self):
+        self.reactor.start()
+
+    def stop(self):
+        self.reactor.stop()
+        for sock in self.sockets:
+            sock.close()
+
+
+def parse_route(route):
+    """Parses listen_port:target_host:target_port"""
+    port, host, target_port = route.rsplit(":", 2)
+    return int(port), (host, int(target_port))
+
+
+def main():
+    args = parse_args()
+
+    proxy = LossyProxy(args.loss, args.duplicate, args.delay, args.jitter, args.seed)
+    for route in args.route:
+        port, target = parse_route(route)
+        address = proxy.add_route(target, args.host, port)
+        print(f"Forwarding {address[0]}:{address[1]} to {target[0]}:{target[1]}")
+
+    proxy.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    proxy.stop()
+    print(f"Forwarded {proxy.forwarded}, dropped {proxy.dropped}, duplicated {proxy.duplicated}")
+
+
+def parse_args():
+    """Parses all command-line arguments for the proxy"""
+    parser = argparse.ArgumentParser(
+        prog="lossy_proxy",
+        description="A UDP proxy that loses, duplicates and reorders datagrams")
+
+    parser.add_argument("-r", "--route",
+                        action="append",
+                        required=True,
+                        help="listen_port:target_host:target_port, may be repeated")
+
+    parser.add_argument("-a", "--host",
+                        default="127.0.0.1",
+                        help="The address to listen on (127.0.0.1)")
+
+    parser.add_argument("-l", "--loss",
+                        default=0.1,
+                        help="Chance of dropping a datagram (0.1)",
+                        type=float)
+
+    parser.add_argument("--duplicate",
+                        default=0.01,
+                        help="Chance of sending a datagram twice (0.01)",
+                        type=float)
+
+    parser.add_argument("--delay",
+                        default=0.0,
+                        help="Seconds every datagram is held (0.0)",
+                        type=float)
+
+    parser.add_argument("-j", "--jitter",
+                        default=0.01,
+                        help="Up to this many extra seconds a datagram is held, reordering them (0.01)",
+                        type=float)
+
+    parser.add_argument("--seed",
+                        default=None,
+                        help="Seed for the random impairments",
+                        type=int)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Password hashing and verification
+
+Passwords are stored as salted scrypt hashes. Hashing is deliberately slow, so
+it runs in a bounded process pool instead of on the event loop, and recently
+verified sign ins are cached so reconnecting clients skip the hash.
+"""
+import asyncio
+import base64
+import collections
+import hashlib
+import hmac
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# scrypt cost parameters, about 50ms per hash on a typical core
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTE_COUNT = 16
+SCHEME = "scrypt"
+
+
+class Overloaded(Exception):
+    """Raised when too many hashes are already waiting for the pool"""
+
+
+def hash_password(password, salt=None):
+    """Returns the encoded salted hash of a password"""
+    if salt is None:
+        salt = os.urandom(SALT_BYTE_COUNT)
+    digest = hashlib.scrypt(
+        password.encode("utf-8"), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return "$".join((
+        SCHEME,
+        str(SCRYPT_N),
+        str(SCRYPT_R),
+        str(SCRYPT_P),
+        base64.b64encode(salt).decode(),
+        base64.b64encode(digest).decode(),
+    ))
+
+
+def verify_password(password, encoded):
+    """Checks a password against an encoded hash in constant time"""
+    if not encoded.startswith(SCHEME + "$"):
+        # Accounts stored before passwords were hashed
+        return hmac.compare_digest(password.encode("utf-8"), encoded.encode("utf-8"))
+
+    _, n, r, p, salt, digest = encoded.split("$")
+    candidate = hashlib.scrypt(
+        password.encode("utf-8"), salt=base64.b64decode(salt), n=int(n), r=int(r), p=int(p))
+    return hmac.compare_digest(candidate, base64.b64decode(digest))
+
+
+class Authenticator:
+    """Hashes and verifies passwords in a process pool, caching verified sign ins"""
+    def __init__(self, workers=None, max_queue=1024, cache_ttl=300, cache_size=100_000):
+        """
+        workers is the size of the process pool, defaulting to the number of cores
+        max_queue is how many hashes may wait for the pool before sign ins are refused
+        cache_ttl is how long in seconds a verified sign in is remembered
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+
+        self.pool = None
+        # Keeps the pool fed without queueing unbounded work inside it
+        self.slots = asyncio.Semaphore(self.workers * 2)
+        self.waiting = 0
+        self.in_flight = 0
+
+        # Username to (keyed digest of the password, expiry), least recently used first
+        self.cache = collections.OrderedDict()
+        # The cache only holds digests under a key that never leaves this process
+        self.cache_key = os.urandom(32)
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.rejected = 0
+
+    def start(self):
+        if self.pool is None:
+            # Spawned rather than forked, as the server already runs threads
+            self.pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    async def run(self, function, *args):
+        """Runs a hash in the pool, refusing it if too many are already waiting"""
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded()
+
+        self.start()
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, function, *args)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    async def hash(self, password):
+        """Returns the encoded hash of a new account's password"""
+        return await self.run(hash_password, password)
+
+    async def verify(self, username, password, encoded):
+        """Checks a sign in, skipping the hash for one verified recently"""
+        if self.recall(username, password):
+            self.cache_hits += 1
+            return True
+
+        self.cache_misses += 1
+        verified = await self.run(verify_password, password, encoded)
+        if verified:
+            self.remember(username, password)
+        return verified
+
+    def digest(self, password):
+        return hmac.digest(self.cache_key, password.encode("utf-8"), "sha256")
+
+    def remember(self, username, password):
+        """Caches a sign in that has been verified"""
+        self.cache[username] = (self.digest(password), time.monotonic() + self.cache_ttl)
+        self.cache.move_to_end(username)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def recall(self, username, password):
+        entry = self.cache.get(username)
+        if entry is None:
+            return False
+
+        digest, expiry = entry
+        if expiry < time.monotonic():
+            del self.cache[username]
+            return False
+
+        if not hmac.compare_digest(digest, self.digest(password)):
+            return False
+
+        self.cache.move_to_end(username)
+        return True
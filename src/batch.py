@@ -0,0 +1,81 @@
+"""
+Coalescing of small chat frames
+
+Frames sent close together are packed into a single datagram, each behind its
+length, which is sent once it is full or once the first frame in it has waited
+for the flush delay. Many short messages then cost one system call and one
+datagram instead of one each, for at most the delay in added latency.
+"""
+import threading
+from codec import BATCH_ENTRY, BATCH_FRAME
+from fragment import MAX_FRAME_BYTE_COUNT
+
+# Seconds the first frame of a batch waits for others to join it
+FLUSH_DELAY = 0.002
+
+
+class Batcher:
+    """Packs the frames sent to one peer into datagrams of up to limit bytes"""
+    def __init__(self, reactor, send, delay=FLUSH_DELAY, limit=MAX_FRAME_BYTE_COUNT):
+        """send is called with each datagram, on whichever thread fills or flushes it"""
+        self.reactor = reactor
+        self.send = send
+        self.delay = delay
+        self.limit = limit
+
+        # Taken by senders and by the reactor thread flushing after the delay
+        self.lock = threading.Lock()
+        self.pending = bytearray()
+        self.count = 0
+        self.timer = None
+
+        self.frames = 0
+        self.datagrams = 0
+
+    def add(self, frame):
+        """Queues a frame, sending the batch if it is full"""
+        entry_byte_count = BATCH_ENTRY.size + len(frame)
+        with self.lock:
+            self.frames += 1
+            if len(self.pending) + entry_byte_count > self.limit:
+                self.flush_locked()
+
+            # Too large to share a datagram, but still sent after what came before it
+            if 1 + entry_byte_count > self.limit:
+                self.datagrams += 1
+                self.send(frame)
+                return
+
+            if not self.pending:
+                self.pending.append(BATCH_FRAME)
+                self.timer = self.reactor.call_later(self.delay, self.flush)
+            self.pending += BATCH_ENTRY.pack(len(frame))
+            self.pending += frame
+            self.count += 1
+
+            # Full, as no other frame could fit
+            if len(self.pending) + BATCH_ENTRY.size + 1 > self.limit:
+                self.flush_locked()
+
+    def flush(self):
+        """Sends whatever is waiting"""
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        # A batch of one is sent as the frame itself
+        if self.count == 1:
+            datagram = bytes(self.pending[1 + BATCH_ENTRY.size:])
+        else:
+            datagram = bytes(self.pending)
+        self.pending.clear()
+        self.count = 0
+
+        self.datagrams += 1
+        self.send(datagram)
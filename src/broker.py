@@ -0,0 +1,308 @@
+"""
+Shared state for a server running as several worker processes
+
+Workers share one listening port with SO_REUSEPORT, so any client may land on
+any of them. A broker process owns what must be agreed on by every worker: the
+registered accounts and which worker each signed in user is connected to.
+Workers talk to it over a Unix socket. They ask it to claim usernames and
+register accounts, and it tells every other worker of each change, so each
+keeps a replica of the accounts and of everyone's presence and can answer user
+lists and sign ins without asking. A command for a user on another worker is
+routed to that worker through the broker.
+"""
+import asyncio
+import logging
+import struct
+from codec import encode_command
+from store import CredentialStore
+
+log = logging.getLogger("server")
+
+# The length of the fields, then the frame type
+FRAME_HEADER = struct.Struct("<IB")
+# Each field is preceded by its length
+FIELD_LENGTH = struct.Struct("<I")
+REQUEST_ID = struct.Struct("<I")
+
+# Sent by workers
+HELLO = 0
+CLAIM = 1
+RELEASE = 2
+SET_VISIBLE = 3
+REGISTER = 4
+ROUTE = 5
+# Sent by the broker
+REPLY = 16
+JOIN = 17
+LEAVE = 18
+VISIBLE = 19
+ACCOUNT = 20
+DELIVER = 21
+READY = 22
+
+
+def encode_fields(fields):
+    """Returns fields, which must all be bytes, each preceded by its length"""
+    parts = [b""]
+    for field in fields:
+        parts.append(FIELD_LENGTH.pack(len(field)))
+        parts.append(field)
+    return b"".join(parts)
+
+
+def encode_frame(frame_type, *fields):
+    """Returns a frame carrying fields, which must all be bytes"""
+    body = encode_fields(fields)
+    return FRAME_HEADER.pack(len(body), frame_type) + body
+
+
+def decode_fields(body):
+    """Returns the fields of a frame body"""
+    fields = []
+    offset = 0
+    while offset < len(body):
+        (length,) = FIELD_LENGTH.unpack_from(body, offset)
+        offset += FIELD_LENGTH.size
+        fields.append(body[offset:offset + length])
+        offset += length
+    return fields
+
+
+async def read_frame(reader):
+    """Returns the type and fields of the next frame, raising IncompleteReadError at the end"""
+    length, frame_type = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    return frame_type, decode_fields(await reader.readexactly(length))
+
+
+def encode_flag(flag):
+    return b"\x01" if flag else b"\x00"
+
+
+class Broker:
+    """Owns the accounts and presence shared by every worker"""
+    def __init__(self, data_dir=None):
+        """Persists accounts in data_dir if given"""
+        self.credentials = CredentialStore(data_dir)
+        # Username to the writer of its worker and whether it is visible
+        self.online = {}
+        # The writer of every connected worker
+        self.workers = set()
+        # Usernames being registered, so two workers cannot both register one
+        self.registering = set()
+
+    def broadcast(self, frame, origin):
+        """Sends a frame to every worker but the one it came from"""
+        for writer in self.workers:
+            if writer is not origin:
+                writer.write(frame)
+
+    async def handle_worker(self, reader, writer):
+        frame_type, fields = await read_frame(reader)
+        if frame_type != HELLO:
+            writer.close()
+            return
+        worker_id = fields[0].decode()
+        log.info(f"Worker {worker_id} connected to the broker")
+
+        # Bring the worker's replicas up to date before it serves anyone
+        for username, password in self.credentials.accounts.items():
+            writer.write(encode_frame(ACCOUNT, username.encode(), password.encode()))
+        for username, (_, visible) in self.online.items():
+            writer.write(encode_frame(JOIN, username.encode(), encode_flag(visible)))
+        writer.write(encode_frame(READY))
+        self.workers.add(writer)
+
+        try:
+            while True:
+                frame_type, fields = await read_frame(reader)
+                self.handle_frame(writer, frame_type, fields)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.error(f"Worker {worker_id} disconnected from the broker")
+        except asyncio.CancelledError:
+            # The broker is stopping
+            pass
+        finally:
+            self.workers.discard(writer)
+            # Its users went with it
+            for username in [name for name, (owner, _) in self.online.items() if owner is writer]:
+                del self.online[username]
+                self.broadcast(encode_frame(LEAVE, username.encode()), writer)
+            writer.close()
+
+    def handle_frame(self, writer, frame_type, fields):
+        if frame_type == CLAIM:
+            request_id, username, visible = fields
+            claimed = username.decode() not in self.online
+            if claimed:
+                self.online[username.decode()] = (writer, visible == b"\x01")
+                self.broadcast(encode_frame(JOIN, username, visible), writer)
+            writer.write(encode_frame(REPLY, request_id, encode_flag(claimed)))
+
+        elif frame_type == RELEASE:
+            (username,) = fields
+            owner, _ = self.online.get(username.decode(), (None, None))
+            # Only the worker that owns the name may release it
+            if owner is writer:
+                del self.online[username.decode()]
+                self.broadcast(encode_frame(LEAVE, username), writer)
+
+        elif frame_type == SET_VISIBLE:
+            username, visible = fields
+            owner, _ = self.online.get(username.decode(), (None, None))
+            if owner is writer:
+                self.online[username.decode()] = (writer, visible == b"\x01")
+                self.broadcast(encode_frame(VISIBLE, username, visible), writer)
+
+        elif frame_type == REGISTER:
+            # Waiting for the log must not hold up the worker's other requests
+            asyncio.ensure_future(self.register(writer, *fields))
+
+        elif frame_type == ROUTE:
+            username, frame = fields
+            owner, _ = self.online.get(username.decode(), (None, None))
+            # Dropped if they have gone since, just as a signed out user would miss it
+            if owner is not None:
+                owner.write(encode_frame(DELIVER, username, frame))
+
+    async def register(self, writer, request_id, username, password):
+        """Adds an account once it is durable, unless the username is taken"""
+        name = username.decode()
+        registered = name not in self.credentials and name not in self.registering
+        if registered:
+            self.registering.add(name)
+            try:
+                await self.credentials.add(name, password.decode())
+            except OSError:
+                registered = False
+            finally:
+                self.registering.discard(name)
+
+        if registered:
+            self.broadcast(encode_frame(ACCOUNT, username, password), writer)
+        writer.write(encode_frame(REPLY, request_id, encode_flag(registered)))
+
+    async def serve(self, sock):
+        """Serves workers on a listening Unix socket, which may have been opened before they started"""
+        self.credentials.load()
+        server = await asyncio.start_unix_server(self.handle_worker, sock=sock)
+        log.info(f"Broker listening on {sock.getsockname()}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.credentials.close()
+
+
+class RemoteUser:
+    """A user signed in to another worker, sent commands through the broker"""
+    def __init__(self, username, link):
+        self.username = username
+        self.link = link
+
+    def send_command(self, command_num, *params):
+        return self.send_frame(encode_command(command_num, *params))
+
+    def send_frame(self, frame):
+        # Whether the user's own worker can send it on is not known here
+        self.link.route(self.username, frame)
+        return True
+
+
+class BrokerLink:
+    """A worker's connection to the broker"""
+    def __init__(self, server, path, worker_id):
+        self.server = server
+        self.path = path
+        self.worker_id = worker_id
+
+        self.writer = None
+        # Replies are matched to requests by id
+        self.replies = {}
+        self.next_request_id = 0
+        self.ready = None
+
+    async def start(self):
+        """Connects to the broker and waits until the replicas are up to date"""
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.ready = asyncio.get_running_loop().create_future()
+        self.writer.write(encode_frame(HELLO, str(self.worker_id).encode()))
+        self.reader_task = asyncio.ensure_future(self.read(reader))
+        await self.ready
+
+    async def close(self):
+        self.reader_task.cancel()
+        self.writer.close()
+
+    async def request(self, frame_type, *fields):
+        """Sends a request and returns whether the broker granted it"""
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        reply = asyncio.get_running_loop().create_future()
+        self.replies[request_id] = reply
+        self.writer.write(encode_frame(frame_type, REQUEST_ID.pack(request_id), *fields))
+        return await reply
+
+    async def claim(self, username, visible):
+        """Claims username across every worker, returning False if it is taken"""
+        return await self.request(CLAIM, username.encode(), encode_flag(visible))
+
+    async def register(self, username, password):
+        """Registers an account across every worker, returning False if the username is taken"""
+        if not await self.request(REGISTER, username.encode(), password.encode()):
+            return False
+        self.server.credentials.accounts[username] = password
+        return True
+
+    def release(self, username):
+        self.writer.write(encode_frame(RELEASE, username.encode()))
+
+    def set_visible(self, username, visible):
+        self.writer.write(encode_frame(SET_VISIBLE, username.encode(), encode_flag(visible)))
+
+    def route(self, username, frame):
+        self.writer.write(encode_frame(ROUTE, username.encode(), frame))
+
+    async def read(self, reader):
+        registry = self.server.registry
+        try:
+            while True:
+                frame_type, fields = await read_frame(reader)
+
+                if frame_type == REPLY:
+                    request_id, granted = fields
+                    reply = self.replies.pop(REQUEST_ID.unpack(request_id)[0], None)
+                    if reply is not None and not reply.done():
+                        reply.set_result(granted == b"\x01")
+
+                elif frame_type == JOIN:
+                    username, visible = fields[0].decode(), fields[1] == b"\x01"
+                    # Any earlier entry is stale, as the broker only grants a name once
+                    stale = registry.get(username)
+                    if isinstance(stale, RemoteUser):
+                        registry.sign_out(stale)
+                    registry.sign_in(RemoteUser(username, self), username, visible)
+
+                elif frame_type == LEAVE:
+                    user = registry.get(fields[0].decode())
+                    if isinstance(user, RemoteUser):
+                        registry.sign_out(user)
+
+                elif frame_type == VISIBLE:
+                    user = registry.get(fields[0].decode())
+                    if isinstance(user, RemoteUser):
+                        registry.set_visible(user, fields[1] == b"\x01")
+
+                elif frame_type == ACCOUNT:
+                    self.server.credentials.accounts[fields[0].decode()] = fields[1].decode()
+
+                elif frame_type == DELIVER:
+                    user = registry.get(fields[0].decode())
+                    if user is not None and not isinstance(user, RemoteUser):
+                        user.send_frame(fields[1])
+
+                elif frame_type == READY:
+                    self.ready.set_result(None)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Without the broker the replicas can no longer be trusted
+            log.error("Lost the connection to the broker, stopping")
+            self.server.stop()
@@ -1,12 +1,54 @@
 import argparse
+import heapq
 import socket
-from server import Message
+from codec import (
+    BATCH_FRAME,
+    COMPRESSED_FLAG,
+    FEATURE_BATCHES,
+    FEATURE_COMPRESSION,
+    FEATURE_FRAGMENTS,
+    FEATURE_RELIABLE,
+    FRAGMENT_FRAME,
+    FRAGMENT_HEADER_BYTE_COUNT,
+    HELLO_ACK_FRAME,
+    HELLO_FRAME,
+    MESSAGE_FRAME,
+    Message,
+    Presence,
+    REQUEST_HELLO_SETUP,
+    REQUEST_RELAY,
+    SETUP_HELLO,
+    SETUP_TCP,
+    COMMAND_BYTE_COUNT,
+    TRANSFER_HEADER_BYTE_COUNT,
+    decode_command,
+    decode_conn_info,
+    decode_conn_setup,
+    decode_data_transfer,
+    decode_hello,
+    decode_param,
+    decode_transfer_header,
+    encode_conn_info,
+    encode_data_transfer,
+    encode_hello,
+    int_to_ip_address,
+    ip_address_to_int,
+    iter_batch,
+    pack_command_into,
+)
+from batch import Batcher
+from compression import MessageCompressor, MessageDecompressor
+from fragment import MAX_DATAGRAM_BYTE_COUNT, Reassembler, fragment
+from history import History, format_time
+from reactor import Reactor
+from reliable import ReliableChannel
+from search import RESULTS, SearchIndex
+import select
 import textwrap
-import struct
-import random
-from threading import Thread, Lock
+from threading import Lock, Thread
 import time
 import os
+import urllib.parse
 
 # These have been pulled from the Blender build scripts
 # Terminal colours are changed by inserting the escape sequence
@@ -27,47 +69,61 @@ class Colours:
         return colour + message + Colours.END
 
 
-# 2 bytes for type of message, and 2 8-byte params
-MESSAGE_BYTE_COUNT = 18
-
-
-def pad_bytes(bytes, length):
-    """Pads bytes with null bytes from the left"""
-    return bytes + b"\x00" * (length - len(bytes))
-
-
-def ip_address_to_int(ip_address):
-    """Converts an ip address to an integer so it can be sent over a socket"""
-    return struct.unpack("!L", socket.inet_aton(ip_address))[0]
-
-
-def int_to_ip_address(integer):
-    """Converts an integer back into an ip address"""
-    return socket.inet_ntoa(struct.pack("!L", integer))
-
-
 class Client:
     """A client for a PTP messaging program that uses UDP sockets to communicate"""
+    # How many matching usernames to suggest when a lookup is not exact
+    SUGGESTIONS = 10
+
     def __init__(self, args):
-        """args must have fields username, ip_address, port, signin"""
+        """
+        args must have fields username, ip_address, port, signin, invisible, reliable,
+        batch_delay, history_dir, relay, heartbeat
+        """
         self.username = args.username
         self.server_ip_address = args.ip_address
         self.server_port = args.port
         self.signed_up = args.signin
-
-        self.ptp_requests = []
+        self.visible = not args.invisible
+        # Chat features to offer other clients
+        self.features = FEATURE_FRAGMENTS | FEATURE_BATCHES | FEATURE_COMPRESSION
+        if args.reliable:
+            self.features |= FEATURE_RELIABLE
+        # Seconds chat messages wait to be sent together, or None to send each at once
+        self.batch_delay = None if args.batch_delay is None else args.batch_delay / 1000
+        self.history_directory = args.history_dir
+        # Whether to chat through a relay on the server rather than directly
+        self.relay = args.relay
+        # Seconds between heartbeats telling the server this client is still there, or 0
+        self.heartbeat = args.heartbeat
+
+        # Usernames that have requested a chat, and whether they asked for a relay
+        self.ptp_requests = {}
+        # Usernames whose chat is waiting for the server to allocate a relay
+        self.awaiting_relay = set()
         self.chats = []
-
-    def command(self, command_type, param_1=b"\x00" * 8, param_2=b"\x00" * 8):
+        # Visible users, kept up to date by the server's presence updates
+        self.online_users = {}
+        # Every command is encoded into the same buffer
+        self.command_buffer = bytearray(COMMAND_BYTE_COUNT)
+        # Heartbeats are sent from the reactor thread while the user is typing commands
+        self.command_lock = Lock()
+        # One thread receives the messages of every chat
+        self.reactor = Reactor()
+
+    def command(self, command_type, param_1=b"", param_2=b""):
         """Sends the given command to the server, defaulting to null parameters"""
-        self.server.sendall(
-            # Commands begin with this byte
-            b"\x01" +
-            command_type.to_bytes(1, "little") +
-            # This ensures that the right format is maintained
-            pad_bytes(param_1, 8) +
-            pad_bytes(param_2, 8)
-        )
+        with self.command_lock:
+            pack_command_into(self.command_buffer, 0, command_type, param_1, param_2)
+            self.server.sendall(self.command_buffer)
+
+    def send_heartbeat(self):
+        """Tells the server this client is still there, then schedules the next heartbeat"""
+        try:
+            self.command(Message.HEARTBEAT.value)
+        except OSError:
+            # The server has gone or the user signed out
+            return
+        self.reactor.call_later(self.heartbeat, self.send_heartbeat)
 
     def run(self):
         """Connects to the server and repeatedly polls the user"""
@@ -76,26 +132,39 @@ class Client:
         self.server.connect((self.server_ip_address, self.server_port))
 
         # Get the personal socket that the server will use
-        self.server_port = int.from_bytes(self.server.recv(2), "little")
-        self.server.close()
+        # A port of 0 means the server keeps us on this connection
+        port = int.from_bytes(self.server.recv(2), "little")
+        if port != 0:
+            self.server_port = port
+            self.server.close()
 
-        # Reconnect to the new socket
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.connect((self.server_ip_address, self.server_port))
+            # Reconnect to the new socket
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.connect((self.server_ip_address, self.server_port))
 
         if self.signed_up:
             self.sign_in()
         else:
             self.sign_up()
 
+        # Users are visible by default once signed in
+        if not self.visible:
+            self.command(Message.SET_VISIBILITY.value, b"\x00")
+
+        self.subscribe_presence()
+        self.reactor.start()
+        if self.heartbeat:
+            self.reactor.call_later(self.heartbeat, self.send_heartbeat)
+
         while True:
             print(textwrap.dedent("""
                   You can:
-                  (1) Request the user list
+                  (1) View the user list
                   (2) Request a PTP connection
                   (3) Accept a PTP connection
                   (4) Enter an active chat
-                  (5) Sign out from the server
+                  (5) Search your chats
+                  (6) Sign out from the server
                   Please enter your choice as a number:"""))
 
             choice = input()
@@ -108,7 +177,7 @@ class Client:
             choice = int(choice)
             match choice:
                 case 1:
-                    self.request_user_list()
+                    self.print_user_list(self.online_users)
                 case 2:
                     self.request_ptp_connection()
                 case 3:
@@ -116,48 +185,131 @@ class Client:
                 case 4:
                     self.enter_chat()
                 case 5:
+                    self.search_chats()
+                case 6:
                     self.sign_out()
                     break
                 case _:
                     print("Unknown request")
 
-    def check_for_requests(self):
-        """Parses any ptp requests or responses"""
-        self.server.setblocking(False)
-
-        # If there is no data, recv will throw an error which will be caught and ignored
-        try:
-            # The only messages we receive from the server at this point
-            # are requests, or accepted or declined requests
-            response = self.server.recv(MESSAGE_BYTE_COUNT)
-            response_type = response[1]
-
-            # We've received a ptp request from the server
-            if response_type == Message.RELAY_PTP_REQUEST.value:
-                username = response[2:10].decode(
-                    "utf-8").rstrip("\0")  # Param 1
-                self.ptp_requests.append(username)
-
-            # Another user has accepted our request
-            if response_type == Message.ACCEPT_PTP_CONNECTION.value:
-                username = response[2:10].decode(
-                    "utf-8").rstrip("\0")  # Param 1
-                conn_info = response[10:17]  # Param 2
-
-                # Create a new chat with them
-                chat = Chat(username)
-
-                # Parse the connection info from param 2
-                chat.host = int_to_ip_address(
-                    int.from_bytes(conn_info[:4], "little"))
-                chat.tcp_port = int.from_bytes(conn_info[4:6], "little")
-
-                self.chats.append(chat)
+    def recv_exactly(self, length):
+        """Receives exactly length bytes from the server"""
+        data = b""
+        while len(data) < length:
+            chunk = self.server.recv(length - len(data))
+            if chunk == b"":
+                raise ConnectionError("The server closed the connection")
+            data += chunk
+        return data
+
+    def receive_frame(self):
+        """
+        Receives and handles one frame
+        Returns the identifier and data of a data transfer, or None for a command
+        """
+        initial_byte = self.recv_exactly(1)
+
+        if initial_byte[0] != 1:
+            header = initial_byte + self.recv_exactly(TRANSFER_HEADER_BYTE_COUNT - 1)
+            _, identifier_length, data_length = decode_transfer_header(header)
+            identifier = self.recv_exactly(identifier_length)
+            return identifier, self.recv_exactly(data_length)
+
+        response = initial_byte + self.recv_exactly(COMMAND_BYTE_COUNT - 1)
+        _, response_type, param_1, param_2 = decode_command(response)
+        # Param 1 is always a username for the messages we receive here
+        username = decode_param(param_1)
+
+        # We've received a ptp request from the server
+        if response_type == Message.RELAY_PTP_REQUEST.value:
+            self.ptp_requests[username] = param_2[0]
+
+        # Another user has accepted our request
+        elif response_type == Message.ACCEPT_PTP_CONNECTION.value:
+            # Create a new chat with them
+            chat = self.create_chat(username)
+            self.chats.append(chat)
+
+            # Parse the connection info from param 2
+            address = decode_conn_info(param_2)
+            if decode_conn_setup(param_2) == SETUP_HELLO:
+                Thread(target=chat.start_hello, args=(address,)).start()
+            else:
+                chat.host, chat.tcp_port = address
                 Thread(target=chat.start_requester).start()
-        except:
-            pass
 
-        self.server.setblocking(True)
+        # Both users are given their side of a relay once the request is accepted
+        elif response_type == Message.RELAY_ALLOCATED.value:
+            self.awaiting_relay.discard(username)
+            chat = self.create_chat(username)
+            self.chats.append(chat)
+            Thread(target=chat.start_hello, args=(decode_conn_info(param_2),)).start()
+
+        elif response_type in (Message.RELAY_NOT_AVAILABLE.value, Message.USER_NOT_AVAILABLE.value):
+            if username in self.awaiting_relay:
+                self.awaiting_relay.discard(username)
+                if response_type == Message.RELAY_NOT_AVAILABLE.value:
+                    print("Sorry, the server could not relay the chat")
+                else:
+                    print(f"Sorry, {username} is no longer available")
+
+        # A user has appeared or disappeared from the user list
+        elif response_type == Message.PRESENCE_UPDATE.value:
+            if Presence(param_2[0]) in (Presence.JOIN, Presence.VISIBLE):
+                self.online_users[username] = None
+            else:
+                self.online_users.pop(username, None)
+
+        # Param 1 holds the type of the command the server refused
+        elif response_type == Message.RATE_LIMITED.value:
+            print("Sorry, the server is limiting how often you can do that")
+            # Anything waiting for a user list is given an empty one
+            if param_1[0] in (Message.REQUEST_USER_LIST.value, Message.QUERY_USER_LIST.value,
+                              Message.SUBSCRIBE_PRESENCE.value):
+                return b"", b""
+            # Only one relay is waited for at a time, and the refusal does not name it
+            if param_1[0] == Message.ACCEPT_PTP_RELAY.value:
+                self.awaiting_relay.clear()
+
+    def create_chat(self, username):
+        """Returns a new chat with a user, continuing any history archived from earlier chats"""
+        # Usernames may contain any character, so they are quoted to make file names
+        archive = os.path.join(
+            self.history_directory,
+            urllib.parse.quote(self.username, safe=""),
+            urllib.parse.quote(username, safe=""))
+        return Chat(username, self.reactor, self.features, self.batch_delay, archive)
+
+    def check_for_requests(self):
+        """Parses any ptp requests, responses or presence updates"""
+        # Handle every frame that has already arrived without waiting for more
+        while select.select([self.server], [], [], 0)[0]:
+            self.receive_frame()
+
+    def subscribe_presence(self):
+        """Fetches the user list once, after which the server pushes changes"""
+        self.command(Message.SUBSCRIBE_PRESENCE.value, b"\x01")
+
+        _, data = self.receive_transfer()
+        users = data.decode("utf-8").split(", ") if data else []
+        self.online_users = dict.fromkeys(users)
+
+    def receive_transfer(self):
+        """Handles frames until a data transfer arrives"""
+        # Requests may be relayed to us before the transfer arrives
+        transfer = None
+        while transfer is None:
+            transfer = self.receive_frame()
+        return transfer
+
+    def query_users(self, prefix, offset=0, limit=0):
+        """Returns a page of visible usernames starting with prefix and the total number of matches"""
+        self.command(Message.QUERY_USER_LIST.value, prefix.encode(),
+                     offset.to_bytes(4, "little") + limit.to_bytes(4, "little"))
+
+        identifier, data = self.receive_transfer()
+        users = data.decode("utf-8").split(", ") if data else []
+        return users, int.from_bytes(identifier, "little")
 
     def sign_up(self):
         """Creates a new account on the server"""
@@ -168,13 +320,17 @@ class Client:
             self.command(Message.SIGN_UP.value,
                          self.username.encode(), self.password.encode())
 
-            response = self.server.recv(MESSAGE_BYTE_COUNT)
+            response = self.recv_exactly(COMMAND_BYTE_COUNT)
             response_type = response[1]
 
             if response_type == Message.ACCEPT_SIGN_IN.value:
                 print("You've successfully signed up to the server!")
                 break
 
+            elif response_type == Message.RATE_LIMITED.value:
+                print("The server is busy, trying again shortly")
+                time.sleep(1)
+
             else:
                 print("Sorry, that username was not accepted by the server")
                 self.username = input(
@@ -189,13 +345,17 @@ class Client:
             self.command(Message.SIGN_IN.value,
                          self.username.encode(), self.password.encode())
 
-            response = self.server.recv(MESSAGE_BYTE_COUNT)
+            response = self.recv_exactly(COMMAND_BYTE_COUNT)
             response_type = response[1]
 
             if response_type == Message.ACCEPT_SIGN_IN.value:
                 print("You've successfully signed in to the server!")
                 break
 
+            elif response_type == Message.RATE_LIMITED.value:
+                print("The server is busy, trying again shortly")
+                time.sleep(1)
+
             else:
                 print(Message(response_type))
                 print(
@@ -216,23 +376,30 @@ class Client:
         if i == 1:
             print(empty_text)
 
-    def request_user_list(self):
-        """Retrieves the current visible users from the server"""
-        self.command(Message.REQUEST_USER_LIST.value)
-
-        # This is a data transfer, with the content being the user list
-        response = self.server.recv(6)
-        list_length = int.from_bytes(response[2:], "little")
-        list = self.server.recv(list_length).decode("utf-8").split(", ")
-
-        self.print_user_list(list)
-
     def request_ptp_connection(self):
         """Sends a PTP connection request to the server"""
         username = input(
             f"Please enter their {Colours.coloured('username', Colours.OKBLUE)}: ")
 
-        self.command(Message.REQUEST_PTP_CONNECTION.value, username.encode())
+        # Look the user up first, suggesting usernames they may have meant
+        users, total = self.query_users(username, limit=self.SUGGESTIONS)
+        if username not in users:
+            if total == 0:
+                print(f"No visible user starts with '{username}'")
+                return
+
+            self.print_user_list(users)
+            if total > len(users):
+                print(f"... and {total - len(users)} more")
+            username = input(
+                f"Please enter their full {Colours.coloured('username', Colours.OKBLUE)}: ")
+
+        # Param 2 says how we can set up the chat
+        flags = REQUEST_HELLO_SETUP
+        if self.relay:
+            flags |= REQUEST_RELAY
+        self.command(Message.REQUEST_PTP_CONNECTION.value, username.encode(),
+                     flags.to_bytes(1, "little"))
         print("Request sent. You will be notified of their response")
 
     def accept_ptp_connection(self):
@@ -251,17 +418,35 @@ class Client:
             return
 
         # They can't accept a request again
-        self.ptp_requests.remove(username)
+        flags = self.ptp_requests.pop(username)
+
+        # Either user may be unable to receive datagrams from the other directly
+        if self.relay or flags & REQUEST_RELAY:
+            self.awaiting_relay.add(username)
+            self.command(Message.ACCEPT_PTP_RELAY.value, username.encode())
+            # The chat is created as the relay is allocated
+            while username in self.awaiting_relay:
+                self.receive_frame()
+            if any(chat.username == username for chat in self.chats):
+                print("Request accepted. You can now view a chat with them through the server")
+            return
 
         # Create the chat
-        chat = Chat(username)
+        chat = self.create_chat(username)
         self.chats.append(chat)
-        ip_address, port = chat.get_conn_info()
-        Thread(target=chat.start_host).start()
+
+        # Clients that can say hello over UDP skip the TCP connection
+        if flags & REQUEST_HELLO_SETUP:
+            ip_address, port = chat.open_endpoint()
+            Thread(target=chat.start_answering).start()
+            setup = SETUP_HELLO
+        else:
+            ip_address, port = chat.get_conn_info()
+            Thread(target=chat.start_host).start()
+            setup = SETUP_TCP
 
         # Transform the connection info for the requesting client
-        part_1 = ip_address_to_int(ip_address).to_bytes(4, "little")
-        info = pad_bytes(part_1 + port.to_bytes(2, "little"), 8)
+        info = encode_conn_info(ip_address, port, setup)
 
         # and send
         self.command(Message.ACCEPT_PTP_CONNECTION.value,
@@ -292,9 +477,9 @@ class Client:
         # Clear the screen when entering a chat using os-specific commands
         os.system('cls' if os.name == 'nt' else 'clear')
         print(f"Chatting with {chat.username}")
-        print("Enter a message to send it in real time, or q to quit")
+        print("Enter a message to send it in real time, o to show older messages, or q to quit")
 
-        Thread(target=chat.enter_chat).start()
+        chat.enter_chat()
 
         # Keep sending messages until q or a keyboard interrupt
         while True:
@@ -308,8 +493,45 @@ class Client:
                 chat.leave_chat()
                 break
 
+            if message == "o":
+                chat.print_older()
+                continue
+
             chat.send_message(message)
 
+    def search(self, query, limit=RESULTS):
+        """Returns (chat, number, content, time, sent) for the newest messages matching query"""
+        matches = []
+        for chat in self.chats:
+            for number in chat.search_index.search(query, limit):
+                message = chat.history.message(number)
+                # Forgotten, as the chat has no archive
+                if message is not None:
+                    matches.append((message[1], chat, number, message))
+
+        results = []
+        for _, chat, number, (content, timestamp, sent) in heapq.nlargest(
+                limit, matches, key=lambda match: match[0]):
+            results.append((chat, number, content, format_time(timestamp), sent))
+        return results
+
+    def search_chats(self):
+        """Prints the newest messages in any chat that contain the words asked for"""
+        query = input(
+            f"Please enter {Colours.coloured('words to search for', Colours.OKBLUE)}, "
+            "ending any with * to match words starting with it: ")
+
+        results = self.search(query)
+        if not results:
+            print("No messages match")
+            return
+
+        for chat, number, content, current_time, sent in results:
+            sender = "you" if sent else chat.username
+            print(Colours.coloured(
+                f"Chat with {chat.username}, message {number} from {sender} ({current_time}):",
+                Colours.GREEN) + f"\n{content}\n")
+
     def sign_out(self):
         """Signs the user out of the server"""
         self.command(Message.SIGN_OUT.value,
@@ -318,36 +540,79 @@ class Client:
 
         for chat in self.chats:
             chat.close()
+        self.reactor.stop()
 
         print("You've been successfully signed out")
 
 
 class Chat:
     """Manages a chat between one client and another"""
-    def __init__(self, username):
+    RECEIVE_BUFFER_BYTE_COUNT = 1024 * 1024
+    # Seconds between hellos, and before the chat setup over UDP gives up
+    HELLO_INTERVAL = 0.2
+    HANDSHAKE_TIMEOUT = 120
+
+    def __init__(self, username, reactor, features=0, batch_delay=None, archive=None):
+        """
+        batch_delay is how long in seconds messages wait to be sent together, if at all
+        archive is where to keep messages too old to hold in memory, if anywhere
+        """
         self.username = username
+        self.reactor = reactor
+        # The features we offer, narrowed to those both clients offer once set up
+        self.features = features
+        self.batch_delay = batch_delay
+        self.tcp_sock = None
+        self.channel = None
+        self.batcher = None
+        self.compressor = None
+        self.decompressor = None
+
+        # Large messages are split into fragments, which carry the id of their message
+        self.message_id = 0
+        self.reassembler = Reassembler()
 
         self.in_chat = False
-        # Previous messages
-        self.history = []
-        self.udp_lock = Lock()
-
-    def get_conn_info(self):
-        """Determines the ip address and generates tcp and udp ports"""
-        self.ip_address = socket.gethostbyname(socket.gethostname())
-        # Get ports nondeterministically to avoid collisions
-        self.tcp_port = random.randint(15000, 65000)
-        self.udp_port = random.randint(15000, 65000)
+        # Previous messages, sent and received, and an index of the words in them
+        self.history = History(archive)
+        self.search_index = SearchIndex()
+        for number, content in self.history.iter_contents():
+            self.search_index.add(number, content)
+        # The number of the oldest message printed since entering the chat
+        self.oldest_shown = 1
+        # Called with the number, text and time of each message arriving while the chat is open
+        self.on_message = None
+
+    def get_conn_info(self, ip_address=None):
+        """Opens the TCP socket the requesting client sets the chat up through, returning its address"""
+        self.ip_address = ip_address or socket.gethostbyname(socket.gethostname())
+        # We use a TCP socket to send data required to set up the UDP socket
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Port 0 lets the OS pick a free port so chats never collide
+        self.tcp_sock.bind((self.ip_address, 0))
+        self.tcp_sock.listen()
+        self.tcp_port = self.tcp_sock.getsockname()[1]
 
         return self.ip_address, self.tcp_port
 
+    def open_endpoint(self, ip_address=None):
+        """Opens the UDP socket the requesting client says hello to, returning its address"""
+        self.ip_address = ip_address or socket.gethostbyname(socket.gethostname())
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.bind((self.ip_address, 0))
+        self.udp_port = self.udp_sock.getsockname()[1]
+
+        return self.ip_address, self.udp_port
+
     def start_host(self):
-        """Sets up the chat for the accepting client"""
-        # We use a TCP socket to send data required to set up the UDP socket
-        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.tcp_sock.bind((self.ip_address, self.tcp_port))
-        self.tcp_sock.listen()
-        self.tcp_sock, _ = self.tcp_sock.accept()
+        """Sets up the chat over TCP for the accepting client, once get_conn_info has been called"""
+        listener = self.tcp_sock
+        self.tcp_sock, _ = listener.accept()
+        listener.close()
+
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.bind((self.ip_address, 0))
+        self.udp_port = self.udp_sock.getsockname()[1]
 
         # Send our UDP port and get their ip address and port
         # (They have our ip address already from the connection info)
@@ -356,82 +621,254 @@ class Chat:
         self.other_ip_address = int_to_ip_address(
             int.from_bytes(self.tcp_sock.recv(4), "little"))
 
-        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_sock.bind((self.ip_address, self.udp_port))
-
         self.to_address = (self.other_ip_address, self.other_udp_port)
+        self.negotiate_features()
 
     def start_requester(self):
-        """Sets up the chat for the requesting client"""
+        """Sets up the chat over TCP for the requesting client"""
         self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # These are set before this method is called
         self.tcp_sock.connect((self.host, self.tcp_port))
 
+        self.ip_address = socket.gethostbyname(socket.gethostname())
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.bind((self.ip_address, 0))
+        self.udp_port = self.udp_sock.getsockname()[1]
+
         # Get UDP port from other client and send our UDP port
         self.other_udp_port = int.from_bytes(self.tcp_sock.recv(4), "little")
-        self.udp_port = random.randint(15000, 65000)
         self.tcp_sock.sendall(self.udp_port.to_bytes(4, "little"))
-        self.ip_address = socket.gethostbyname(socket.gethostname())
         self.tcp_sock.sendall(ip_address_to_int(
             self.ip_address).to_bytes(4, "little"))
 
+        self.to_address = (self.host, self.other_udp_port)
+        self.negotiate_features()
+
+    def start_answering(self):
+        """
+        Sets up the chat for the accepting client once open_endpoint has been called,
+        by answering the requesting client's hello
+        """
+        # Where they are is only known once their hello arrives
+        self.to_address = None
+        self.handshake()
+
+    def start_hello(self, address):
+        """Sets up the chat by saying hello to address, either the other client or a relay"""
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_sock.bind((self.ip_address, self.udp_port))
+        # Port 0 lets the OS pick a free port
+        self.udp_sock.bind(("", 0))
+        self.to_address = address
+        self.handshake()
+
+    def negotiate_features(self):
+        """Agrees on the features both clients offer over TCP, then starts receiving messages"""
+        self.tcp_sock.sendall(self.features.to_bytes(1, "little"))
+        self.features &= self.tcp_sock.recv(1)[0]
+        self.start_receiving()
+
+    def handshake(self):
+        """
+        Agrees on the features both clients offer over UDP, then starts receiving messages
+        A hello is resent until the other client's hello or answer arrives, and without a
+        to_address the other client's hello is waited for and answered
+        """
+        hello = encode_hello(HELLO_FRAME, self.features)
+        deadline = time.monotonic() + self.HANDSHAKE_TIMEOUT
+        self.udp_sock.settimeout(self.HELLO_INTERVAL)
+        try:
+            while True:
+                if self.to_address is not None:
+                    self.udp_sock.sendto(hello, self.to_address)
+                try:
+                    buffer, address = self.udp_sock.recvfrom(MAX_DATAGRAM_BYTE_COUNT)
+                except socket.timeout:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"{self.username} never answered the chat setup")
+                    continue
+
+                if buffer[0] not in (HELLO_FRAME, HELLO_ACK_FRAME):
+                    continue
+                frame_type, features = decode_hello(buffer)
+                if frame_type == HELLO_FRAME:
+                    if self.to_address is None:
+                        self.to_address = address
+                    self.udp_sock.sendto(encode_hello(HELLO_ACK_FRAME, self.features), address)
+                self.features &= features
+                break
+        finally:
+            self.udp_sock.settimeout(None)
 
-        self.to_address = (self.host, self.other_udp_port)
+        self.start_receiving()
+
+    def start_receiving(self):
+        """Sets up the agreed features and registers the chat with the reactor"""
+        # Leaves room for the fragments of a large message to queue up
+        self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER_BYTE_COUNT)
+
+        if self.features & FEATURE_RELIABLE:
+            self.channel = ReliableChannel(
+                self.udp_sock, self.to_address, self.reactor, self.handle_frame)
+
+        # A single stream for the whole chat relies on every message arriving in order
+        if self.features & FEATURE_COMPRESSION:
+            streaming = self.channel is not None
+            self.compressor = MessageCompressor(streaming)
+            self.decompressor = MessageDecompressor(streaming)
+
+        # Both clients can receive batches, but only those asked to send them do
+        if self.batch_delay is not None and self.features & FEATURE_BATCHES:
+            self.batcher = Batcher(self.reactor, self.transmit, self.batch_delay)
+
+        self.reactor.register(self.udp_sock, self.receive_message)
 
     def enter_chat(self):
-        """Prints previous messages and polls the server for new ones"""
-        # Print the previous messages
-        for i in range(len(self.history)):
-            message, current_time = self.history[i]
-            print(f"Message {i + 1} ({current_time}):\n{message}\n")
+        """Prints the latest messages, then prints new ones as the reactor receives them"""
+        messages = self.history.latest()
+        self.oldest_shown = messages[0][0] if messages else 1
+        if self.oldest_shown > self.history.first_available():
+            print(f"{self.oldest_shown - 1} older messages, enter o to show them\n")
+        self.print_page(messages)
 
         self.in_chat = True
+        self.on_message = self.print_message
 
-        # Continuously check for sent messages and print them if found
-        i = len(self.history)
-        while self.in_chat:
-            try:
-                # This will throw an error if there is no available message, so we catch it
-                message, current_time = self.receive_message()
-                print(Colours.coloured(
-                    f"\nMessage {i + 1} ({current_time}):", Colours.GREEN) + f"\n{message}\n")
-                i += 1
-            except Exception as e:
-                pass
+    def print_older(self):
+        """Prints the page of messages before the oldest one printed"""
+        messages = self.history.page(self.oldest_shown)
+        if not messages:
+            print("There are no older messages")
+            return
+
+        self.oldest_shown = messages[0][0]
+        print(f"Messages {self.oldest_shown} to {messages[-1][0]}:\n")
+        self.print_page(messages)
+
+    def print_page(self, messages):
+        for number, message, current_time, sent in messages:
+            sender = "you" if sent else self.username
+            print(f"Message {number} from {sender} ({current_time}):\n{message}\n")
+
+    def print_message(self, number, message, current_time):
+        print(Colours.coloured(
+            f"\nMessage {number} from {self.username} ({current_time}):", Colours.GREEN)
+            + f"\n{message}\n")
 
     def leave_chat(self):
-        """Stops the polling for messages"""
+        """Stops printing new messages, which are still kept in the history"""
         self.in_chat = False
+        self.on_message = None
+
+    def record(self, content, sent):
+        """Adds a message to the history and the search index, returning its number"""
+        number = self.history.append(content, sent=sent)
+        self.search_index.add(number, content)
+        return number
 
     def send_message(self, text):
         """Send a message to the other client"""
-        with self.udp_lock:
-            encoded_text = text.encode("utf-8")
-            length = len(encoded_text).to_bytes(4, "little")
-            message = (b"\x00" * 2) + length + encoded_text
-            self.udp_sock.sendto(message, self.to_address)
+        self.record(text, True)
+        data = text.encode("utf-8")
+        compressed = None
+        if self.compressor is not None:
+            compressed = self.compressor.compress(data)
+
+        if compressed is not None:
+            message = encode_data_transfer(True, b"", compressed, compressed=True)
+        else:
+            message = encode_data_transfer(True, b"", data)
+
+        datagrams = [message]
+        if self.features & FEATURE_FRAGMENTS:
+            datagrams = fragment(message, self.message_id)
+            self.message_id += 1
+
+        for datagram in datagrams:
+            if self.batcher is not None:
+                self.batcher.add(datagram)
+            else:
+                self.transmit(datagram)
+
+    def transmit(self, datagram):
+        if self.channel is not None:
+            self.channel.send(datagram)
+        else:
+            self.udp_sock.sendto(datagram, self.to_address)
 
     def receive_message(self):
-        """Receive a message from the other client"""
-        with self.udp_lock:
-            self.udp_sock.setblocking(False)
-            buffer, _ = self.udp_sock.recvfrom(1024)
-            self.udp_sock.setblocking(True)
+        """
+        Receive a message from the other client
+        Called on the reactor thread once the socket is readable, so this never blocks
+        """
+        buffer, address = self.udp_sock.recvfrom(MAX_DATAGRAM_BYTE_COUNT)
+        # Nothing a peer could have meant to send
+        if not buffer:
+            return
+
+        # The other client is still waiting for an answer to its hello
+        if buffer[0] == HELLO_FRAME:
+            self.udp_sock.sendto(encode_hello(HELLO_ACK_FRAME, self.features), address)
+            return
+        if buffer[0] == HELLO_ACK_FRAME:
+            return
 
-            length = int.from_bytes(buffer[2:6], "little")
-            content = buffer[6:6 + length].decode("utf-8")
-            current_time = time.strftime("%H:%M:%S", time.localtime())
+        if self.channel is not None:
+            # Frames are handled once every frame before them has arrived
+            self.channel.receive(memoryview(buffer))
+        else:
+            self.handle_frame(buffer)
+
+    def handle_frame(self, frame):
+        """Adds a message from the other client to the history, dropping anything malformed"""
+        if not frame:
+            return
 
-            self.history.append((content, current_time))
+        if frame[0] == BATCH_FRAME:
+            for batched in iter_batch(memoryview(frame)):
+                self.handle_frame(batched)
+            return
+
+        if frame[0] == FRAGMENT_FRAME:
+            if len(frame) < FRAGMENT_HEADER_BYTE_COUNT:
+                return
+            frame = self.reassembler.add(memoryview(frame))
+            # Still waiting for the rest of the message
+            if frame is None:
+                return
+
+        # Only whole chat messages are handled past here
+        if (len(frame) < TRANSFER_HEADER_BYTE_COUNT
+                or frame[0] & ~COMPRESSED_FLAG != MESSAGE_FRAME):
+            return
+        frame_type, identifier_length, data_length = decode_transfer_header(frame)
+        if TRANSFER_HEADER_BYTE_COUNT + identifier_length + data_length > len(frame):
+            return
 
-            return (content, current_time)
+        frame_type, _, data = decode_data_transfer(memoryview(frame))
+        if frame_type & COMPRESSED_FLAG:
+            if self.decompressor is None:
+                raise ValueError("A compressed message in a chat without compression")
+            data = self.decompressor.decompress(data)
+        content = str(data, "utf-8")
+        current_time = time.strftime("%H:%M:%S", time.localtime())
+
+        number = self.record(content, False)
+
+        on_message = self.on_message
+        if on_message is not None:
+            on_message(number, content, current_time)
 
     def close(self):
         """Close all connections"""
-        self.tcp_sock.close()
+        if self.batcher is not None:
+            self.batcher.flush()
+        self.reactor.unregister(self.udp_sock)
+        if self.channel is not None:
+            self.channel.close()
+        if self.tcp_sock is not None:
+            self.tcp_sock.close()
         self.udp_sock.close()
+        self.history.close()
 
 
 def main():
@@ -467,6 +904,33 @@ def parse_args():
                         action="store_true",
                         help="Whether to hide the user's username from other users (False)")
 
+    parser.add_argument("-r", "--reliable",
+                        action="store_true",
+                        help="Whether to resend lost chat messages and keep them in order, "
+                             "when the other user's client also does (False)")
+
+    parser.add_argument("--relay",
+                        action="store_true",
+                        help="Chat through a relay on the server, for when the other user's "
+                             "client cannot be reached directly (False)")
+
+    parser.add_argument("--history_dir",
+                        default="history",
+                        help="Where to archive chat messages, so they can be paged through "
+                             "and kept between runs (history)")
+
+    parser.add_argument("-b", "--batch_delay",
+                        default=None,
+                        help="Send chat messages written within this many milliseconds "
+                             "of each other in one datagram (off)",
+                        type=float)
+
+    parser.add_argument("--heartbeat",
+                        default=30,
+                        help="Seconds between heartbeats telling the server this client "
+                             "is still there, or 0 to send none (30)",
+                        type=float)
+
     return parser.parse_args()
 
 
@@ -0,0 +1,374 @@
+"""
+Rendezvous servers on several machines sharing presence by gossip
+
+Each server of a cluster is a node, named by the address its peers reach it
+on. A node keeps the usernames signed in to it along with a version that goes
+up with every change, the accounts registered on it and a heartbeat that goes
+up every round. Every round it sends a digest of what it knows of each node to
+one random peer, and the two send each other whatever the other is missing, so
+a change spreads to every node within a few rounds without any node having to
+know every other one up front.
+
+Users signed in to other nodes sit in the registry as remote users, so user
+lists and presence pushes cover the whole cluster and commands for them are
+forwarded to the node they are on. A node whose heartbeat stops for long enough
+is taken to be down and its users are shown offline until it is heard from again.
+
+There is no coordinator, so a username claimed on two nodes before either has
+heard of the other stays reachable only from the node each is on, and an account
+registered on two nodes at once keeps whichever password a node heard of first.
+"""
+import asyncio
+import logging
+import random
+import struct
+import time
+from broker import RemoteUser, decode_fields, encode_fields, encode_frame, read_frame
+
+log = logging.getLogger("server")
+
+# Seconds between gossip rounds
+GOSSIP_INTERVAL = 0.5
+# Seconds without a new heartbeat before a node is taken to be down
+NODE_TIMEOUT = 5
+
+# A digest of what the sender knows, answered with a digest and updates
+DIGEST = 32
+# A digest sent in reply, answered only with updates
+DIGEST_REPLY = 33
+UPDATE = 34
+# A command for a user signed in to the receiving node
+ROUTE = 35
+
+# Incarnation, heartbeat, presence version and number of accounts known
+NODE_DIGEST = struct.Struct("<QQQI")
+# The same, but with the index of the first account sent and whether presence is sent
+NODE_UPDATE = struct.Struct("<QQQIB")
+
+
+def join_names(names):
+    """Returns names as a single field, each preceded by its length"""
+    return encode_fields([name.encode() for name in names])
+
+
+def split_names(data):
+    return [field.decode() for field in decode_fields(data)]
+
+
+class Node:
+    """What is known of one node of the cluster"""
+    def __init__(self, node_id, incarnation):
+        self.node_id = node_id
+        # Restarting a node starts a new incarnation, which replaces everything known of the old
+        self.incarnation = incarnation
+        self.heartbeat = 0
+        # Versions start at 1, so 0 means no presence has been heard yet
+        self.version = 0
+        # Username to whether it is visible
+        self.presence = {}
+        # Registered on the node in this incarnation, in order
+        self.accounts = []
+
+        self.last_seen = time.monotonic()
+        self.alive = True
+
+    def digest(self):
+        return NODE_DIGEST.pack(self.incarnation, self.heartbeat, self.version, len(self.accounts))
+
+
+class PeerLink:
+    """A connection to another node, opened when first needed and again after it drops"""
+    def __init__(self, cluster, node_id):
+        self.cluster = cluster
+        self.node_id = node_id
+        self.writer = None
+        # Frames sent while connecting
+        self.pending = []
+        self.connecting = None
+
+    def send(self, frame):
+        if self.writer is not None:
+            self.writer.write(frame)
+            return
+
+        self.pending.append(frame)
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self.connect())
+
+    def route(self, username, frame):
+        """Sends a command to a user signed in to the node"""
+        self.cluster.routed += 1
+        self.send(encode_frame(ROUTE, username.encode(), frame))
+
+    async def connect(self):
+        host, port = self.node_id.rsplit(":", 1)
+        try:
+            reader, writer = await asyncio.open_connection(host, int(port))
+        except OSError as error:
+            log.debug(f"Could not reach node {self.node_id}: {error}")
+            # Lost like any other gossip, and commands to a node that is down go nowhere anyway
+            self.pending.clear()
+            self.connecting = None
+            return
+
+        self.writer = writer
+        writer.write(b"".join(self.pending))
+        self.pending.clear()
+        try:
+            await self.cluster.serve_connection(reader, writer)
+        finally:
+            self.writer = None
+            self.connecting = None
+
+    def close(self):
+        if self.connecting is not None:
+            self.connecting.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Cluster:
+    """One node of a cluster of servers, keeping the server's registry in step with the others"""
+    def __init__(self, server, host, port, seeds, gossip_interval=GOSSIP_INTERVAL,
+                 node_timeout=NODE_TIMEOUT):
+        """
+        Listens for other nodes on host and port, which together name this node
+        seeds are the names of nodes to gossip with until others are heard of
+        """
+        self.server = server
+        self.host = host
+        self.port = port
+        self.seeds = [seed for seed in seeds if seed != f"{host}:{port}"]
+        self.gossip_interval = gossip_interval
+        self.node_timeout = node_timeout
+
+        self.me = Node(f"{host}:{port}", time.time_ns())
+        # Node name to what is known of every other node
+        self.nodes = {}
+        self.links = {}
+
+        self.listener = None
+        self.gossiper = None
+        self.rounds = 0
+        self.routed = 0
+
+    def live_count(self):
+        """Returns how many nodes are up, counting this one"""
+        return 1 + sum(node.alive for node in self.nodes.values())
+
+    def link(self, node_id):
+        if node_id not in self.links:
+            self.links[node_id] = PeerLink(self, node_id)
+        return self.links[node_id]
+
+    async def start(self):
+        self.listener = await asyncio.start_server(self.serve_connection, self.host, self.port)
+        self.gossiper = asyncio.ensure_future(self.gossip())
+        log.info(f"Cluster node {self.me.node_id} gossiping with {self.seeds}")
+
+    async def close(self):
+        """Tells the live nodes this one has no users left, then stops gossiping"""
+        self.gossiper.cancel()
+        self.me.presence.clear()
+        self.me.version += 1
+        for node in self.nodes.values():
+            if node.alive:
+                self.link(node.node_id).send(
+                    self.encode_update(self.me, self.me.version - 1, len(self.me.accounts)))
+        # Gives the updates a moment to be written before the links close
+        await asyncio.sleep(0)
+
+        self.listener.close()
+        for link in self.links.values():
+            link.close()
+
+    async def claim(self, username, visible):
+        """Adds a username signed in to this node, which the others hear of by gossip"""
+        self.me.presence[username] = visible
+        self.me.version += 1
+        return True
+
+    def release(self, username):
+        if self.me.presence.pop(username, None) is not None:
+            self.me.version += 1
+
+    def set_visible(self, username, visible):
+        if username in self.me.presence:
+            self.me.presence[username] = visible
+            self.me.version += 1
+
+    async def register(self, username, password):
+        """Registers an account on this node, returning False if it is known to be taken"""
+        if username in self.server.credentials:
+            return False
+
+        await self.server.credentials.add(username, password)
+        self.me.accounts.append((username, password))
+        return True
+
+    async def gossip(self):
+        while True:
+            await asyncio.sleep(self.gossip_interval)
+            self.me.heartbeat += 1
+            self.rounds += 1
+            self.expire()
+
+            # Seeds are kept on the list so a node that was down is found again
+            peers = set(self.seeds)
+            peers.update(node_id for node_id, node in self.nodes.items() if node.alive)
+            if peers:
+                peer = random.choice(sorted(peers))
+                self.link(peer).send(self.encode_digest(DIGEST))
+
+    def expire(self):
+        """Shows the users of nodes that have gone quiet as offline"""
+        cutoff = time.monotonic() - self.node_timeout
+        for node in self.nodes.values():
+            if node.alive and node.last_seen < cutoff:
+                log.warning(f"Node {node.node_id} stopped responding")
+                node.alive = False
+                # Its presence is kept to show again if it comes back
+                self.apply_presence(node, node.presence, {})
+
+    def encode_digest(self, frame_type):
+        fields = [self.me.node_id.encode(), self.me.digest()]
+        for node in self.nodes.values():
+            fields.append(node.node_id.encode())
+            fields.append(node.digest())
+        return encode_frame(frame_type, *fields)
+
+    def encode_update(self, node, known_version, known_accounts):
+        """Returns what a peer that knows the given version and accounts of node is missing"""
+        send_presence = node.version > known_version
+        visible = [name for name, shown in node.presence.items() if shown] if send_presence else []
+        hidden = [name for name, shown in node.presence.items() if not shown] if send_presence else []
+        accounts = node.accounts[known_accounts:]
+        return encode_frame(
+            UPDATE,
+            node.node_id.encode(),
+            NODE_UPDATE.pack(node.incarnation, node.heartbeat, node.version,
+                             known_accounts, send_presence),
+            join_names(visible),
+            join_names(hidden),
+            join_names(field for account in accounts for field in account),
+        )
+
+    def send_updates(self, writer, fields):
+        """Sends every node the digest in fields shows the peer is behind on"""
+        known = {}
+        for i in range(0, len(fields), 2):
+            known[fields[i].decode()] = NODE_DIGEST.unpack(fields[i + 1])
+
+        for node in [self.me, *self.nodes.values()]:
+            theirs = known.get(node.node_id)
+            if theirs is None or theirs[0] < node.incarnation:
+                writer.write(self.encode_update(node, 0, 0))
+                continue
+
+            incarnation, heartbeat, version, account_count = theirs
+            if incarnation == node.incarnation and (
+                    heartbeat < node.heartbeat or version < node.version
+                    or account_count < len(node.accounts)):
+                writer.write(self.encode_update(node, version, account_count))
+
+    async def serve_connection(self, reader, writer):
+        """Handles the frames of a connection to another node, in whichever direction it was opened"""
+        try:
+            while True:
+                frame_type, fields = await read_frame(reader)
+
+                if frame_type == DIGEST:
+                    self.send_updates(writer, fields)
+                    writer.write(self.encode_digest(DIGEST_REPLY))
+
+                elif frame_type == DIGEST_REPLY:
+                    self.send_updates(writer, fields)
+
+                elif frame_type == UPDATE:
+                    self.apply_update(*fields)
+
+                elif frame_type == ROUTE:
+                    user = self.server.registry.get(fields[0].decode())
+                    # Dropped if they have gone since, just as a signed out user would miss it
+                    if user is not None and not isinstance(user, RemoteUser):
+                        user.send_frame(fields[1])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # The node is stopping
+            pass
+        finally:
+            writer.close()
+
+    def apply_update(self, node_id, header, visible, hidden, accounts):
+        node_id = node_id.decode()
+        if node_id == self.me.node_id:
+            return
+        incarnation, heartbeat, version, first_account, has_presence = NODE_UPDATE.unpack(header)
+
+        node = self.nodes.get(node_id)
+        if node is not None and incarnation < node.incarnation:
+            return
+        if node is None or incarnation > node.incarnation:
+            if node is not None:
+                log.info(f"Node {node_id} restarted")
+                self.apply_presence(node, node.presence if node.alive else {}, {})
+            node = self.nodes[node_id] = Node(node_id, incarnation)
+            log.info(f"Joined by node {node_id}")
+
+        if heartbeat > node.heartbeat:
+            node.heartbeat = heartbeat
+            node.last_seen = time.monotonic()
+            if not node.alive:
+                log.info(f"Node {node_id} is responding again")
+                node.alive = True
+                self.apply_presence(node, {}, node.presence)
+
+        fields = split_names(accounts)
+        # Only accounts following on from those already known can be added in order
+        if first_account <= len(node.accounts):
+            new = list(zip(fields[0::2], fields[1::2]))[len(node.accounts) - first_account:]
+            node.accounts.extend(new)
+            for username, password in new:
+                if username not in self.server.credentials:
+                    asyncio.ensure_future(self.store_account(username, password))
+
+        if has_presence and version > node.version:
+            node.version = version
+            presence = dict.fromkeys(split_names(visible), True)
+            presence.update(dict.fromkeys(split_names(hidden), False))
+            if node.alive:
+                self.apply_presence(node, node.presence, presence)
+            node.presence = presence
+
+    async def store_account(self, username, password):
+        try:
+            await self.server.credentials.add(username, password)
+        except OSError:
+            # Heard of again from the next node that gossips it
+            pass
+
+    def apply_presence(self, node, previous, presence):
+        """Brings the registry from showing the previous users of node to showing presence"""
+        registry = self.server.registry
+        link = self.link(node.node_id)
+
+        for username in previous.keys() - presence.keys():
+            user = registry.get(username)
+            # The user may have moved to another node since
+            if isinstance(user, RemoteUser) and user.link is link:
+                registry.sign_out(user)
+
+        for username, visible in presence.items():
+            user = registry.get(username)
+            if isinstance(user, RemoteUser) and user.link is link:
+                registry.set_visible(user, visible)
+                continue
+
+            if user is not None and not isinstance(user, RemoteUser):
+                log.warning(f"{username} is signed in here and on node {node.node_id}")
+                continue
+            # Anyone signed in elsewhere under the name has since moved here
+            if user is not None:
+                registry.sign_out(user)
+            registry.sign_in(RemoteUser(username, link), username, visible)
@@ -0,0 +1,312 @@
+"""
+Encoding and decoding of the wire format shared by the server and clients
+The protocol specification is described in the report
+"""
+import socket
+import struct
+from enum import Enum
+
+
+class Message(Enum):
+    SIGN_UP = 0
+    DECLINE_SIGN_UP = 1
+    SIGN_IN = 2
+    ACCEPT_SIGN_IN = 3
+    DECLINE_SIGN_IN = 4
+    REQUEST_USER_LIST = 5
+    REQUEST_PTP_CONNECTION = 6
+    USER_NOT_AVAILABLE = 7
+    RELAY_PTP_REQUEST = 8
+    DECLINE_PTP_CONNECTION = 9
+    ACCEPT_PTP_CONNECTION = 10
+    SIGN_OUT = 11
+    ALREADY_LOGGED_IN = 12
+    SET_VISIBILITY = 13
+    SUBSCRIBE_PRESENCE = 14
+    PRESENCE_UPDATE = 15
+    QUERY_USER_LIST = 16
+    ACCEPT_PTP_RELAY = 17
+    RELAY_ALLOCATED = 18
+    RELAY_NOT_AVAILABLE = 19
+    HEARTBEAT = 20
+    RATE_LIMITED = 21
+
+
+class Presence(Enum):
+    """Changes to the set of visible users, sent in param 2 of PRESENCE_UPDATE"""
+    JOIN = 0
+    LEAVE = 1
+    VISIBLE = 2
+    HIDDEN = 3
+
+
+# The first byte of every frame
+COMMAND_FRAME = 0x01
+MESSAGE_FRAME = 0x00
+FILE_FRAME = 0x40
+# Peer to peer file transfer, after a file data transfer offers the file
+FILE_CHUNK_FRAME = 0x41
+FILE_ACK_FRAME = 0x42
+# Chat datagrams sent by the reliability layer
+SEGMENT_FRAME = 0x20
+ACK_FRAME = 0x21
+# Part of a chat frame too large for one datagram
+FRAGMENT_FRAME = 0x10
+# Several small chat frames sent together
+BATCH_FRAME = 0x30
+# The chat setup over UDP, each followed by the chat features offered
+HELLO_FRAME = 0x50
+HELLO_ACK_FRAME = 0x51
+# Set in the frame type of a data transfer whose data is compressed
+COMPRESSED_FLAG = 0x80
+
+# Flags in the first byte of param 2 of REQUEST_PTP_CONNECTION and RELAY_PTP_REQUEST
+REQUEST_RELAY = 0x01
+# The requester can set up the chat with a UDP hello instead of over TCP
+REQUEST_HELLO_SETUP = 0x02
+
+# How the requester sets up the chat with the address in ACCEPT_PTP_CONNECTION
+SETUP_TCP = 0
+SETUP_HELLO = 1
+
+# Chat features each client offers in the chat setup, used when both offer them
+FEATURE_RELIABLE = 0x01
+FEATURE_FRAGMENTS = 0x02
+FEATURE_BATCHES = 0x04
+FEATURE_COMPRESSION = 0x08
+
+# 1 byte for the frame type, 1 byte for command type, 8 bytes for param 1 and 8 for param 2
+# Packing "8s" pads params with null bytes, and truncates any that are too long
+COMMAND = struct.Struct("<BB8s8s")
+COMMAND_BYTE_COUNT = COMMAND.size
+PARAM_BYTE_COUNT = 8
+
+# 1 byte for the frame type, 1 for the identifier length and 4 for the data length
+TRANSFER_HEADER = struct.Struct("<BBI")
+TRANSFER_HEADER_BYTE_COUNT = TRANSFER_HEADER.size
+
+# An ip address as sent in ACCEPT_PTP_CONNECTION, followed by a port and how to set up the chat
+CONN_INFO = struct.Struct("<IHB")
+ADDRESS = struct.Struct("!L")
+
+# 1 byte for the frame type and 4 for the sequence number, followed by a data transfer
+SEGMENT_HEADER = struct.Struct("<BI")
+SEGMENT_HEADER_BYTE_COUNT = SEGMENT_HEADER.size
+
+# 1 byte for the frame type, 4 for the next sequence number expected and 8 for a
+# bitmap of the segments received after it, the lowest bit being the one just after
+ACK = struct.Struct("<BIQ")
+ACK_BYTE_COUNT = ACK.size
+
+# 1 byte for the frame type, 4 for the message id, 2 for the index of this
+# fragment and 2 for the number of fragments, followed by part of the frame
+FRAGMENT_HEADER = struct.Struct("<BIHH")
+FRAGMENT_HEADER_BYTE_COUNT = FRAGMENT_HEADER.size
+
+# The data of a file data transfer offering a file: 4 bytes for the transfer
+# id, 8 for the file size and 4 for the size of each chunk but the last
+FILE_INFO = struct.Struct("<IQI")
+
+# 1 byte for the frame type, 4 for the transfer id, 4 for the chunk index and
+# 4 for the crc32 of the chunk, followed by the chunk
+FILE_CHUNK_HEADER = struct.Struct("<BIII")
+FILE_CHUNK_HEADER_BYTE_COUNT = FILE_CHUNK_HEADER.size
+
+# 1 byte for the frame type, 4 for the transfer id and 4 for the first chunk
+# missing, followed by a bitmap of the chunks received after it
+FILE_ACK = struct.Struct("<BII")
+FILE_ACK_BITMAP_BYTE_COUNT = 64
+
+# The length of each frame in a batch, which follows it
+BATCH_ENTRY = struct.Struct("<H")
+
+# 1 byte for the frame type and 1 for the chat features offered
+HELLO = struct.Struct("<BB")
+
+EMPTY_PARAM = b"\x00" * PARAM_BYTE_COUNT
+
+
+def decode_param(param):
+    """Decodes a padded string parameter, which cannot hold null as it pads the rest"""
+    string = bytes(param).rstrip(b"\x00").decode("utf-8")
+    if "\x00" in string:
+        raise ValueError("A string parameter holding null")
+    return string
+
+
+def ip_address_to_int(ip_address):
+    """Converts an ip address to an int to be sent over a socket"""
+    return ADDRESS.unpack(socket.inet_aton(ip_address))[0]
+
+
+def int_to_ip_address(integer):
+    """Converts an int back into an ip address"""
+    return socket.inet_ntoa(ADDRESS.pack(integer))
+
+
+def encode_command(command_type, param_1=EMPTY_PARAM, param_2=EMPTY_PARAM):
+    """Returns a command frame"""
+    return COMMAND.pack(COMMAND_FRAME, command_type, param_1, param_2)
+
+
+def pack_command_into(buffer, offset, command_type, param_1=EMPTY_PARAM, param_2=EMPTY_PARAM):
+    """Writes a command frame into a preallocated buffer at offset"""
+    COMMAND.pack_into(buffer, offset, COMMAND_FRAME, command_type, param_1, param_2)
+
+
+def decode_command(buffer, offset=0):
+    """
+    Returns the frame type, command type and params of the command at offset
+    Only the params are copied out of the buffer, which may be a memoryview
+    """
+    return COMMAND.unpack_from(buffer, offset)
+
+
+def iter_commands(view):
+    """Decodes every command in a memoryview holding a whole number of commands"""
+    return COMMAND.iter_unpack(view)
+
+
+def encode_data_transfer(message, identifier, data, compressed=False):
+    """Returns a data transfer frame, assuming identifier and data are encoded"""
+    frame_type = MESSAGE_FRAME if message else FILE_FRAME
+    if compressed:
+        frame_type |= COMPRESSED_FLAG
+
+    # Joining copies each part exactly once into the new frame
+    return b"".join((
+        TRANSFER_HEADER.pack(frame_type, len(identifier), len(data)),
+        identifier,
+        data,
+    ))
+
+
+def pack_data_transfer_into(buffer, offset, message, identifier, data):
+    """Writes a data transfer frame into a preallocated buffer at offset, returning its end"""
+    TRANSFER_HEADER.pack_into(
+        buffer, offset,
+        MESSAGE_FRAME if message else FILE_FRAME, len(identifier), len(data))
+
+    offset += TRANSFER_HEADER_BYTE_COUNT
+    buffer[offset:offset + len(identifier)] = identifier
+    offset += len(identifier)
+    buffer[offset:offset + len(data)] = data
+    return offset + len(data)
+
+
+def decode_transfer_header(buffer, offset=0):
+    """Returns the frame type, identifier length and data length of a data transfer"""
+    return TRANSFER_HEADER.unpack_from(buffer, offset)
+
+
+def decode_data_transfer(view):
+    """
+    Returns the frame type, identifier and data of a whole data transfer
+    The identifier and data are slices of view, so nothing is copied
+    """
+    frame_type, identifier_length, data_length = TRANSFER_HEADER.unpack_from(view)
+    start = TRANSFER_HEADER_BYTE_COUNT + identifier_length
+    return (
+        frame_type,
+        view[TRANSFER_HEADER_BYTE_COUNT:start],
+        view[start:start + data_length],
+    )
+
+
+def encode_segment(sequence, frame):
+    """Returns a reliable chat datagram carrying a whole frame"""
+    return SEGMENT_HEADER.pack(SEGMENT_FRAME, sequence) + frame
+
+
+def decode_segment(view):
+    """Returns the sequence number and frame of a reliable chat datagram, without copying"""
+    _, sequence = SEGMENT_HEADER.unpack_from(view)
+    return sequence, view[SEGMENT_HEADER_BYTE_COUNT:]
+
+
+def encode_ack(expected, received):
+    """Returns an acknowledgement of every segment before expected and those in received"""
+    return ACK.pack(ACK_FRAME, expected, received)
+
+
+def decode_ack(buffer):
+    """Returns the next sequence number expected and the bitmap of segments received after it"""
+    _, expected, received = ACK.unpack_from(buffer)
+    return expected, received
+
+
+def encode_fragment(message_id, index, count, data):
+    """Returns a datagram carrying part of a frame"""
+    return b"".join((FRAGMENT_HEADER.pack(FRAGMENT_FRAME, message_id, index, count), data))
+
+
+def decode_fragment(view):
+    """Returns the message id, index, fragment count and data of a fragment, without copying"""
+    _, message_id, index, count = FRAGMENT_HEADER.unpack_from(view)
+    return message_id, index, count, view[FRAGMENT_HEADER_BYTE_COUNT:]
+
+
+def iter_batch(view):
+    """Yields a view of each frame in a batch"""
+    offset = 1
+    while offset + BATCH_ENTRY.size <= len(view):
+        (length,) = BATCH_ENTRY.unpack_from(view, offset)
+        offset += BATCH_ENTRY.size
+        yield view[offset:offset + length]
+        offset += length
+
+
+def encode_hello(frame_type, features):
+    """Returns a hello, or the answer to one, offering features"""
+    return HELLO.pack(frame_type, features)
+
+
+def decode_hello(buffer):
+    """Returns the frame type and the chat features offered by a hello or its answer"""
+    return HELLO.unpack_from(buffer)
+
+
+def encode_file_chunk_header(transfer_id, index, checksum):
+    """Returns the header sent in front of a file chunk"""
+    return FILE_CHUNK_HEADER.pack(FILE_CHUNK_FRAME, transfer_id, index, checksum)
+
+
+def decode_file_chunk(view):
+    """Returns the transfer id, chunk index, checksum and chunk of a file chunk, without copying"""
+    _, transfer_id, index, checksum = FILE_CHUNK_HEADER.unpack_from(view)
+    return transfer_id, index, checksum, view[FILE_CHUNK_HEADER_BYTE_COUNT:]
+
+
+def encode_file_ack(transfer_id, missing, received):
+    """Returns an acknowledgement of every chunk before missing and those in the received bitmap"""
+    return FILE_ACK.pack(FILE_ACK_FRAME, transfer_id, missing) + received.to_bytes(
+        FILE_ACK_BITMAP_BYTE_COUNT, "little")
+
+
+def decode_file_ack(view):
+    """Returns the transfer id, first missing chunk and received bitmap of a file acknowledgement"""
+    _, transfer_id, missing = FILE_ACK.unpack_from(view)
+    received = int.from_bytes(
+        view[FILE_ACK.size:FILE_ACK.size + FILE_ACK_BITMAP_BYTE_COUNT], "little")
+    return transfer_id, missing, received
+
+
+def decode_file_transfer_id(view):
+    """Returns the transfer id of a file chunk or acknowledgement"""
+    return FILE_ACK.unpack_from(view)[1]
+
+
+def encode_conn_info(ip_address, port, setup=SETUP_TCP):
+    """Packs an address into the param 2 of ACCEPT_PTP_CONNECTION"""
+    return CONN_INFO.pack(ip_address_to_int(ip_address), port, setup)
+
+
+def decode_conn_info(param):
+    """Returns the ip address and port in the param 2 of ACCEPT_PTP_CONNECTION"""
+    ip_address, port, _ = CONN_INFO.unpack_from(param)
+    return int_to_ip_address(ip_address), port
+
+
+def decode_conn_setup(param):
+    """Returns how to set up the chat with the address in the param 2 of ACCEPT_PTP_CONNECTION"""
+    return CONN_INFO.unpack_from(param)[2]
@@ -0,0 +1,96 @@
+"""
+Compression of chat messages
+
+Messages above a size threshold are deflated before they are sent, and smaller
+ones are sent as they are, since compressing them saves little and costs time.
+Every compressor starts from a preset dictionary of text common in chats and
+logs, so even the first message compresses well.
+
+When the reliability layer delivers every message in order, each direction of
+a chat keeps one deflate stream for the whole chat, so later messages are
+compressed against everything sent before them. Otherwise a lost datagram
+would break the stream, so each message is compressed on its own.
+"""
+import zlib
+from fragment import MAX_MESSAGE_BYTE_COUNT
+
+# Messages shorter than this are not compressed
+COMPRESSION_THRESHOLD = 128
+LEVEL = 6
+# Raw deflate, without the zlib header and checksum, negated as zlib expects
+WINDOW_BITS = -15
+MIN_WINDOW_BITS = 9
+
+# Ends every sync flushed block, so it is left off the wire and added back
+SYNC_TRAILER = b"\x00\x00\xff\xff"
+
+# Deflate prefers the end of the dictionary, so the most common text is last
+PRESET_DICTIONARY = (
+    b"Traceback (most recent call last):\n  File \"\", line , in <module>\n"
+    b"Exception: Error: ValueError: KeyError: TypeError: RuntimeError: "
+    b"https://www. http://localhost:8080/api/v1/ .com/ .org/ .json .txt .log .py "
+    b"GET POST PUT DELETE HTTP/1.1\" 200 404 500 "
+    b"connection timeout failed succeeded started stopped request response "
+    b"user server client message file error warning "
+    b"2024-01-01T00:00:00.000Z 00:00:00 "
+    b"CRITICAL FATAL TRACE DEBUG WARNING WARN ERROR INFO "
+    b"[DEBUG] [WARNING] [ERROR] [INFO] "
+    b"what when where there their about would could should because "
+    b"have that this with from your they will been were what just like "
+    b"the and for you not are but can all "
+)
+
+
+class MessageCompressor:
+    """Compresses the messages one client sends in a chat"""
+    def __init__(self, streaming):
+        """streaming must only be set when the messages arrive in order, exactly once"""
+        self.streaming = streaming
+        self.stream = None
+        if streaming:
+            self.stream = zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS, zdict=PRESET_DICTIONARY)
+
+    def compress(self, data):
+        """Returns the compressed message, or None if it should be sent as it is"""
+        if len(data) < COMPRESSION_THRESHOLD:
+            return None
+
+        if self.streaming:
+            # Flushed so the message can be decompressed without waiting for the next
+            compressed = self.stream.compress(data) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+            # Always used, as the other client's stream must see every compressed message
+            return compressed[:-len(SYNC_TRAILER)]
+
+        # A window no larger than the message and dictionary is far cheaper to set up
+        window_bits = min(
+            max((len(data) + len(PRESET_DICTIONARY)).bit_length(), MIN_WINDOW_BITS), -WINDOW_BITS)
+        compressor = zlib.compressobj(
+            LEVEL, zlib.DEFLATED, -window_bits, zdict=PRESET_DICTIONARY)
+        compressed = compressor.compress(data) + compressor.flush()
+        return compressed if len(compressed) < len(data) else None
+
+
+class MessageDecompressor:
+    """Decompresses the messages one client receives in a chat"""
+    def __init__(self, streaming):
+        self.streaming = streaming
+        self.stream = None
+        if streaming:
+            self.stream = zlib.decompressobj(WINDOW_BITS, zdict=PRESET_DICTIONARY)
+
+    def decompress(self, data):
+        """Returns the original message, raising ValueError if it is larger than any message"""
+        if self.streaming:
+            decompressor = self.stream
+            data = bytes(data) + SYNC_TRAILER
+        else:
+            decompressor = zlib.decompressobj(WINDOW_BITS, zdict=PRESET_DICTIONARY)
+
+        # Bounded, so a small message cannot expand into an enormous one
+        try:
+            message = decompressor.decompress(data, MAX_MESSAGE_BYTE_COUNT)
+        except zlib.error as error:
+            raise ValueError(f"A compressed message is corrupt: {error}") from error
+        if decompressor.unconsumed_tail:
+            raise ValueError("A compressed message expands past the message size limit")
+        return message
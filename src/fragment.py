@@ -0,0 +1,122 @@
+"""
+Fragmentation of chat frames too large for a single datagram
+
+Large frames are split into numbered fragments that each fit the path MTU, so
+IP never has to fragment them. The receiver holds the fragments of a message
+until they have all arrived, within a fixed memory budget and for a limited
+time, so incomplete messages cannot pile up.
+"""
+import collections
+import time
+from codec import (
+    FRAGMENT_HEADER_BYTE_COUNT,
+    SEGMENT_HEADER_BYTE_COUNT,
+    decode_fragment,
+    encode_fragment,
+)
+
+# Below the 1280 byte minimum IPv6 MTU once the IP and UDP headers are added
+MAX_DATAGRAM_BYTE_COUNT = 1200
+# Leaves room for the reliability layer's header in every datagram
+MAX_FRAME_BYTE_COUNT = MAX_DATAGRAM_BYTE_COUNT - SEGMENT_HEADER_BYTE_COUNT
+FRAGMENT_DATA_BYTE_COUNT = MAX_FRAME_BYTE_COUNT - FRAGMENT_HEADER_BYTE_COUNT
+
+MAX_MESSAGE_BYTE_COUNT = 8 * 1024 * 1024
+MESSAGE_ID_MASK = 0xFFFFFFFF
+
+# Bytes of incomplete messages held before the oldest is dropped
+REASSEMBLY_BUDGET = 32 * 1024 * 1024
+# Seconds an incomplete message waits for its missing fragments
+REASSEMBLY_TIMEOUT = 30
+
+
+def fragment(frame, message_id):
+    """Returns the datagrams to send a frame as, which is just the frame if it fits in one"""
+    if len(frame) <= MAX_FRAME_BYTE_COUNT:
+        return [frame]
+
+    if len(frame) > MAX_MESSAGE_BYTE_COUNT:
+        raise ValueError(f"Messages are limited to {MAX_MESSAGE_BYTE_COUNT} bytes")
+
+    view = memoryview(frame)
+    count = -(-len(frame) // FRAGMENT_DATA_BYTE_COUNT)
+    message_id &= MESSAGE_ID_MASK
+    return [
+        encode_fragment(
+            message_id, index, count,
+            view[index * FRAGMENT_DATA_BYTE_COUNT:(index + 1) * FRAGMENT_DATA_BYTE_COUNT])
+        for index in range(count)
+    ]
+
+
+class Partial:
+    """The fragments of one message received so far"""
+    __slots__ = ("fragments", "missing", "size", "expires")
+
+    def __init__(self, count, expires):
+        self.fragments = [None] * count
+        self.missing = count
+        self.size = 0
+        self.expires = expires
+
+
+class Reassembler:
+    """Rebuilds frames from the fragments sent by one peer"""
+    def __init__(self, budget=REASSEMBLY_BUDGET, timeout=REASSEMBLY_TIMEOUT):
+        self.budget = budget
+        self.timeout = timeout
+
+        # Message id to Partial, oldest first
+        self.partials = collections.OrderedDict()
+        self.held = 0
+
+        self.expired = 0
+        self.evicted = 0
+
+    def add(self, view):
+        """Adds a fragment, returning the whole frame once its last fragment arrives"""
+        message_id, index, count, data = decode_fragment(view)
+        now = time.monotonic()
+        self.expire(now)
+
+        if index >= count or count * FRAGMENT_DATA_BYTE_COUNT > MAX_MESSAGE_BYTE_COUNT:
+            return None
+
+        partial = self.partials.get(message_id)
+        if partial is None:
+            partial = Partial(count, now + self.timeout)
+            self.partials[message_id] = partial
+        elif len(partial.fragments) != count:
+            return None
+
+        # A duplicate
+        if partial.fragments[index] is not None:
+            return None
+
+        partial.fragments[index] = bytes(data)
+        partial.missing -= 1
+        partial.size += len(data)
+        self.held += len(data)
+
+        if partial.missing == 0:
+            del self.partials[message_id]
+            self.held -= partial.size
+            return b"".join(partial.fragments)
+
+        while self.held > self.budget:
+            _, oldest = self.partials.popitem(last=False)
+            self.held -= oldest.size
+            self.evicted += 1
+
+        return None
+
+    def expire(self, now):
+        """Drops incomplete messages that have waited too long"""
+        # Every message waits as long, so the oldest always expires first
+        while self.partials:
+            message_id, oldest = next(iter(self.partials.items()))
+            if oldest.expires > now:
+                break
+            del self.partials[message_id]
+            self.held -= oldest.size
+            self.expired += 1
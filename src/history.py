@@ -0,0 +1,186 @@
+"""
+Chat history kept in bounded memory
+
+The latest messages of a chat are held in a ring buffer. Every message is also
+appended to an archive file, alongside an index of where each one starts, so
+older pages are read back from a memory map of the archive only when they are
+asked for. The archive outlives the client, so a chat picks up its history the
+next time the same users chat.
+"""
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Messages kept in memory for each chat
+RECENT_MESSAGES = 200
+# Messages shown at once when paging through a chat
+PAGE_SIZE = 20
+
+# The time the message was sent or received, in seconds since the epoch, the
+# length of the text and 1 if we sent it or 0 if the other user did
+RECORD_HEADER = struct.Struct("<dIB")
+# Where each record starts in the archive
+OFFSET = struct.Struct("<Q")
+
+ARCHIVE_SUFFIX = ".messages"
+INDEX_SUFFIX = ".index"
+
+
+def format_time(timestamp):
+    return time.strftime("%H:%M:%S", time.localtime(timestamp))
+
+
+class History:
+    """The messages of one chat, numbered from 1"""
+    def __init__(self, path=None, capacity=RECENT_MESSAGES):
+        """
+        path is where to keep the archive, without a suffix
+        Without one, messages older than the last capacity are forgotten
+        """
+        # (content, timestamp, sent) of the latest messages
+        self.recent = collections.deque(maxlen=capacity)
+        self.count = 0
+
+        # Appended to by the reactor thread and paged through by the main thread
+        self.lock = threading.Lock()
+
+        self.archive = None
+        self.index = None
+        self.archive_map = None
+        self.index_map = None
+        if path is not None:
+            self.open(path)
+
+    def __len__(self):
+        return self.count
+
+    def open(self, path):
+        """Opens the archive, dropping a record torn by a crash while it was written"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.archive = open(path + ARCHIVE_SUFFIX, "a+b")
+        self.index = open(path + INDEX_SUFFIX, "a+b")
+
+        index_size = os.fstat(self.index.fileno()).st_size
+        self.count = index_size // OFFSET.size
+        archive_size = os.fstat(self.archive.fileno()).st_size
+
+        # Drop index entries whose record never fully made it into the archive
+        while self.count:
+            self.index.seek((self.count - 1) * OFFSET.size)
+            (offset,) = OFFSET.unpack(self.index.read(OFFSET.size))
+            if offset + RECORD_HEADER.size <= archive_size:
+                self.archive.seek(offset)
+                _, length, _ = RECORD_HEADER.unpack(self.archive.read(RECORD_HEADER.size))
+                end = offset + RECORD_HEADER.size + length
+                if end <= archive_size:
+                    break
+            self.count -= 1
+        else:
+            end = 0
+
+        self.index.truncate(self.count * OFFSET.size)
+        self.archive.truncate(end)
+
+        # Start with the latest messages in memory
+        for number in range(max(self.count - self.recent.maxlen, 0), self.count):
+            self.recent.append(self.read_archived(number))
+
+    def append(self, content, timestamp=None, sent=False):
+        """Adds a message, returning its number, where sent is whether we sent it"""
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            if self.archive is not None:
+                data = content.encode("utf-8")
+                offset = self.archive.seek(0, os.SEEK_END)
+                self.archive.write(RECORD_HEADER.pack(timestamp, len(data), sent) + data)
+                self.archive.flush()
+                # The index is written last, so it never points past the archive
+                self.index.write(OFFSET.pack(offset))
+                self.index.flush()
+
+            self.recent.append((content, timestamp, sent))
+            self.count += 1
+            return self.count
+
+    def get(self, number):
+        """Returns (content, timestamp, sent) of message number, or None if it is forgotten"""
+        first_recent = self.count - len(self.recent) + 1
+        if number >= first_recent:
+            return self.recent[number - first_recent]
+        if self.archive is not None and number >= 1:
+            return self.read_archived(number - 1)
+        return None
+
+    def message(self, number):
+        """Returns (content, timestamp, sent) of message number, or None if it is forgotten"""
+        with self.lock:
+            return self.get(number)
+
+    def page(self, end, count=PAGE_SIZE):
+        """Returns (number, content, time, sent) for up to count messages before message end"""
+        with self.lock:
+            end = min(end, self.count + 1)
+            messages = []
+            for number in range(max(end - count, 1), end):
+                message = self.get(number)
+                # Forgotten, as there is no archive
+                if message is None:
+                    continue
+                content, timestamp, sent = message
+                messages.append((number, content, format_time(timestamp), sent))
+            return messages
+
+    def iter_contents(self):
+        """Yields the number and content of every message that is not forgotten"""
+        with self.lock:
+            count = self.count
+        for number in range(self.first_available(), count + 1):
+            with self.lock:
+                message = self.get(number)
+            yield number, message[0]
+
+    def latest(self, count=PAGE_SIZE):
+        return self.page(self.count + 1, count)
+
+    def first_available(self):
+        """Returns the number of the oldest message that can still be shown"""
+        if self.archive is not None or not self.count:
+            return 1
+        return self.count - len(self.recent) + 1
+
+    def remap(self):
+        """Maps the archive and index again once they have grown past the current maps"""
+        for name, file in (("archive_map", self.archive), ("index_map", self.index)):
+            current = getattr(self, name)
+            size = os.fstat(file.fileno()).st_size
+            if current is None or len(current) < size:
+                if current is not None:
+                    current.close()
+                setattr(self, name, mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ))
+
+    def read_archived(self, index):
+        """Returns the content, timestamp and sent flag of the message at index, counting from 0"""
+        position = (index + 1) * OFFSET.size
+        if self.index_map is None or len(self.index_map) < position:
+            self.remap()
+
+        (offset,) = OFFSET.unpack_from(self.index_map, index * OFFSET.size)
+        if len(self.archive_map) < offset + RECORD_HEADER.size:
+            self.remap()
+        timestamp, length, sent = RECORD_HEADER.unpack_from(self.archive_map, offset)
+        start = offset + RECORD_HEADER.size
+        if len(self.archive_map) < start + length:
+            self.remap()
+        return str(self.archive_map[start:start + length], "utf-8"), timestamp, bool(sent)
+
+    def close(self):
+        with self.lock:
+            for resource in (self.archive_map, self.index_map, self.archive, self.index):
+                if resource is not None:
+                    resource.close()
+            self.archive_map = self.index_map = self.archive = self.index = None
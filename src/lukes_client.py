@@ -1,28 +1,46 @@
 import argparse
 import socket
-from enum import Enum
 import logging
-import struct
 import random
-from server import Message
+import struct
+from codec import (
+    FILE_ACK,
+    FILE_ACK_FRAME,
+    FILE_CHUNK_FRAME,
+    FILE_CHUNK_HEADER_BYTE_COUNT,
+    FILE_FRAME,
+    FILE_INFO,
+    FRAGMENT_FRAME,
+    FRAGMENT_HEADER_BYTE_COUNT,
+    MESSAGE_FRAME,
+    TRANSFER_HEADER_BYTE_COUNT,
+    Message,
+    decode_conn_info,
+    decode_data_transfer,
+    decode_file_transfer_id,
+    decode_transfer_header,
+    encode_command,
+    encode_conn_info,
+    encode_data_transfer,
+)
+from fragment import Reassembler, fragment
+from transfer import (
+    MAX_FILE_DATAGRAM_BYTE_COUNT,
+    FileReceiver,
+    FileSender,
+    configure_socket,
+    describe_throughput,
+)
 from threading import Thread
 import threading
 import time
+import os
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-
-def pad_bytes(bytes, length):
-    return bytes + b"\x00" * (length - len(bytes))
-
-
-def ip_address_to_int(ip_address):
-    return struct.unpack("!L", socket.inet_aton(ip_address))[0]
-
-
-def int_to_ip_address(integer):
-    return socket.inet_ntoa(struct.pack("!L", integer))
+# received files are saved here
+DOWNLOAD_DIRECTORY = "downloads"
 
 
 class Connection:
@@ -33,31 +51,163 @@ class Connection:
         self.send_address = address
         self.sock_lock = threading.Lock()
         self.active = True
+        # large messages are sent in fragments tagged with their message's id
+        self.message_id = 0
+        self.reassembler = Reassembler()
+        # every datagram is received into the same buffer
+        self.buffer = bytearray(MAX_FILE_DATAGRAM_BYTE_COUNT)
+        # file transfers in each direction by transfer id
+        self.sending = {}
+        self.receiving = {}
+        # finished downloads, kept to answer chunks resent after the last ack was lost
+        self.received = {}
+        # the thread reading the socket, which close waits for
+        self.reader = None
+        configure_socket(sock)
 
     def run(self):
         log.debug(f"New thread connected to {self.username}")
+        self.reader = threading.current_thread()
 
         time.sleep(1)
         while self.active:
             self.recieve_message()
 
     def send_message(self, message):
-        encoded = message.encode("utf=8")
-        self.sock.sendto(
-            b"\x00" + b"\x00" + len(encoded).to_bytes(4, "little") + encoded,
-            self.send_address,
-        )
+        frame = encode_data_transfer(True, b"", message.encode("utf-8"))
+        for datagram in fragment(frame, self.message_id):
+            self.sock.sendto(datagram, self.send_address)
+        self.message_id += 1
 
     def send_file(self, recipient, filename):
-        pass
+        sender = FileSender(self.sock, self.send_address, filename)
+        self.sending[sender.transfer_id] = sender
+        try:
+            seconds = sender.run()
+        except (OSError, TimeoutError) as e:
+            print(f"Could not send {filename} to {recipient}: {e}")
+            return
+        finally:
+            del self.sending[sender.transfer_id]
+
+        if seconds is None:
+            print(f"Sending {filename} to {recipient} was cancelled")
+            return
+        print(
+            f"Sent {filename} to {recipient}: {describe_throughput(sender.bytes_sent, seconds)}, "
+            f"{sender.retransmits} of {sender.chunks_sent} chunks resent"
+        )
+
+    # a file offered by the peer, which is accepted into the download directory
+    def recieve_offer(self, msg):
+        _, identifier, data = decode_data_transfer(msg)
+        transfer_id = FILE_INFO.unpack_from(data)[0]
+        if transfer_id in self.received:
+            self.received[transfer_id].acknowledge()
+            return
+        receiver = self.receiving.get(transfer_id)
+        if receiver is None:
+            receiver = FileReceiver(
+                self.sock, self.send_address, DOWNLOAD_DIRECTORY, str(identifier, "utf-8"), data
+            )
+            self.receiving[transfer_id] = receiver
+            resumed = f", resuming with {receiver.resumed} chunks" if receiver.resumed else ""
+            print(f"Receiving {receiver.name} from {self.username}{resumed}")
+
+        if receiver.done:
+            self.finish_file(receiver)
+        else:
+            receiver.acknowledge()
+
+    def recieve_chunk(self, msg):
+        transfer_id = decode_file_transfer_id(msg)
+        receiver = self.receiving.get(transfer_id)
+        if receiver is None:
+            # a finished download only answers the sender again
+            receiver = self.received.get(transfer_id)
+            if receiver is not None:
+                receiver.receive_chunk(msg)
+            return
+        # the last chunk finishes the download inside receive_chunk
+        receiver.receive_chunk(msg)
+        if receiver.done:
+            self.finish_file(receiver)
+
+    # reports a download once, when it leaves self.receiving
+    def finish_file(self, receiver):
+        receiver.finish()
+        self.received[receiver.transfer_id] = self.receiving.pop(receiver.transfer_id)
+        print(
+            f"Received {receiver.path} from {self.username}: "
+            f"{describe_throughput(receiver.bytes_received, receiver.seconds)}"
+        )
 
     # Calls recieve method, decodes, and prints to terminal
     def recieve_message(self):
-        msg, addr = self.sock.recvfrom(2048)
-        length = int.from_bytes(msg[2:6], "little")
-        message = msg[6:].decode()
+        length, addr = self.sock.recvfrom_into(self.buffer)
+        # datagrams come straight from the peer, so a malformed one is dropped
+        # rather than ending the thread reading the socket
+        try:
+            self.handle_datagram(memoryview(self.buffer)[:length])
+        except (ValueError, struct.error) as e:
+            log.debug(f"Dropped a datagram from {self.username}: {e}")
+
+    def handle_datagram(self, msg):
+        if not msg:
+            return
+
+        if msg[0] == FILE_CHUNK_FRAME:
+            if len(msg) >= FILE_CHUNK_HEADER_BYTE_COUNT:
+                self.recieve_chunk(msg)
+            return
+        if msg[0] == FILE_ACK_FRAME:
+            if len(msg) < FILE_ACK.size:
+                return
+            sender = self.sending.get(decode_file_transfer_id(msg))
+            if sender is not None:
+                sender.receive_ack(msg)
+            return
+        if msg[0] == FILE_FRAME:
+            if is_whole_transfer(msg):
+                self.recieve_offer(msg)
+            return
+
+        if msg[0] == FRAGMENT_FRAME:
+            if len(msg) < FRAGMENT_HEADER_BYTE_COUNT:
+                return
+            msg = self.reassembler.add(msg)
+            # wait for the rest of the message
+            if msg is None:
+                return
+        if not is_whole_transfer(msg) or msg[0] != MESSAGE_FRAME:
+            return
+        _, _, data = decode_data_transfer(memoryview(msg))
+        message = str(data, "utf-8")
         print(f"Message from {self.username}: {message}")
 
+    # stops any file transfers, keeping partial downloads so they can resume
+    def close(self):
+        self.active = False
+        for sender in list(self.sending.values()):
+            sender.cancel()
+        # the reader may be writing a chunk, so it has stopped before the downloads are closed
+        if self.reader is not None and self.reader is not threading.current_thread():
+            while self.reader.is_alive():
+                # an empty datagram wakes the reader, and is sent again in case it is dropped
+                self.sock.sendto(b"", self.sock.getsockname())
+                self.reader.join(0.1)
+        for receiver in self.receiving.values():
+            receiver.close()
+        self.sock.close()
+
+
+# whether a data transfer is as long as its header says
+def is_whole_transfer(msg):
+    if len(msg) < TRANSFER_HEADER_BYTE_COUNT:
+        return False
+    _, identifier_length, data_length = decode_transfer_header(msg)
+    return TRANSFER_HEADER_BYTE_COUNT + identifier_length + data_length <= len(msg)
+
 
 class Client:
     def __init__(self, sock):
@@ -83,6 +233,7 @@ class Client:
                     # User list from server
                     elif bit_0 == 0:
                         header = self.sock.recv(5)
+                        self.sock.recv(header[0])
                         length = int.from_bytes(header[1:], "little")
                         print(f"User list: {self.sock.recv(length).decode()}.")
             except:
@@ -125,15 +276,27 @@ class Client:
             )
         else:
             print("Could not interperet input.")
-            self.process_login(self)
+            self.process_login()
 
     def control_flow(self):
         print(
-            "Choose an action: Request a (C)onnection, (L)ist online users, (M)essage user, (D)isconnect from user, (R)efresh, (S)ign out"
+            "Choose an action: Request a (C)onnection, (L)ist online users, (M)essage user, send a (F)ile, (D)isconnect from user, (R)efresh, (S)ign out"
         )
         choice = input().upper()
         if choice == "C":
             username = input("Enter username: ")
+            # check the user is online before requesting
+            result = self.query_users(username)
+            # refused by the server, which has already been reported
+            if result is None:
+                return
+            users, total = result
+            if username not in users:
+                if total == 0:
+                    print("No online user has that username.")
+                else:
+                    print(f"No exact match. Did you mean: {', '.join(users)}?")
+                return
             self.send_command(
                 Message.REQUEST_PTP_CONNECTION.value, username.encode("utf-8")
             )
@@ -153,6 +316,19 @@ class Client:
                     print("Message sent")
                     return
             print("You do not have an active connection with this user.")
+        elif choice == "F":
+            username = input("Enter username: ")
+            connection = self.get_connection(username)
+            if connection is None:
+                print("You do not have an active connection with this user.")
+                return
+            filename = input("Enter the path of the file: ")
+            if not os.path.isfile(filename):
+                print("There is no file at that path.")
+                return
+            # large files take a while, so send in the background
+            Thread(target=connection.send_file, args=(username, filename)).start()
+            print("Sending file. You will be notified when it has been received.")
         elif choice == "R":
             print("Refreshing...")
         elif choice == "S":
@@ -168,8 +344,7 @@ class Client:
             username = input("Enter username: ")
             for connection in self.connections:
                 if connection.username.rstrip("\0") == username:
-                    connection.active = False
-                    connection.sock.close()
+                    connection.close()
                     self.connections.remove(connection)
                     print("Disconnected")
 
@@ -201,6 +376,13 @@ class Client:
             print("This user is already logged in.")
             self.process_login()
 
+        # the first byte of param 1 is the command the server refused as sent too often
+        elif command_type == Message.RATE_LIMITED.value:
+            print("The server is limiting how often you can do that, please try again shortly.")
+            if param_1[0] in (Message.SIGN_UP.value, Message.SIGN_IN.value):
+                time.sleep(1)
+                self.process_login()
+
         elif command_type == Message.RELAY_PTP_REQUEST.value:
             print(
                 f"The user {param_1.decode()} has requested a peer to peer connection."
@@ -209,20 +391,18 @@ class Client:
                 input("Would you like to accept this connection? (Y)es/(N)o: ").upper()
                 == "Y"
             ):
-                ip = ip_address_to_int(self.ip_address)
                 port = 10000 + random.randint(0, 10000)
-                log.debug(f"Port: {port}, ip: {ip}")
+                log.debug(f"Port: {port}, ip: {self.ip_address}")
 
                 # create new socket and bind to new port
                 new_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
                 new_sock.bind((self.ip_address, port))
 
-                log.debug(ip.to_bytes(4, "little") + port.to_bytes(2, "little"))
                 # notify requesting client
                 self.send_command(
                     Message.ACCEPT_PTP_CONNECTION.value,
                     param_1,
-                    ip.to_bytes(4, "little") + port.to_bytes(2, "little"),
+                    encode_conn_info(self.ip_address, port),
                 )
                 # Create a connection instance and pass a reference to
                 # the current state.
@@ -251,8 +431,7 @@ class Client:
         elif command_type == Message.ACCEPT_PTP_CONNECTION.value:
             username = param_1.decode("utf-8")
             print("The user {username} has accepted your connection request.")
-            ip_address = int_to_ip_address(int.from_bytes(param_2[:4], "little"))
-            port = int.from_bytes(param_2[4:6], "little")
+            ip_address, port = decode_conn_info(param_2)
             # create new socket for ptp connection
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             sock.bind((ip_address, port + 1))
@@ -268,14 +447,33 @@ class Client:
             except:
                 log.debug("Connection failed")
 
-    # pads params 1 and 2 with 0s by default, otherwise assumes values if inputed are padded
-    def send_command(self, command_num, param_1=b"\x00" * 8, param_2=b"\x00" * 8):
-        self.sock.sendall(
-            b"\x01"
-            + command_num.to_bytes(1, "little")
-            + pad_bytes(param_1, 8)
-            + pad_bytes(param_2, 8)
+    # looks up a page of online usernames starting with prefix
+    # returns the page and the total number of matches, or None if the server refused
+    def query_users(self, prefix, offset=0, limit=10):
+        self.send_command(
+            Message.QUERY_USER_LIST.value,
+            prefix.encode("utf-8"),
+            offset.to_bytes(4, "little") + limit.to_bytes(4, "little"),
         )
+        # commands may be relayed to us before the reply arrives
+        while True:
+            bit_0 = self.sock.recv(1)[0]
+            if bit_0 == 1:
+                command_bytes = self.sock.recv(17)
+                self.process_command(command_bytes)
+                if (command_bytes[0] == Message.RATE_LIMITED.value
+                        and command_bytes[1] == Message.QUERY_USER_LIST.value):
+                    return None
+            else:
+                header = self.sock.recv(5)
+                total = int.from_bytes(self.sock.recv(header[0]), "little")
+                length = int.from_bytes(header[1:], "little")
+                users = self.sock.recv(length).decode() if length else ""
+                return (users.split(", ") if users else []), total
+
+    # pads params 1 and 2 with 0s by default
+    def send_command(self, command_num, param_1=b"", param_2=b""):
+        self.sock.sendall(encode_command(command_num, param_1, param_2))
 
     def get_connection(self, recipient):
         with self._connections_lock:
@@ -308,15 +506,19 @@ def main():
 
     args = parser.parse_args()
 
-    port = None
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        sock.connect((args.ip_address, args.port))
-        print("Connected to the server!")
-        port = int.from_bytes(sock.recv(2), "little")
-        print(f"Port: {port}")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((args.ip_address, args.port))
+    print("Connected to the server!")
+    port = int.from_bytes(sock.recv(2), "little")
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    # A port of 0 means the server keeps us on this connection
+    if port != 0:
+        print(f"Port: {port}")
+        sock.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((args.ip_address, port))
+
+    with sock:
         client = Client(sock)
         client.run()
 
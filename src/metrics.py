@@ -0,0 +1,163 @@
+"""
+Counters, gauges and latency histograms for the server, rendered in the
+Prometheus text format and served over a tiny HTTP listener
+"""
+import asyncio
+import bisect
+import logging
+
+log = logging.getLogger("server")
+
+# Upper bounds in seconds of the command latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+)
+
+
+class Histogram:
+    """Counts observations into fixed buckets"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for observations above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class Metrics:
+    """The metrics of a single server process"""
+    def __init__(self):
+        # Per message type name
+        self.commands = {}
+        self.latencies = {}
+        # Per reason, such as USER_NOT_AVAILABLE
+        self.relay_failures = {}
+        # Per message type name
+        self.limited = {}
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        # Name to (type, help, callable) for values read when scraped
+        self.collected = {}
+
+    def gauge(self, name, help, function):
+        """Registers a value that is read every time the metrics are rendered"""
+        self.collected[name] = ("gauge", help, function)
+
+    def counter(self, name, help, function):
+        """Registers a total kept elsewhere that is read every time the metrics are rendered"""
+        self.collected[name] = ("counter", help, function)
+
+    def observe_command(self, message, duration):
+        """Records a processed command and how long it took"""
+        self.commands[message] = self.commands.get(message, 0) + 1
+        if message not in self.latencies:
+            self.latencies[message] = Histogram()
+        self.latencies[message].observe(duration)
+
+    def relay_failed(self, reason):
+        self.relay_failures[reason] = self.relay_failures.get(reason, 0) + 1
+
+    def rate_limited(self, message):
+        self.limited[message] = self.limited.get(message, 0) + 1
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        lines = [
+            "# HELP server_commands_total Commands processed, by message type",
+            "# TYPE server_commands_total counter",
+        ]
+        for message, count in sorted(self.commands.items()):
+            lines.append(f'server_commands_total{{message="{message}"}} {count}')
+
+        lines += [
+            "# HELP server_command_duration_seconds Time spent processing commands, by message type",
+            "# TYPE server_command_duration_seconds histogram",
+        ]
+        for message, histogram in sorted(self.latencies.items()):
+            lines.extend(histogram.render("server_command_duration_seconds", f'message="{message}"'))
+
+        lines += [
+            "# HELP server_relay_failures_total Commands that could not be relayed, by reply",
+            "# TYPE server_relay_failures_total counter",
+        ]
+        for reason, count in sorted(self.relay_failures.items()):
+            lines.append(f'server_relay_failures_total{{reason="{reason}"}} {count}')
+
+        lines += [
+            "# HELP server_rate_limited_total Commands refused as over a user's limits, by message type",
+            "# TYPE server_rate_limited_total counter",
+        ]
+        for message, count in sorted(self.limited.items()):
+            lines.append(f'server_rate_limited_total{{message="{message}"}} {count}')
+
+        lines += [
+            "# HELP server_received_bytes_total Bytes received from clients",
+            "# TYPE server_received_bytes_total counter",
+            f"server_received_bytes_total {self.bytes_in}",
+            "# HELP server_sent_bytes_total Bytes sent to clients",
+            "# TYPE server_sent_bytes_total counter",
+            f"server_sent_bytes_total {self.bytes_out}",
+        ]
+
+        for name, (type, help, function) in self.collected.items():
+            lines += [
+                f"# HELP {name} {help}",
+                f"# TYPE {name} {type}",
+                f"{name} {function()}",
+            ]
+
+        return "\n".join(lines) + "\n"
+
+    async def handle_request(self, reader, writer):
+        """Answers a single HTTP request for the metrics"""
+        try:
+            request_line = await reader.readline()
+            # The headers are not needed, but must be read up to the blank line
+            while (await reader.readline()).strip():
+                pass
+        except (ConnectionError, ValueError):
+            writer.close()
+            return
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1] in ("/", "/metrics"):
+            status = "200 OK"
+            body = self.render().encode()
+        else:
+            status = "404 Not Found"
+            body = b"Not found\n"
+
+        header = (
+            f"HTTP/1.0 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        )
+        writer.write(header.encode() + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def start(self, host, port):
+        """Starts the stats listener, returning the asyncio server"""
+        server = await asyncio.start_server(self.handle_request, host, port)
+        log.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
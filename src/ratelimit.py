@@ -0,0 +1,113 @@
+"""
+Token buckets limiting how often each user may send commands
+
+A bucket holds up to burst tokens and gains rate tokens a second, and a command
+is only processed if it can take one. Every user has a bucket for all of their
+commands together and one for each message type with a limit of its own. Buckets
+are only refilled when used, from the time since they were last used, so users
+that send nothing cost nothing.
+"""
+import argparse
+import time
+from codec import Message
+
+# The name limiting every command of a user together
+ALL = "ALL"
+
+# Message name to commands a second and the most that can be sent in a burst
+DEFAULT_LIMITS = {
+    ALL: (50, 100),
+    "SIGN_UP": (1, 5),
+    "SIGN_IN": (1, 5),
+    # Each of these joins every visible username
+    "REQUEST_USER_LIST": (1, 5),
+    "SUBSCRIBE_PRESENCE": (1, 5),
+    # Paging through the matches may take a few in a row
+    "QUERY_USER_LIST": (5, 20),
+    # Each of these is sent on to another user
+    "REQUEST_PTP_CONNECTION": (2, 10),
+    "ACCEPT_PTP_RELAY": (2, 10),
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        # Starts full, so a new user can send a burst straight away
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Returns whether a token was taken, after adding those gained since the last call"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimits:
+    """The limits every user is held to"""
+    def __init__(self, limits=DEFAULT_LIMITS):
+        """limits maps ALL or a Message name to a rate and burst, where a rate of 0 means no limit"""
+        self.overall = limits.get(ALL)
+        if self.overall is not None and self.overall[0] == 0:
+            self.overall = None
+        # Message value to rate and burst
+        self.per_type = {
+            Message[name].value: limit for name, limit in limits.items()
+            if name != ALL and limit[0] != 0
+        }
+
+    def limiter(self):
+        """Returns the buckets of a new user"""
+        return Limiter(self)
+
+
+class Limiter:
+    """The buckets of one user, each made when first needed"""
+    __slots__ = ("limits", "overall", "buckets")
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.overall = None
+        self.buckets = {}
+
+    def allow(self, command_type):
+        """Returns whether the user may send a command of the given type now"""
+        now = time.monotonic()
+
+        limit = self.limits.per_type.get(command_type)
+        if limit is not None:
+            bucket = self.buckets.get(command_type)
+            if bucket is None:
+                bucket = self.buckets[command_type] = TokenBucket(*limit, now)
+            if not bucket.take(now):
+                return False
+
+        if self.limits.overall is None:
+            return True
+        if self.overall is None:
+            self.overall = TokenBucket(*self.limits.overall, now)
+        return self.overall.take(now)
+
+
+def parse_limit(text):
+    """Parses NAME=RATE/BURST, as given on the command line, into a name and a limit"""
+    try:
+        name, limit = text.split("=")
+        rate, burst = limit.split("/")
+        rate, burst = float(rate), float(burst)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected NAME=RATE/BURST, not '{text}'")
+
+    name = name.upper()
+    if name != ALL and name not in Message.__members__:
+        raise argparse.ArgumentTypeError(f"'{name}' is not {ALL} or a message name")
+    if rate < 0 or burst < 1:
+        raise argparse.ArgumentTypeError("the rate cannot be negative and the burst must be at least 1")
+    return name, (rate, burst)
@@ -0,0 +1,145 @@
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+
+log = logging.getLogger("reactor")
+
+
+class Timer:
+    """A callback scheduled on the reactor thread, which can be cancelled from any thread"""
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Reactor:
+    """Waits on many sockets in a single thread and calls back when one is readable"""
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+
+        # Registrations are handed to the reactor thread, which owns the selector
+        self.lock = threading.Lock()
+        self.changes = []
+        # (deadline, tie breaker, timer), soonest first
+        self.timers = []
+        self.timer_order = itertools.count()
+
+        # Writing to this wakes the reactor thread from select
+        self.waker, self.wakee = socket.socketpair()
+        self.wakee.setblocking(False)
+        self.selector.register(self.wakee, selectors.EVENT_READ)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker.send(b"\x00")
+        except OSError:
+            pass
+
+    def register(self, sock, callback):
+        """Calls callback with no arguments on the reactor thread whenever sock is readable"""
+        with self.lock:
+            self.changes.append((sock, callback))
+        self.wake()
+
+    def call_later(self, delay, callback):
+        """Calls callback with no arguments on the reactor thread after delay seconds"""
+        timer = Timer(time.monotonic() + delay, callback)
+        with self.lock:
+            heapq.heappush(self.timers, (timer.deadline, next(self.timer_order), timer))
+            soonest = self.timers[0][2] is timer
+        # Only a new earliest deadline shortens the current wait
+        if soonest:
+            self.wake()
+        return timer
+
+    def run_timers(self):
+        """Runs every timer that is due, returning how long until the next one or None"""
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+            timeout = max(self.timers[0][0] - now, 0) if self.timers else None
+
+        for timer in due:
+            if not timer.cancelled:
+                try:
+                    timer.callback()
+                except Exception:
+                    log.exception("A timer failed")
+        return 0 if due else timeout
+
+    def unregister(self, sock):
+        with self.lock:
+            self.changes.append((sock, None))
+        self.wake()
+
+    def apply_changes(self):
+        with self.lock:
+            changes, self.changes = self.changes, []
+
+        for sock, callback in changes:
+            if callback is not None:
+                try:
+                    self.selector.register(sock, selectors.EVENT_READ, callback)
+                except (OSError, ValueError):
+                    # Closed before the reactor got to it
+                    pass
+                continue
+
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                # Never registered, or already closed
+                pass
+
+    def run(self):
+        """Sleeps until a socket is readable, so an idle client uses no CPU"""
+        try:
+            while self.running:
+                for key, _ in self.selector.select(self.run_timers()):
+                    if key.fileobj is self.wakee:
+                        try:
+                            while self.wakee.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        continue
+
+                    try:
+                        key.data()
+                    except OSError:
+                        # The socket was closed under us
+                        self.selector.unregister(key.fileobj)
+                    except ValueError:
+                        # A malformed datagram is dropped rather than stopping every chat
+                        pass
+                    except Exception:
+                        # Nothing one peer sends may stop the chats of every other
+                        log.exception("A socket callback failed")
+
+                self.apply_changes()
+        finally:
+            self.selector.close()
+            self.waker.close()
+            self.wakee.close()
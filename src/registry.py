@@ -0,0 +1,137 @@
+import bisect
+import threading
+from codec import Presence
+
+
+class Registry:
+    """Indexes the connected users of a server by username"""
+    def __init__(self, on_presence=None):
+        """on_presence is called with the subscribers, a username and a Presence"""
+        self.lock = threading.Lock()
+        self.on_presence = on_presence
+        # Every open connection, signed in or not
+        self._connections = set()
+        # Username to user for signed in users
+        self._online = {}
+        # Usernames of visible signed in users, a dict keeps them in sign in order
+        self._visible = {}
+        # The same usernames kept sorted for prefix queries
+        self._sorted = []
+        # Users that are pushed presence changes
+        self._subscribers = set()
+
+    def __len__(self):
+        with self.lock:
+            return len(self._connections)
+
+    def online_count(self):
+        with self.lock:
+            return len(self._online)
+
+    def add(self, user):
+        """Tracks a new connection"""
+        with self.lock:
+            self._connections.add(user)
+
+    def remove(self, user):
+        """Forgets a connection, signing it out first"""
+        with self.lock:
+            self._connections.discard(user)
+            self._subscribers.discard(user)
+            event = self._sign_out(user)
+        self._publish(user.username, event)
+
+    def sign_in(self, user, username, visible=True):
+        """Marks the user online under username, unless someone already is"""
+        with self.lock:
+            if username in self._online:
+                return False
+
+            self._online[username] = user
+            if visible:
+                self._show(username)
+
+        if visible:
+            self._publish(username, Presence.JOIN)
+        return True
+
+    def sign_out(self, user):
+        with self.lock:
+            event = self._sign_out(user)
+        self._publish(user.username, event)
+
+    def _sign_out(self, user):
+        """Returns the presence change to publish, if any"""
+        # Only the user that owns the name may release it
+        if self._online.get(user.username) is not user:
+            return None
+
+        del self._online[user.username]
+        if user.username in self._visible:
+            self._hide(user.username)
+            return Presence.LEAVE
+
+    def set_visible(self, user, visible):
+        with self.lock:
+            if self._online.get(user.username) is not user:
+                return
+            if visible == (user.username in self._visible):
+                return
+
+            if visible:
+                self._show(user.username)
+            else:
+                self._hide(user.username)
+
+        self._publish(user.username, Presence.VISIBLE if visible else Presence.HIDDEN)
+
+    def _show(self, username):
+        self._visible[username] = None
+        bisect.insort(self._sorted, username)
+
+    def _hide(self, username):
+        del self._visible[username]
+        del self._sorted[bisect.bisect_left(self._sorted, username)]
+
+    def subscribe(self, user):
+        """Subscribes the user to presence changes and returns the current snapshot"""
+        with self.lock:
+            self._subscribers.add(user)
+            return list(self._visible)
+
+    def unsubscribe(self, user):
+        with self.lock:
+            self._subscribers.discard(user)
+
+    def _publish(self, username, event):
+        if event is None or self.on_presence is None:
+            return
+
+        with self.lock:
+            subscribers = list(self._subscribers)
+        self.on_presence(subscribers, username, event)
+
+    def is_online(self, username):
+        with self.lock:
+            return username in self._online
+
+    def get(self, username):
+        """Returns the online user with the given username, or None"""
+        with self.lock:
+            return self._online.get(username)
+
+    def visible_usernames(self):
+        with self.lock:
+            return list(self._visible)
+
+    def query(self, prefix, offset, limit):
+        """
+        Returns a page of the visible usernames starting with prefix, in sorted order,
+        along with the total number of matches
+        """
+        with self.lock:
+            # Every match sorts between the prefix and the prefix followed by the largest character
+            start = bisect.bisect_left(self._sorted, prefix)
+            end = bisect.bisect_left(self._sorted, prefix + "\U0010ffff", start)
+            page_start = min(start + offset, end)
+            return self._sorted[page_start:min(page_start + limit, end)], end - start
@@ -0,0 +1,169 @@
+"""
+Relaying of chat datagrams through the server
+
+Two clients that cannot reach each other directly can chat through a relay.
+The server opens a UDP socket for each of them and sends every datagram that
+arrives on one out of the other, to wherever the other client sent from. The
+first datagram a client sends its socket, the hello of the chat setup, tells
+the relay where that client is, and datagrams from anywhere else are dropped.
+
+Every relay is served by the server's event loop. Datagrams are received into
+one preallocated buffer and sent on from a view of it, so forwarding copies
+nothing into Python objects.
+"""
+import logging
+import socket
+import time
+
+log = logging.getLogger("server")
+
+# Seconds a relay may go without forwarding anything before it is closed
+RELAY_TIMEOUT = 300
+# Seconds between checks for idle relays
+SWEEP_INTERVAL = 10
+# Large enough for any UDP datagram
+BUFFER_BYTE_COUNT = 65536
+# Datagrams forwarded from one socket before the loop serves the others
+MAX_BURST = 64
+# Leaves room for a burst to queue up while the loop serves other relays
+RECEIVE_BUFFER_BYTE_COUNT = 1024 * 1024
+
+
+class Relay:
+    """Forwards datagrams between the two clients of one chat"""
+    def __init__(self, relays, usernames):
+        """usernames are the two clients, each given the port at the same index"""
+        self.relays = relays
+        self.usernames = usernames
+
+        self.sockets = []
+        for _ in usernames:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_BYTE_COUNT)
+            # Port 0 lets the OS pick a free port so relays never collide
+            sock.bind((relays.host, 0))
+            self.sockets.append(sock)
+        self.ports = [sock.getsockname()[1] for sock in self.sockets]
+        # Where each client sends from, learnt from its first datagram
+        self.addresses = [None, None]
+
+        # Forwarded from each client
+        self.byte_counts = [0, 0]
+        self.datagram_counts = [0, 0]
+        # Datagrams from strangers, or sent before the other client arrived
+        self.dropped = 0
+        self.last_active = time.monotonic()
+
+    def forward(self, side):
+        """Sends on every datagram waiting on the socket of side, up to a burst"""
+        sock = self.sockets[side]
+        other = 1 - side
+        buffer = self.relays.view
+
+        for _ in range(MAX_BURST):
+            try:
+                byte_count, address = sock.recvfrom_into(buffer)
+            except BlockingIOError:
+                return
+            except OSError:
+                # An ICMP error for an earlier datagram, which UDP reports on the next read
+                continue
+
+            if self.addresses[side] is None:
+                self.addresses[side] = address
+                log.debug(f"Relay for {self.usernames[side]} found them at {address}")
+            elif self.addresses[side] != address:
+                self.dropped += 1
+                continue
+
+            destination = self.addresses[other]
+            if destination is None:
+                self.dropped += 1
+                continue
+
+            try:
+                self.sockets[other].sendto(buffer[:byte_count], destination)
+            except OSError:
+                # Full or unreachable, which UDP treats as a lost datagram
+                self.dropped += 1
+                continue
+
+            self.byte_counts[side] += byte_count
+            self.datagram_counts[side] += 1
+            self.relays.byte_count += byte_count
+            self.relays.datagram_count += 1
+            self.last_active = time.monotonic()
+
+    def describe(self):
+        """Returns the per direction byte counts of the relay, for the log"""
+        first, second = self.usernames
+        return (f"{first} -> {second}: {self.byte_counts[0]} bytes in {self.datagram_counts[0]} "
+                f"datagrams, {second} -> {first}: {self.byte_counts[1]} bytes in "
+                f"{self.datagram_counts[1]} datagrams, {self.dropped} dropped")
+
+
+class Relays:
+    """Every relay of a server, all served by its event loop"""
+    def __init__(self, host, limit):
+        """Binds relays to host, opening at most limit of them at once"""
+        self.host = host
+        self.limit = limit
+        self.relays = set()
+
+        # Shared by every relay, as the loop forwards one datagram at a time
+        self.buffer = bytearray(BUFFER_BYTE_COUNT)
+        self.view = memoryview(self.buffer)
+
+        self.byte_count = 0
+        self.datagram_count = 0
+        self.opened = 0
+        self.loop = None
+        self.sweeper = None
+
+    def __len__(self):
+        return len(self.relays)
+
+    def start(self, loop):
+        self.loop = loop
+        self.sweeper = loop.call_later(SWEEP_INTERVAL, self.sweep)
+
+    def allocate(self, first, second):
+        """Opens a relay between two usernames, returning None if there are too many already"""
+        if len(self.relays) >= self.limit:
+            return None
+
+        relay = Relay(self, (first, second))
+        for side, sock in enumerate(relay.sockets):
+            self.loop.add_reader(sock.fileno(), relay.forward, side)
+        self.relays.add(relay)
+        self.opened += 1
+        log.info(f"Relay opened between {first} and {second} on ports {relay.ports}")
+        return relay
+
+    def close(self, relay):
+        if relay not in self.relays:
+            return
+        self.relays.discard(relay)
+        for sock in relay.sockets:
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+        log.info(f"Relay closed, {relay.describe()}")
+
+    def close_user(self, username):
+        """Closes every relay serving username"""
+        for relay in [relay for relay in self.relays if username in relay.usernames]:
+            self.close(relay)
+
+    def sweep(self):
+        """Closes relays that have been idle for too long"""
+        cutoff = time.monotonic() - RELAY_TIMEOUT
+        for relay in [relay for relay in self.relays if relay.last_active < cutoff]:
+            self.close(relay)
+        self.sweeper = self.loop.call_later(SWEEP_INTERVAL, self.sweep)
+
+    def shutdown(self):
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+        for relay in list(self.relays):
+            self.close(relay)
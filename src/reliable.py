@@ -0,0 +1,247 @@
+"""
+Reliable, ordered delivery of chat datagrams
+
+Each frame is sent as a numbered segment and kept until the peer acknowledges
+it. Acks carry the next sequence number expected and a bitmap of the segments
+received after it, so a loss only resends the missing segments. Up to WINDOW
+segments may be unacknowledged at once, and the retransmission timeout adapts
+to the measured round trip time as described in RFC 6298.
+"""
+import collections
+import threading
+import time
+from codec import (
+    ACK_BYTE_COUNT,
+    ACK_FRAME,
+    SEGMENT_FRAME,
+    SEGMENT_HEADER_BYTE_COUNT,
+    decode_ack,
+    decode_segment,
+    encode_ack,
+    encode_segment,
+)
+
+# Segments that may be sent but not yet acknowledged, which must fit the ack bitmap
+WINDOW = 64
+SEQUENCE_MASK = 0xFFFFFFFF
+
+# Retransmission timeouts in seconds
+INITIAL_RTO = 0.25
+MIN_RTO = 0.02
+MAX_RTO = 8.0
+
+# Acks showing later segments but not this one before it is resent without waiting
+DUPLICATE_THRESHOLD = 3
+
+
+def unwrap(sequence, reference):
+    """Returns the sequence number closest to reference that has the given lower 32 bits"""
+    difference = (sequence - reference) & SEQUENCE_MASK
+    if difference > SEQUENCE_MASK // 2:
+        difference -= SEQUENCE_MASK + 1
+    return reference + difference
+
+
+class RoundTripTimer:
+    """Derives the retransmission timeout from round trip time samples, as in RFC 6298"""
+    def __init__(self, initial=INITIAL_RTO, minimum=MIN_RTO, maximum=MAX_RTO):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+
+    def observe(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.minimum), self.maximum)
+
+    def back_off(self):
+        """Doubles the timeout after a loss"""
+        self.rto = min(self.rto * 2, self.maximum)
+
+
+class Segment:
+    __slots__ = ("datagram", "sent", "retransmitted")
+
+    def __init__(self, datagram, sent):
+        self.datagram = datagram
+        self.sent = sent
+        self.retransmitted = False
+
+
+class ReliableChannel:
+    """Sends frames to one peer over UDP, delivering the peer's frames in order exactly once"""
+    def __init__(self, sock, address, reactor, deliver):
+        """
+        reactor runs the retransmission timer, and receive must be called on its thread
+        deliver is called on the reactor thread with each frame from the peer, in order
+        """
+        self.sock = sock
+        self.address = address
+        self.reactor = reactor
+        self.deliver = deliver
+
+        # Taken by sends and by the reactor thread handling acks and timeouts
+        self.lock = threading.Lock()
+
+        # Every segment before acked has been acknowledged
+        self.next_sequence = 0
+        self.acked = 0
+        self.unacked = {}
+        # Frames waiting for the window to open
+        self.backlog = collections.deque()
+        self.duplicates = 0
+
+        self.round_trip = RoundTripTimer()
+        self.timer = None
+
+        # Every segment before expected has been delivered
+        self.expected = 0
+        self.out_of_order = {}
+
+        self.retransmits = 0
+
+    def send(self, frame):
+        """Queues a frame to be delivered to the peer, never waiting for the network"""
+        with self.lock:
+            if self.backlog or self.next_sequence >= self.acked + WINDOW:
+                self.backlog.append(frame)
+            else:
+                self.transmit(frame)
+
+    def transmit(self, frame):
+        sequence = self.next_sequence
+        self.next_sequence += 1
+
+        segment = Segment(encode_segment(sequence & SEQUENCE_MASK, frame), time.monotonic())
+        self.unacked[sequence] = segment
+        self.sock.sendto(segment.datagram, self.address)
+
+        if self.timer is None:
+            self.timer = self.reactor.call_later(self.round_trip.rto, self.timed_out)
+
+    def fill_window(self):
+        while self.backlog and self.next_sequence < self.acked + WINDOW:
+            self.transmit(self.backlog.popleft())
+
+    def receive(self, view):
+        """Handles a datagram from the peer, called on the reactor thread"""
+        frame_type = view[0]
+        if frame_type == ACK_FRAME:
+            # Cut short, so nothing in it can be trusted
+            if len(view) >= ACK_BYTE_COUNT:
+                self.receive_ack(view)
+            return
+
+        # A frame sent without the reliability layer
+        if frame_type != SEGMENT_FRAME:
+            self.deliver(view)
+            return
+        if len(view) < SEGMENT_HEADER_BYTE_COUNT:
+            return
+
+        sequence, frame = decode_segment(view)
+        deliverable = []
+        with self.lock:
+            sequence = unwrap(sequence, self.expected)
+            # Anything before expected is a resend of a segment whose ack was lost
+            if self.expected <= sequence < self.expected + WINDOW:
+                if sequence not in self.out_of_order:
+                    self.out_of_order[sequence] = bytes(frame)
+                while self.expected in self.out_of_order:
+                    deliverable.append(self.out_of_order.pop(self.expected))
+                    self.expected += 1
+
+            received = 0
+            for later in self.out_of_order:
+                received |= 1 << (later - self.expected - 1)
+            ack = encode_ack(self.expected & SEQUENCE_MASK, received)
+
+        # Every segment is acknowledged, including duplicates, in case an ack was lost
+        self.sock.sendto(ack, self.address)
+
+        for frame in deliverable:
+            self.deliver(frame)
+
+    def receive_ack(self, view):
+        expected, received = decode_ack(view)
+        now = time.monotonic()
+
+        with self.lock:
+            expected = unwrap(expected, self.acked)
+            if expected > self.next_sequence:
+                # Acknowledges segments that were never sent
+                return
+
+            # Only segments sent once give a usable round trip time (Karn's algorithm)
+            sample = None
+            if expected > self.acked:
+                for sequence in range(self.acked, expected):
+                    segment = self.unacked.pop(sequence, None)
+                    if segment is not None and not segment.retransmitted:
+                        sample = now - segment.sent
+                self.acked = expected
+                self.duplicates = 0
+            elif received:
+                self.duplicates += 1
+
+            while received:
+                lowest = received & -received
+                segment = self.unacked.pop(expected + lowest.bit_length(), None)
+                if segment is not None and not segment.retransmitted:
+                    sample = now - segment.sent
+                received ^= lowest
+
+            if sample is not None:
+                self.round_trip.observe(sample)
+
+            if self.duplicates == DUPLICATE_THRESHOLD and expected in self.unacked:
+                self.retransmit(self.unacked[expected], now)
+
+            self.fill_window()
+
+            # The timer always covers the oldest unacknowledged segment
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.unacked:
+                self.timer = self.reactor.call_later(self.round_trip.rto, self.timed_out)
+
+    def retransmit(self, segment, now):
+        segment.sent = now
+        segment.retransmitted = True
+        self.retransmits += 1
+        self.sock.sendto(segment.datagram, self.address)
+
+    def timed_out(self):
+        """Resends every segment unacknowledged for longer than the timeout, backing off"""
+        with self.lock:
+            self.timer = None
+            if not self.unacked:
+                return
+
+            now = time.monotonic()
+            resent = False
+            for segment in self.unacked.values():
+                if now - segment.sent >= self.round_trip.rto:
+                    self.retransmit(segment, now)
+                    resent = True
+
+            if resent:
+                self.round_trip.back_off()
+
+            # Wait until the oldest remaining segment times out
+            oldest = min(segment.sent for segment in self.unacked.values())
+            self.timer = self.reactor.call_later(
+                max(oldest + self.round_trip.rto - now, MIN_RTO), self.timed_out)
+
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
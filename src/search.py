@@ -0,0 +1,157 @@
+"""
+Search of chat messages
+
+Each chat indexes its messages as they are added, under every distinct word in
+them. A word maps to the numbers of the messages containing it in ascending
+order, so the newest matches are at the end of the list and a search reads
+back only as far as the results it returns, however long the chat is. The
+words are also kept sorted, so those starting with a prefix are found by
+bisection rather than by checking every word. A prefix shared by many words
+has their lists merged into one the first time it is searched, which is then
+kept up to date as messages are added, so searching it again costs no more
+than searching a single word.
+"""
+import array
+import bisect
+import heapq
+import re
+import threading
+
+# Longer words are split up, so a long run of characters cannot bloat the index
+MAX_WORD_LENGTH = 64
+WORD = re.compile(rf"\w{{1,{MAX_WORD_LENGTH}}}")
+# A word, optionally followed by * to match every word starting with it
+TERM = re.compile(rf"(\w{{1,{MAX_WORD_LENGTH}}})(\*?)")
+# Results returned by a search
+RESULTS = 20
+# Prefixes expanding to more words than this have their merged list kept
+WIDE_PREFIX_WORDS = 32
+MAX_WIDE_PREFIXES = 256
+
+
+def words(text):
+    """Returns the distinct words of text, ignoring case"""
+    return set(WORD.findall(text.casefold()))
+
+
+def descending(postings):
+    """Yields each number in any of postings once, from the largest"""
+    if len(postings) == 1:
+        yield from reversed(postings[0])
+        return
+
+    previous = None
+    for number in heapq.merge(*(reversed(numbers) for numbers in postings), reverse=True):
+        # A message may hold several words starting with a prefix
+        if number != previous:
+            yield number
+            previous = number
+
+
+def insert(numbers, number):
+    """Adds number to the ascending numbers, unless it is already there"""
+    if not numbers or numbers[-1] < number:
+        numbers.append(number)
+        return
+    # A message sent and one received at the same time may be indexed out of order
+    i = bisect.bisect_left(numbers, number)
+    if i == len(numbers) or numbers[i] != number:
+        numbers.insert(i, number)
+
+
+def contains(postings, number):
+    for numbers in postings:
+        i = bisect.bisect_left(numbers, number)
+        if i < len(numbers) and numbers[i] == number:
+            return True
+    return False
+
+
+class SearchIndex:
+    """An inverted index of the messages in one chat"""
+    def __init__(self):
+        # Each word mapped to the ascending numbers of the messages containing it
+        self.postings = {}
+        # Words sorted for prefix searches, and words added since they were sorted
+        self.vocabulary = []
+        self.new_words = []
+        # Merged lists of the prefixes that expand to many words
+        self.wide_prefixes = {}
+        self.longest_wide_prefix = 0
+        # Added to by the reactor thread and the main thread, and searched by the main thread
+        self.lock = threading.Lock()
+
+    def add(self, number, text):
+        """Indexes message number, which contains text"""
+        with self.lock:
+            for word in words(text):
+                numbers = self.postings.get(word)
+                if numbers is None:
+                    numbers = self.postings[word] = array.array("I")
+                    self.new_words.append(word)
+                # Messages almost always arrive in order, so this is checked first
+                if numbers and numbers[-1] >= number:
+                    insert(numbers, number)
+                else:
+                    numbers.append(number)
+
+                if self.wide_prefixes:
+                    for length in range(1, min(len(word), self.longest_wide_prefix) + 1):
+                        merged = self.wide_prefixes.get(word[:length])
+                        if merged is not None:
+                            insert(merged, number)
+
+    def expand(self, prefix):
+        """Returns the postings of every word starting with prefix"""
+        merged = self.wide_prefixes.get(prefix)
+        if merged is not None:
+            return [merged]
+
+        if self.new_words:
+            # Mostly sorted already, which the sort takes advantage of
+            self.vocabulary += self.new_words
+            self.vocabulary.sort()
+            self.new_words.clear()
+
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        postings = []
+        for word in self.vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+            postings.append(self.postings[word])
+
+        if len(postings) > WIDE_PREFIX_WORDS and len(self.wide_prefixes) < MAX_WIDE_PREFIXES:
+            merged = array.array("I", sorted(set().union(*postings)))
+            self.wide_prefixes[prefix] = merged
+            self.longest_wide_prefix = max(self.longest_wide_prefix, len(prefix))
+            return [merged]
+        return postings
+
+    def search(self, query, limit=RESULTS):
+        """
+        Returns the numbers of up to limit messages containing every word in query, newest first
+        A word ending in * matches any word starting with it
+        """
+        with self.lock:
+            terms = []
+            for word, wildcard in TERM.findall(query.casefold()):
+                if wildcard:
+                    postings = self.expand(word)
+                else:
+                    postings = [self.postings[word]] if word in self.postings else []
+                # Nothing can match every term
+                if not postings:
+                    return []
+                terms.append(postings)
+            if not terms:
+                return []
+
+            # Walk the term with the fewest matches, checking the rest for each one
+            terms.sort(key=lambda postings: sum(len(numbers) for numbers in postings))
+            results = []
+            for number in descending(terms[0]):
+                if all(contains(postings, number) for postings in terms[1:]):
+                    results.append(number)
+                    if len(results) == limit:
+                        break
+            return results
@@ -1,40 +1,159 @@
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import os
+import signal
 import socket
+import tempfile
 import threading
-from threading import Thread
-from enum import Enum
 import logging
-import struct
+import time
+from auth import Authenticator, Overloaded
+from broker import Broker, BrokerLink
+from cluster import GOSSIP_INTERVAL, Cluster
+from codec import (
+    Message,
+    COMMAND_FRAME,
+    COMMAND_BYTE_COUNT,
+    EMPTY_PARAM,
+    decode_param,
+    encode_command,
+    encode_conn_info,
+    encode_data_transfer,
+    iter_commands,
+)
+from metrics import Metrics
+from ratelimit import DEFAULT_LIMITS, RateLimits, parse_limit
+from registry import Registry
+from relay import Relays
+from store import CredentialStore
+from wheel import TimerWheel
 
 log = logging.getLogger("server")
 logging.basicConfig(level=logging.INFO)
 
+# Labels for the metrics of each command type
+MESSAGE_NAMES = {message.value: message.name for message in Message}
+# Commands that wait on the hashing pool or other servers, so many can be in progress at once
+EXPENSIVE_COMMANDS = {Message.SIGN_UP.value, Message.SIGN_IN.value}
+# Commands sent on to another user under the sender's username, so only once signed in
+CHAT_COMMANDS = {
+    Message.REQUEST_PTP_CONNECTION.value,
+    Message.DECLINE_PTP_CONNECTION.value,
+    Message.ACCEPT_PTP_CONNECTION.value,
+    Message.ACCEPT_PTP_RELAY.value,
+}
 
-class Message(Enum):
-    SIGN_UP = 0
-    DECLINE_SIGN_UP = 1
-    SIGN_IN = 2
-    ACCEPT_SIGN_IN = 3
-    DECLINE_SIGN_IN = 4
-    REQUEST_USER_LIST = 5
-    REQUEST_PTP_CONNECTION = 6
-    USER_NOT_AVAILABLE = 7
-    RELAY_PTP_REQUEST = 8
-    DECLINE_PTP_CONNECTION = 9
-    ACCEPT_PTP_CONNECTION = 10
-    SIGN_OUT = 11
-    ALREADY_LOGGED_IN = 12
 
-def pad_bytes(bytes, length):
-    """Left pad bytes with null bytes"""
-    return bytes + b"\x00" * (length - len(bytes))
+class CommandProtocol(asyncio.BufferedProtocol):
+    """
+    Frames the command stream of one connection
+    Bytes are received straight into a reusable buffer and every complete command
+    in it is queued for the user in order, so clients may pipeline commands
+    """
+    # Small enough that idle connections stay cheap, large enough for a burst of commands
+    BUFFER_SIZE = 4096
+    # Reading pauses while this many commands are waiting to be processed
+    HIGH_WATER = 1024
+    LOW_WATER = 256
+
+    def __init__(self, server, greet=True):
+        self.server = server
+        # Clients handed off to this connection are not told the port again
+        self.greet = greet
+
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        # Unprocessed bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.user = User(transport, self.server, self)
+        self.server.watch(self.user)
+
+        # A handed off port of 0 tells the client to keep this connection
+        if self.greet:
+            transport.write((0).to_bytes(2, "little"))
+
+        self.server.registry.add(self.user)
+        self.task = asyncio.ensure_future(self.user.run())
+
+    def get_buffer(self, sizehint):
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        self.user.last_active = self.server.wheel.ticks
+        self.server.metrics.bytes_in += nbytes
+
+        frames = []
+        complete = (self.end - self.start) // COMMAND_BYTE_COUNT * COMMAND_BYTE_COUNT
+        with memoryview(self.buffer)[self.start:self.start + complete] as view:
+            for frame_type, command_type, param_1, param_2 in iter_commands(view):
+                # The server is *never* sent a data transfer by the client
+                # This is assumed to be malicious
+                if frame_type != COMMAND_FRAME:
+                    log.debug("Data transfer received, closing connection")
+                    frames.append(None)
+                    self.transport.pause_reading()
+                    break
+
+                frames.append((command_type, param_1, param_2))
+                self.start += COMMAND_BYTE_COUNT
+
+        # Keep any partial command at the front of the buffer for the next read
+        remaining = self.end - self.start
+        self.buffer[:remaining] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = remaining
+
+        if frames:
+            self.user.receive(frames)
+
+    def eof_received(self):
+        # The connection was closed without signout by the client
+        log.debug("Connection closed")
+        self.user.receive([None])
+
+    def connection_lost(self, exc):
+        if exc:
+            log.debug("Connection forcibly closed")
+        self.user.receive([None])
+
+    def pause_writing(self):
+        # The client is reading slower than it is being sent frames
+        self.user.writable = False
+
+    def resume_writing(self):
+        self.user.writable = True
+        self.user.flush()
+
+    def pause(self):
+        if not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
 
 
 class User:
     """Manages a connection to a specific client"""
-    def __init__(self, sock, server):
-        """Takes a TCP socket and a reference"""
-        self.sock = sock
+    def __init__(self, transport, server, protocol):
+        """Takes the transport of a TCP connection and a reference to the server"""
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
         self.server = server
+        self.protocol = protocol
+
+        # Commands received but not yet processed, None marks the end of the stream
+        self.inbox = collections.deque()
+        self.waiting = asyncio.Event()
 
         self.username = None
         self.password = None
@@ -43,84 +162,229 @@ class User:
         # Not visible until specified as such
         self.visible = False
 
-    def process_command(self, command_bytes):
-        """
-        Takes command bytes
-        1 byte for command type, 8 bytes for param 1, 8 bytes for param 2
-        """
-        # The protocol specification is described in the report
-        command_type = command_bytes[0]
-        param_1 = command_bytes[1:9]
-        param_2 = command_bytes[9:17]
+        # The wheel tick anything last arrived in, and the timer that checks on it
+        self.last_active = server.wheel.ticks
+        self.idle_timer = None
+        # Clients that send heartbeats can be closed once they go quiet
+        self.heartbeats = False
+
+        # Frames waiting while the transport's buffer is full, bulk ones sent after the rest
+        self.writable = True
+        self.control = collections.deque()
+        self.bulk = collections.deque()
+
+        # How often the user may send each type of command, if limited at all
+        self.limiter = server.limits.limiter() if server.limits is not None else None
+
+    async def process_command(self, command_type, param_1, param_2):
+        """Takes a decoded command, with 8 bytes for param 1 and 8 bytes for param 2"""
+        if not self.admit(command_type):
+            return
+
+        expensive = command_type in EXPENSIVE_COMMANDS
+        if expensive:
+            self.server.expensive += 1
+        try:
+            await self.handle_command(command_type, param_1, param_2)
+        except ValueError as error:
+            # A param that could not be decoded, which only a broken or hostile client sends
+            name = MESSAGE_NAMES.get(command_type, "UNKNOWN")
+            log.debug(f"Refusing {name} from {self.addr}: {error}")
+            self.refuse(command_type, param_1)
+        finally:
+            if expensive:
+                self.server.expensive -= 1
+
+    @property
+    def signed_in(self):
+        return self.username is not None and self.server.registry.get(self.username) is self
 
+    def refuse(self, command_type, param_1):
+        """Sends the reply a client waits for when its command cannot be carried out"""
         if command_type == Message.SIGN_UP.value:
-            username = param_1.decode("utf-8")
-            password = param_2.decode("utf-8")
+            self.send_command(Message.DECLINE_SIGN_UP.value)
+        elif command_type == Message.SIGN_IN.value:
+            self.send_command(Message.DECLINE_SIGN_IN.value)
+        elif command_type == Message.QUERY_USER_LIST.value:
+            self.send_user_list([], (0).to_bytes(4, "little"))
+        elif command_type in (Message.REQUEST_PTP_CONNECTION.value,
+                              Message.ACCEPT_PTP_CONNECTION.value):
+            self.send_command(Message.USER_NOT_AVAILABLE.value)
+        elif command_type == Message.ACCEPT_PTP_RELAY.value:
+            self.send_command(Message.USER_NOT_AVAILABLE.value, param_1)
+        # Nothing else is answered, so nothing else needs refusing
+
+    def admit(self, command_type):
+        """Returns whether a command is within the limits, refusing it if not"""
+        # Signing out is never refused, so even a flooding client can leave
+        if command_type == Message.SIGN_OUT.value:
+            return True
+
+        if command_type in EXPENSIVE_COMMANDS and self.server.expensive >= self.server.max_expensive:
+            self.server.expensive_refused += 1
+        elif self.limiter is None or self.limiter.allow(command_type):
+            return True
+        else:
+            self.server.metrics.rate_limited(MESSAGE_NAMES.get(command_type, "UNKNOWN"))
+
+        # Sent behind anything else waiting, as it is the first thing worth dropping
+        self.send_frame(encode_command(Message.RATE_LIMITED.value, bytes((command_type,))),
+                        bulk=True)
+        return False
+
+    async def handle_command(self, command_type, param_1, param_2):
+        """Carries out a command that was let through"""
+        # Otherwise a relay could be held for a user that is never removed
+        if command_type in CHAT_COMMANDS and not self.signed_in:
+            log.debug(f"Refusing {MESSAGE_NAMES[command_type]} from {self.addr} before signing in")
+            self.refuse(command_type, param_1)
+            return
+
+        # The protocol specification is described in the report
+        if command_type == Message.HEARTBEAT.value:
+            # Arriving was enough to show the client is still there
+            self.heartbeats = True
+
+        elif command_type == Message.SIGN_UP.value:
+            # A connection is only ever signed in under one name
+            if self.signed_in:
+                self.send_command(Message.ALREADY_LOGGED_IN.value)
+                return
+
+            username = decode_param(param_1)
+            password = decode_param(param_2)
 
             if username in self.server.registered_users:
                 log.debug(f"Username '{username}' taken")
                 self.send_command(Message.DECLINE_SIGN_UP.value)
                 return
 
+            try:
+                encoded = await self.server.auth.hash(password)
+            except Overloaded:
+                log.debug(f"Too many hashes waiting to sign up '{username}'")
+                self.send_command(Message.DECLINE_SIGN_UP.value)
+                return
+
+            # Someone else may have taken the username while it was hashed
+            if username in self.server.registered_users:
+                self.send_command(Message.DECLINE_SIGN_UP.value)
+                return
+
+            # Only accepted once the account will survive a restart
+            try:
+                registered = await self.server.add_registered_user(username, encoded)
+            except OSError:
+                registered = False
+            if not registered:
+                self.send_command(Message.DECLINE_SIGN_UP.value)
+                return
+
+            self.server.auth.remember(username, password)
+            # Another worker may have signed in to the new account first
+            if not await self.server.sign_in(self, username):
+                self.send_command(Message.ALREADY_LOGGED_IN.value)
+                return
             self.username = username
             self.password = password
             self.registered = True
-            self.server.add_registered_user(username, password)
+            self.visible = True
 
             log.debug(f"Username '{username}' signed in")
             self.send_command(Message.ACCEPT_SIGN_IN.value)
 
         elif command_type == Message.SIGN_IN.value:
-            username = param_1.decode("utf-8")
-            password = param_2.decode("utf-8")
+            if self.signed_in:
+                self.send_command(Message.ALREADY_LOGGED_IN.value)
+                return
+
+            username = decode_param(param_1)
+            password = decode_param(param_2)
 
             # Decline login if username in list of current users
-            if username in [n.username for n in self.server.users]:
+            if self.server.registry.is_online(username):
                 self.send_command(Message.ALREADY_LOGGED_IN.value)
                 return
 
             # Confirm correct username and password match
-            registered_users = self.server.registered_users
-            if username in registered_users and registered_users[username] == password:
+            encoded = self.server.registered_users.get(username)
+            try:
+                verified = encoded is not None and await self.server.auth.verify(
+                    username, password, encoded)
+            except Overloaded:
+                log.debug(f"Too many hashes waiting to sign in '{username}'")
+                verified = False
+
+            if verified:
+                # Claiming the username is atomic, so a concurrent login can still lose
+                if not await self.server.sign_in(self, username):
+                    self.send_command(Message.ALREADY_LOGGED_IN.value)
+                    return
+
                 self.username = username
                 self.password = password
                 self.registered = True
+                self.visible = True
 
                 self.send_command(Message.ACCEPT_SIGN_IN.value)
                 return
 
-            self.send_command(Message.DECLINE_LOGIN.value)
+            self.send_command(Message.DECLINE_SIGN_IN.value)
+
+        elif command_type == Message.SET_VISIBILITY.value:
+            # Param 1 holds a single flag byte
+            self.visible = param_1[0] != 0
+            self.server.set_visible(self, self.visible)
+
+        elif command_type == Message.SIGN_OUT.value:
+            self.server.sign_out(self)
 
         elif command_type == Message.REQUEST_USER_LIST.value:
-            users = self.server.get_user_list()
+            self.send_user_list(self.server.get_user_list())
 
-            if len(users) == 0:
-                data = ""
-            else:
-                data = (", ".join(users))
+        elif command_type == Message.QUERY_USER_LIST.value:
+            # Param 1 is the prefix, param 2 a 4 byte offset and a 4 byte limit
+            prefix = decode_param(param_1)
+            offset = int.from_bytes(param_2[:4], "little")
+            limit = int.from_bytes(param_2[4:], "little")
+            if limit == 0 or limit > self.server.MAX_PAGE:
+                limit = self.server.MAX_PAGE
 
-            log.debug(f"Sending data transfer: {data}")
-            self.send_data_transfer(True, 0, len(data), data.encode())
+            users, total = self.server.registry.query(prefix, offset, limit)
+            # The total number of matches is sent as the identifier
+            self.send_user_list(users, total.to_bytes(4, "little"))
+
+        elif command_type == Message.SUBSCRIBE_PRESENCE.value:
+            # Param 1 holds a single flag byte, 0 unsubscribes
+            if param_1[0] == 0:
+                self.server.registry.unsubscribe(self)
+                return
+
+            # The snapshot is followed by a PRESENCE_UPDATE for every change
+            self.send_user_list(self.server.registry.subscribe(self))
 
         elif command_type == Message.REQUEST_PTP_CONNECTION.value:
-            username = param_1.decode("utf-8")
+            username = decode_param(param_1)
             user = self.server.get_user(username)
 
             # User has already signed out
             if not user:
                 log.debug(f"{username} not available")
+                self.server.metrics.relay_failed(Message.USER_NOT_AVAILABLE.name)
                 self.send_command(Message.USER_NOT_AVAILABLE.value)
 
             else:
                 log.debug("Relay request")
-                user.send_command(
+                # Param 2 holds a flag byte asking the other user to chat through a relay
+                if not user.send_command(
                     Message.RELAY_PTP_REQUEST.value, self.username.encode(
-                        "utf-8")
-                )
+                        "utf-8"), param_2[:1]
+                ):
+                    self.server.metrics.relay_failed(Message.USER_NOT_AVAILABLE.name)
+                    self.send_command(Message.USER_NOT_AVAILABLE.value)
 
         elif command_type == Message.DECLINE_PTP_CONNECTION.value:
-            username = param_1.decode("utf-8")
-            log.debug(username)
+            username = decode_param(param_1)
             user = self.server.get_user(username)
             # Ensure user is still connected
             if user:
@@ -130,68 +394,183 @@ class User:
                 )
 
         elif command_type == Message.ACCEPT_PTP_CONNECTION.value:
-            username = param_1.decode("utf-8")
+            username = decode_param(param_1)
             connection_data = param_2
             user = self.server.get_user(username)
 
-            user.send_command(
+            # The requester may have signed out since
+            if not user:
+                log.debug(f"{username} not available")
+                self.server.metrics.relay_failed(Message.USER_NOT_AVAILABLE.name)
+                self.send_command(Message.USER_NOT_AVAILABLE.value)
+                return
+
+            if not user.send_command(
                 Message.ACCEPT_PTP_CONNECTION.value,
                 self.username.encode("utf-8"),
                 connection_data,
+            ):
+                self.server.metrics.relay_failed(Message.USER_NOT_AVAILABLE.name)
+                self.send_command(Message.USER_NOT_AVAILABLE.value)
+
+        elif command_type == Message.ACCEPT_PTP_RELAY.value:
+            username = decode_param(param_1)
+            user = self.server.get_user(username)
+
+            # The username is echoed so the client knows which chat was refused
+            if not user:
+                log.debug(f"{username} not available")
+                self.server.metrics.relay_failed(Message.USER_NOT_AVAILABLE.name)
+                self.send_command(Message.USER_NOT_AVAILABLE.value, param_1)
+                return
+
+            relay = None
+            if self.server.relays is not None:
+                relay = self.server.relays.allocate(self.username, username)
+            if relay is None:
+                log.debug(f"No relay for {self.username} and {username}")
+                self.server.metrics.relay_failed(Message.RELAY_NOT_AVAILABLE.name)
+                self.send_command(Message.RELAY_NOT_AVAILABLE.value, param_1)
+                return
+
+            # Each user is told the other's username and the port of their side of the relay
+            if not user.send_command(
+                Message.RELAY_ALLOCATED.value,
+                self.username.encode("utf-8"),
+                encode_conn_info(self.server.HOST, relay.ports[1]),
+            ):
+                self.server.relays.close(relay)
+                self.server.metrics.relay_failed(Message.USER_NOT_AVAILABLE.name)
+                self.send_command(Message.USER_NOT_AVAILABLE.value, param_1)
+                return
+            self.send_command(
+                Message.RELAY_ALLOCATED.value,
+                username.encode("utf-8"),
+                encode_conn_info(self.server.HOST, relay.ports[0]),
             )
 
-    def send_command(self, command_num, param_1=b"\x00" * 8, param_2=b"\x00" * 8):
-        """Pads params 1 and 2 with 0s by default, otherwise assumes values if inputed are padded"""
-        self.conn.sendall(
-            b"\x01"
-            + command_num.to_bytes(1, "little")
-            + pad_bytes(param_1, 8)
-            + pad_bytes(param_2, 8)
-        )
+    def send_command(self, command_num, param_1=EMPTY_PARAM, param_2=EMPTY_PARAM):
+        """Pads params 1 and 2 with 0s, returning False if the frame was refused"""
+        return self.send_frame(encode_command(command_num, param_1, param_2))
 
-    def send_data_transfer(self, message, identifier_length, data_length, data):
-        """Sends data transfer, assuming data is encoded"""
-        self.conn.sendall(
-            (b"\x00"
-            if message
-            else b"\x40")
-            + identifier_length.to_bytes(1, "little")
-            + data_length.to_bytes(4, "little")
-            + data
-        )
+    def send_frame(self, frame, bulk=False):
+        """
+        Sends an already encoded frame, returning False if it was refused
+        Bulk frames, like user lists and presence updates, wait behind any others
+        """
+        if self.transport.is_closing():
+            return False
 
-    def run(self):
-        """Waits for requests from the client, handling exceptions were possible"""
-        self.sock.listen()
-        self.conn, self.addr = self.sock.accept()
-        with self.conn:
-            log.info(f"Connected by {self.addr}")
+        if self.writable:
+            self.write(frame)
+            return True
+
+        # The client is not keeping up, so the frame waits in the outbox if there is room
+        if len(self.control) + len(self.bulk) >= self.server.outbox_size:
+            return self.overflow(frame, bulk)
+
+        (self.bulk if bulk else self.control).append(frame)
+        self.server.queued += 1
+        return True
+
+    def write(self, frame):
+        # Writes are buffered by the event loop so this never blocks
+        self.transport.write(frame)
+        self.server.metrics.bytes_out += len(frame)
+
+    def overflow(self, frame, bulk):
+        """Applies the server's overflow policy to a frame that does not fit in the outbox"""
+        policy = self.server.overflow
+        if policy == "disconnect":
+            log.info(f"Closing {self.addr}, {self.server.outbox_size} frames behind")
+            self.server.overflow_closed += 1
+            self.discard_outbox()
+            self.transport.abort()
+            return False
+
+        self.server.dropped += 1
+        if policy == "drop" and self.bulk:
+            # A stale user list or presence update is the least missed
+            self.bulk.popleft()
+            (self.bulk if bulk else self.control).append(frame)
+            return True
+        # Refused, so anyone the frame was from is told the client is not available
+        return policy == "drop"
+
+    def flush(self):
+        """Writes waiting frames until the transport's buffer fills again"""
+        while self.writable and (self.control or self.bulk):
+            self.write((self.control or self.bulk).popleft())
+            self.server.queued -= 1
+
+    def discard_outbox(self):
+        self.server.queued -= len(self.control) + len(self.bulk)
+        self.control.clear()
+        self.bulk.clear()
+
+    def check_idle(self):
+        """Closes a connection that has gone quiet, otherwise checks again when it could have"""
+        wheel = self.server.wheel
+        timeout = wheel.ticks_for(self.server.idle_timeout)
+        idle = wheel.ticks - self.last_active
+
+        # Signed in clients that never send heartbeats may just have nothing to say
+        if idle >= timeout and (self.heartbeats or self.username is None):
+            log.info(f"Closing {self.addr}, silent for {idle * wheel.tick:.0f} s")
+            self.server.reaped += 1
+            self.idle_timer = None
+            # Nothing buffered for a client that has gone is worth waiting on
+            self.transport.abort()
+            return
+
+        self.idle_timer = wheel.schedule(timeout - idle if idle < timeout else timeout,
+                                         self.check_idle)
+
+    def send_user_list(self, users, identifier=b""):
+        """Sends the given usernames as a data transfer"""
+        log.debug(f"Sending user list of {len(users)} users")
+        self.send_data_transfer(True, identifier, ", ".join(users).encode())
+
+    def send_data_transfer(self, message, identifier, data):
+        """Sends data transfer, assuming identifier and data are encoded"""
+        self.send_frame(encode_data_transfer(message, identifier, data), bulk=True)
+
+    def receive(self, frames):
+        """Queues commands framed by the protocol"""
+        self.inbox.extend(frames)
+        self.waiting.set()
+
+        if len(self.inbox) >= self.protocol.HIGH_WATER:
+            self.protocol.pause()
 
+    async def run(self):
+        """Processes commands in the order they were received"""
+        log.info(f"Connected by {self.addr}")
+
+        try:
             while True:
-                try:
-                    initial_byte = self.conn.recv(1)
-                except:
-                    log.debug("Connection forcibly closed")
-                    self.server.remove_user(self)
-                    break
+                if not self.inbox:
+                    self.waiting.clear()
+                    await self.waiting.wait()
 
-                # The connection was closed without signout by the client
-                if initial_byte == b"":
-                    log.debug("Connection closed")
-                    self.server.remove_user(self)
+                command = self.inbox.popleft()
+                if command is None:
                     break
 
-                if initial_byte[0] == 1:
-                    # Recieve rest of message
-                    command_bytes = self.conn.recv(17)
-                    self.process_command(command_bytes)
+                if len(self.inbox) <= self.protocol.LOW_WATER:
+                    self.protocol.resume()
 
-                # The server is *never* sent a data transfer by the client
-                # This is assumed to be malicious
-                else:
-                    log.debug("Data transfer received, closing connection")
-                    self.server.remove_user(self)
-                    break
+                started = time.perf_counter()
+                await self.process_command(*command)
+                self.server.metrics.observe_command(
+                    MESSAGE_NAMES.get(command[0], "UNKNOWN"), time.perf_counter() - started)
+        finally:
+            # However the session ended, its username is released
+            self.server.remove_user(self)
+            if self.idle_timer is not None:
+                self.server.wheel.cancel(self.idle_timer)
+            self.discard_outbox()
+            self.transport.close()
 
 
 class Server:
@@ -201,81 +580,473 @@ class Server:
     HOST = "127.0.0.1"
     PORT = 65432
 
-    def __init__(self):
-        self.sockets = []
-        self.users_lock = threading.Lock()
-        # List of usernames
-        self._users = []
-        self.registered_users_lock = threading.Lock()
-        # Dictionary with username/password pairs
-        self._registered_users = {}
+    # The most usernames a single user list query returns
+    MAX_PAGE = 256
 
-    @property
-    def users(self):
-        with self.users_lock:
-            return self._users
+    # How long a handed off port waits for its client to reconnect
+    HANDOFF_TIMEOUT = 10
+
+    # Seconds a client that sends heartbeats, or has not signed in, may stay silent
+    IDLE_TIMEOUT = 90
+
+    # Frames a client that is slow to read may have waiting before the overflow policy applies
+    OUTBOX_SIZE = 256
+    # Drop the stalest user list or presence update, close the connection, or
+    # refuse the frame, telling any user it was from that the client is not available
+    OVERFLOW_POLICIES = ("drop", "disconnect", "reject")
+
+    # Sign ups and sign ins that may be in progress at once before more are refused
+    MAX_EXPENSIVE = 256
+
+    def __init__(self, handoff=False, stats_port=None, data_dir=None, auth_workers=None,
+                 max_relays=0, broker_path=None, worker_id=0, node=None, peers=(),
+                 gossip_interval=GOSSIP_INTERVAL, idle_timeout=IDLE_TIMEOUT,
+                 outbox_size=OUTBOX_SIZE, overflow="reject", rate_limits=DEFAULT_LIMITS,
+                 max_expensive=MAX_EXPENSIVE):
+        """
+        A server given broker_path is one of several workers sharing its port, whose
+        accounts and presence are kept by the broker listening on that Unix socket
+        A server given node as host:port is a node of a cluster, gossiping with the
+        other nodes on that address and first with the peers, given the same way
+        An idle_timeout of 0 keeps silent connections open
+        overflow is one of OVERFLOW_POLICIES, applied once a client has outbox_size frames waiting
+        rate_limits are as taken by RateLimits, or None to let every command through
+        """
+        # Legacy clients expect to be handed a personal port to reconnect to
+        self.handoff = handoff
+        # Connected users, indexed by username once signed in
+        self.registry = Registry(on_presence=self.publish_presence)
+        # Accounts are only kept in memory unless given a directory
+        # A worker's are a replica of the broker's, which persists them
+        self.credentials = CredentialStore(None if broker_path else data_dir)
+        # Where accounts and presence shared with other servers are kept, if anywhere
+        self.shared = None
+        if broker_path:
+            self.shared = BrokerLink(self, broker_path, worker_id)
+        elif node:
+            host, port = node.rsplit(":", 1)
+            self.shared = Cluster(self, host, int(port), peers, gossip_interval)
+        self.listener = None
+        self.stopping = False
+        # Silent connections are found by a timer each, all kept in one wheel
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel()
+        self.reaped = 0
+        # Frames for clients that are slow to read wait in an outbox each
+        self.outbox_size = outbox_size
+        self.overflow = overflow
+        self.queued = 0
+        self.dropped = 0
+        self.overflow_closed = 0
+        # Commands over a user's limits, or expensive ones over the server's, are refused
+        self.limits = RateLimits(rate_limits) if rate_limits is not None else None
+        self.max_expensive = max_expensive
+        self.expensive = 0
+        self.expensive_refused = 0
+        # Passwords are hashed in a process pool
+        self.auth = Authenticator(workers=auth_workers)
+        # Chats are only relayed when the server allows some relays
+        self.relays = Relays(self.HOST, max_relays) if max_relays else None
+
+        # Metrics are only served when a port is given
+        self.stats_port = stats_port
+        self.metrics = Metrics()
+        self.metrics.gauge("server_connections", "Open client connections",
+                           lambda: len(self.registry))
+        self.metrics.gauge("server_online_users", "Signed in users",
+                           self.registry.online_count)
+        self.metrics.gauge("server_registered_users", "Registered accounts",
+                           lambda: len(self.registered_users))
+        self.metrics.gauge("server_tasks", "Running asyncio tasks",
+                           lambda: len(asyncio.all_tasks()))
+        self.metrics.gauge("server_threads", "Running threads",
+                           threading.active_count)
+        self.metrics.gauge("server_auth_queue_depth", "Password hashes waiting for the pool",
+                           lambda: self.auth.waiting)
+        self.metrics.gauge("server_auth_in_flight", "Password hashes running in the pool",
+                           lambda: self.auth.in_flight)
+        self.metrics.counter("server_idle_closed_total", "Connections closed for going silent",
+                             lambda: self.reaped)
+        self.metrics.gauge("server_outbox_frames", "Frames waiting for clients that are slow to read",
+                           lambda: self.queued)
+        self.metrics.counter("server_outbox_dropped_total",
+                             "Frames dropped or refused as a client's outbox was full",
+                             lambda: self.dropped)
+        self.metrics.counter("server_outbox_closed_total",
+                             "Connections closed as their outbox was full",
+                             lambda: self.overflow_closed)
+        self.metrics.gauge("server_expensive_in_flight", "Sign ups and sign ins in progress",
+                           lambda: self.expensive)
+        self.metrics.counter("server_expensive_refused_total",
+                             "Sign ups and sign ins refused as too many were in progress",
+                             lambda: self.expensive_refused)
+        self.metrics.counter("server_auth_rejected_total", "Sign ins refused as the pool was full",
+                             lambda: self.auth.rejected)
+        self.metrics.counter("server_auth_cache_hits_total", "Sign ins verified from the cache",
+                             lambda: self.auth.cache_hits)
+        self.metrics.counter("server_auth_cache_misses_total", "Sign ins verified by hashing",
+                             lambda: self.auth.cache_misses)
+        if self.relays is not None:
+            self.metrics.gauge("server_relays", "Open chat relays",
+                               lambda: len(self.relays))
+            self.metrics.counter("server_relays_opened_total", "Chat relays opened",
+                                 lambda: self.relays.opened)
+            self.metrics.counter("server_relayed_bytes_total", "Bytes forwarded by chat relays",
+                                 lambda: self.relays.byte_count)
+            self.metrics.counter("server_relayed_datagrams_total",
+                                 "Datagrams forwarded by chat relays",
+                                 lambda: self.relays.datagram_count)
+        if isinstance(self.shared, Cluster):
+            self.metrics.gauge("server_cluster_nodes", "Cluster nodes up, counting this one",
+                               self.shared.live_count)
+            self.metrics.counter("server_cluster_gossip_rounds_total", "Gossip rounds started",
+                                 lambda: self.shared.rounds)
+            self.metrics.counter("server_cluster_routed_total",
+                                 "Commands forwarded to users on other nodes",
+                                 lambda: self.shared.routed)
 
     @property
     def registered_users(self):
-        with self.registered_users_lock:
-            return self._registered_users
+        return self.credentials
 
     def get_user(self, username):
-        for user in self.users:
-            log.debug(user.username)
-            if user.username == username:
-                return user
+        """Returns the signed in user with the given username, or None"""
+        return self.registry.get(username)
 
     def get_user_list(self):
-        """Filters any errors from the user list"""
-        return list(filter(None, [user.username for user in self.users]))
+        """Returns the usernames of visible signed in users"""
+        return self.registry.visible_usernames()
 
-    def remove_user(self, username):
-        for i in range(len(self.users)):
-            if self.users[i].username == username:
-                self.users.pop(i)
-                return
+    def watch(self, user):
+        """Starts checking a new connection for going silent"""
+        if not self.idle_timeout:
+            return
 
-    def add_registered_user(self, username, password):
-        with self.registered_users_lock:
-            self._registered_users[username] = password
+        user.idle_timer = self.wheel.schedule(
+            self.wheel.ticks_for(self.idle_timeout), user.check_idle)
+        # The kernel's keepalive probes find clients that vanished without heartbeats
+        sock = user.transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.idle_timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
 
-    def ip_address_to_int(ip_address):
-        """Converts an ip address to an int to be sent over a socket"""
-        return struct.unpack("!L", socket.inet_aton(ip_address))[0]
+    def owns(self, user):
+        """Returns whether the other servers must be told of the user's presence"""
+        if self.shared is None or user.username is None:
+            return False
+        return self.registry.get(user.username) is user
 
-    def int_to_ip_address(integer):
-        """Converts an int to a ip address to be received over a socket"""
-        return socket.inet_ntoa(struct.pack("!L", integer))
+    async def sign_in(self, user, username):
+        """Marks the user online under username, unless someone already is on any server"""
+        if self.shared is not None and not await self.shared.claim(username, True):
+            return False
+
+        if not self.registry.sign_in(user, username):
+            if self.shared is not None:
+                self.shared.release(username)
+            return False
+        return True
+
+    def sign_out(self, user):
+        owned = self.owns(user)
+        self.registry.sign_out(user)
+        if owned:
+            self.shared.release(user.username)
+
+    def set_visible(self, user, visible):
+        if self.owns(user):
+            self.shared.set_visible(user.username, visible)
+        self.registry.set_visible(user, visible)
+
+    def remove_user(self, user):
+        owned = self.owns(user) and not self.stopping
+        self.registry.remove(user)
+        if owned:
+            self.shared.release(user.username)
+        # A relay is no use once either of its users has gone
+        if self.relays is not None and user.username is not None:
+            self.relays.close_user(user.username)
+
+    def publish_presence(self, subscribers, username, event):
+        """Pushes a single presence change to every subscriber"""
+        if not subscribers:
+            return
+
+        # Every subscriber is sent the same frame so it is only encoded once
+        frame = encode_command(
+            Message.PRESENCE_UPDATE.value,
+            username.encode("utf-8"),
+            event.value.to_bytes(1, "little"),
+        )
+        for user in subscribers:
+            user.send_frame(frame, bulk=True)
+
+    async def add_registered_user(self, username, password):
+        """Returns False if another server registered the username first"""
+        if self.shared is None:
+            await self.credentials.add(username, password)
+            return True
+        return await self.shared.register(username, password)
+
+    async def handle_handoff(self, reader, writer):
+        """Hands the client a personal port on an OS-assigned socket"""
+        loop = asyncio.get_running_loop()
+        connected = loop.create_future()
+
+        def on_reconnect():
+            if not connected.done():
+                connected.set_result(None)
+            return CommandProtocol(self, greet=False)
+
+        # Port 0 lets the OS pick a free port so handoffs never collide
+        personal = await loop.create_server(on_reconnect, self.HOST, 0)
+        new_port = personal.sockets[0].getsockname()[1]
+        # Send the new port so it can reconnect
+        writer.write(new_port.to_bytes(2, "little"))
+        await writer.drain()
+        writer.close()
+
+        try:
+            await asyncio.wait_for(connected, self.HANDOFF_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.debug(f"Client never reconnected to port {new_port}")
+        finally:
+            # Stop listening once the one connection has been made
+            personal.close()
+
+    def stop(self):
+        """Stops accepting clients, ending serve"""
+        self.stopping = True
+        if self.listener is not None:
+            self.listener.close()
+
+    async def serve(self):
+        self.credentials.load()
+        if self.shared is not None:
+            # Users must not be served until the replicas are up to date
+            await self.shared.start()
+
+        if self.handoff:
+            server = await asyncio.start_server(self.handle_handoff, self.HOST, self.PORT)
+        else:
+            # Workers all listen on the same port and the kernel spreads connections over them
+            server = await asyncio.get_running_loop().create_server(
+                lambda: CommandProtocol(self), self.HOST, self.PORT,
+                reuse_port=isinstance(self.shared, BrokerLink))
+        self.listener = server
+
+        if self.stats_port is not None:
+            await self.metrics.start(self.HOST, self.stats_port)
+        if self.relays is not None:
+            self.relays.start(asyncio.get_running_loop())
+        self.wheel.start(asyncio.get_running_loop())
 
-    def run(self):
         log.info("Server is running!")
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            if not self.stopping:
+                raise
+        finally:
+            # Sessions cancelled from here on have nothing left to release their usernames to
+            self.stopping = True
+            if self.shared is not None:
+                await self.shared.close()
+            await self.credentials.close()
+            self.auth.shutdown()
+            if self.relays is not None:
+                self.relays.shutdown()
+            self.wheel.stop()
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.bind((self.HOST, self.PORT))
-            sock.listen()
+    def run(self):
+        asyncio.run(self.serve())
 
-            while True:
-                conn, _ = sock.accept()
 
-                # Create a new socket to handle the connection
-                new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                new_port = self.PORT + len(self.users) + 1
-                new_sock.bind((self.HOST, new_port))
-                # Send the new port so it can reconnect
-                conn.sendall(new_port.to_bytes(2, "little"))
+def limits_from_args(args):
+    """Returns the limits given on the command line over the defaults, or None for no limits"""
+    if args.no_rate_limits:
+        return None
+    return {**DEFAULT_LIMITS, **dict(args.rate_limit)}
+
+
+def run_worker(args, broker_path, worker_id):
+    """Runs one worker process of a multi-process server"""
+    Server.PORT = args.port
+    # The cores are shared by every worker's hashing pool
+    auth_workers = args.auth_workers or max(1, (os.cpu_count() or 1) // args.workers)
+    server = Server(
+        stats_port=None if args.stats_port is None else args.stats_port + worker_id,
+        auth_workers=auth_workers,
+        max_relays=args.relays,
+        idle_timeout=args.idle_timeout,
+        outbox_size=args.outbox,
+        overflow=args.overflow,
+        rate_limits=limits_from_args(args),
+        max_expensive=args.max_expensive,
+        broker_path=broker_path,
+        worker_id=worker_id,
+    )
+    # Terminated by the parent when it stops, which should still shut the pools down
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
 
-                # Create a user connection instance and pass a reference to
-                # the current state.
-                user = User(new_sock, self)
-                self.users.append(user)
+def run_workers(args):
+    """Forks the workers, then runs the broker they share in this process"""
+    broker_path = os.path.join(tempfile.mkdtemp(prefix="ptp-broker-"), "broker.sock")
+    # Listening before the workers start means none of them can connect too early
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(broker_path)
+    sock.listen()
 
-                Thread(target=user.run).start()
+    # Forked before any event loop or pool exists in this process
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=run_worker, args=(args, broker_path, worker_id))
+        for worker_id in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # Stopped like a single server on Ctrl-C, so the workers are stopped with it
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(Broker(args.data_dir).serve(sock))
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        os.remove(broker_path)
+        os.rmdir(os.path.dirname(broker_path))
 
 
 def main():
-    server = Server()
-    server.run()
+    args = parse_args()
+    if args.workers > 1:
+        if args.handoff or args.node:
+            raise SystemExit("--handoff and --node cannot be used with --workers")
+        run_workers(args)
+        return
+
+    Server.PORT = args.port
+    server = Server(
+        handoff=args.handoff,
+        stats_port=args.stats_port,
+        data_dir=args.data_dir,
+        auth_workers=args.auth_workers,
+        max_relays=args.relays,
+        node=args.node,
+        peers=args.peers.split(",") if args.peers else (),
+        gossip_interval=args.gossip_interval,
+        idle_timeout=args.idle_timeout,
+        outbox_size=args.outbox,
+        overflow=args.overflow,
+        rate_limits=limits_from_args(args),
+        max_expensive=args.max_expensive,
+    )
+    # Stopped like Ctrl-C, so the hashing pool is shut down rather than orphaned
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_args():
+    """Parses all command-line arguments for the server"""
+    parser = argparse.ArgumentParser(
+        prog="Server",
+        description="The rendezvous server for the peer-to-peer messenger")
+
+    parser.add_argument("-p", "--port",
+                        default=Server.PORT,
+                        help="The port number to listen on (65432)",
+                        type=int)
+
+    parser.add_argument("--handoff",
+                        action="store_true",
+                        help="Hand each client a personal port to reconnect to, for older clients (False)")
+
+    parser.add_argument("-d", "--data_dir",
+                        help="Persist registered accounts in this directory (kept in memory only)")
+
+    parser.add_argument("--auth_workers",
+                        help="Processes used to hash passwords (one per core)",
+                        type=int)
+
+    parser.add_argument("-w", "--workers",
+                        default=1,
+                        help="Serve the port from this many processes, sharing accounts and "
+                             "presence through a broker process (1)",
+                        type=int)
+
+    parser.add_argument("--node",
+                        help="Join a cluster of servers as the node other nodes reach on this "
+                             "host:port (disabled)")
+
+    parser.add_argument("--peers",
+                        help="Comma separated host:port of cluster nodes to gossip with first")
+
+    parser.add_argument("--gossip_interval",
+                        default=GOSSIP_INTERVAL,
+                        help=f"Seconds between the cluster gossip rounds ({GOSSIP_INTERVAL})",
+                        type=float)
+
+    parser.add_argument("--idle_timeout",
+                        default=Server.IDLE_TIMEOUT,
+                        help="Seconds before closing a client that sends heartbeats, or has not "
+                             f"signed in, once it goes silent ({Server.IDLE_TIMEOUT}, 0 never)",
+                        type=int)
+
+    parser.add_argument("--outbox",
+                        default=Server.OUTBOX_SIZE,
+                        help="Frames a client that is slow to read may have waiting before "
+                             f"the overflow policy applies ({Server.OUTBOX_SIZE})",
+                        type=int)
+
+    parser.add_argument("--overflow",
+                        default="reject",
+                        choices=Server.OVERFLOW_POLICIES,
+                        help="What to do with a frame for a client whose outbox is full (reject)")
+
+    parser.add_argument("--rate_limit",
+                        action="append",
+                        default=[],
+                        help="Commands a second and the largest burst each user may send of a "
+                             "message type, or of ALL commands together, as NAME=RATE/BURST "
+                             "(see ratelimit.py, a rate of 0 removes the limit)",
+                        type=parse_limit)
+
+    parser.add_argument("--no_rate_limits",
+                        action="store_true",
+                        help="Let users send commands as often as they like (False)")
+
+    parser.add_argument("--max_expensive",
+                        default=Server.MAX_EXPENSIVE,
+                        help="Sign ups and sign ins that may be in progress at once before "
+                             f"more are refused ({Server.MAX_EXPENSIVE})",
+                        type=int)
+
+    parser.add_argument("--relays",
+                        default=0,
+                        help="Relay up to this many chats between clients that cannot reach "
+                             "each other directly (0, disabled)",
+                        type=int)
+
+    parser.add_argument("--stats_port",
+                        help="Serve Prometheus-style metrics over HTTP on this port, and the "
+                             "ports after it for further workers (disabled)",
+                        type=int)
+
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,291 @@
+"""
+Durable storage for registered accounts
+
+Accounts are kept in memory and every new one is appended to a log. Appends
+are group committed, so many sign ups share one fsync. Once the log grows long
+enough, the accounts are written to a compact snapshot and the old log is
+deleted. Startup loads the snapshot and replays only the log written since.
+"""
+import asyncio
+import logging
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("server")
+
+# crc32 of the rest of the record, then the username and password lengths
+RECORD_HEADER = struct.Struct("<IHH")
+# The log sequence number the snapshot covers up to, then the number of accounts
+SNAPSHOT_HEADER = struct.Struct("<8sQQ")
+SNAPSHOT_MAGIC = b"PTPSNAP2"
+# Older snapshots joined every username and password with null instead
+LEGACY_SNAPSHOT_MAGIC = b"PTPSNAP1"
+LEGACY_SEPARATOR = "\x00"
+# Every account in a snapshot is the username and password lengths, then both
+LENGTHS = struct.Struct("<HH")
+CRC = struct.Struct("<I")
+
+SNAPSHOT_NAME = "snapshot"
+LOG_PREFIX = "log."
+
+
+def encode_record(username, password):
+    """Returns a log record, assuming username and password are encoded"""
+    body = LENGTHS.pack(len(username), len(password)) + username + password
+    return CRC.pack(zlib.crc32(body)) + body
+
+
+def fsync_directory(directory):
+    """Makes renames and deletions in the directory durable"""
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class CredentialStore:
+    """Registered usernames and passwords, persisted when given a directory"""
+    def __init__(self, directory=None, flush_delay=0.002, snapshot_every=100_000):
+        """
+        flush_delay is how long in seconds an append waits for others to share its fsync
+        snapshot_every is how many appended accounts trigger a new snapshot
+        """
+        self.directory = directory
+        self.flush_delay = flush_delay
+        self.snapshot_every = snapshot_every
+
+        # Dictionary with username/password pairs
+        self.accounts = {}
+
+        # Encoded records waiting to be written, and the future they all wait on
+        self.pending = []
+        self.committed = None
+        self.flusher = None
+
+        self.log_file = None
+        self.log_sequence = 0
+        self.appended = 0
+        self.snapshotting = None
+
+        # One thread writes the log in order, another writes snapshots
+        self.log_executor = ThreadPoolExecutor(1, thread_name_prefix="credential-log")
+        self.snapshot_executor = ThreadPoolExecutor(1, thread_name_prefix="credential-snapshot")
+
+    def __contains__(self, username):
+        return username in self.accounts
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def get(self, username):
+        """Returns the password of a registered user, or None"""
+        return self.accounts.get(username)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def log_path(self, sequence):
+        return self.path(f"{LOG_PREFIX}{sequence:08d}")
+
+    def load(self):
+        """Loads the snapshot and replays the log written after it"""
+        if self.directory is None:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        covered = self.load_snapshot()
+
+        sequences = sorted(
+            int(name[len(LOG_PREFIX):])
+            for name in os.listdir(self.directory)
+            if name.startswith(LOG_PREFIX) and name[len(LOG_PREFIX):].isdecimal()
+        )
+        replayed = 0
+        for sequence in sequences:
+            # Already in the snapshot, left behind by a crash before it was deleted
+            if sequence <= covered:
+                os.remove(self.log_path(sequence))
+                continue
+            replayed += self.replay_log(sequence)
+
+        self.log_sequence = max([covered + 1] + sequences)
+        self.appended = replayed
+        self.log_file = open(self.log_path(self.log_sequence), "ab")
+
+        log.info(f"Loaded {len(self.accounts)} accounts, replaying {replayed} from the log")
+
+    def load_snapshot(self):
+        """Returns the last log sequence number the snapshot covers"""
+        try:
+            with open(self.path(SNAPSHOT_NAME), "rb") as snapshot:
+                data = snapshot.read()
+        except FileNotFoundError:
+            return 0
+
+        view = memoryview(data)
+        magic, covered, count = SNAPSHOT_HEADER.unpack_from(view)
+        (checksum,) = CRC.unpack_from(view, len(view) - CRC.size)
+        if (magic not in (SNAPSHOT_MAGIC, LEGACY_SNAPSHOT_MAGIC)
+                or zlib.crc32(view[:-CRC.size]) != checksum):
+            raise ValueError(f"Corrupt credential snapshot in {self.directory}")
+
+        if count and magic == LEGACY_SNAPSHOT_MAGIC:
+            fields = str(view[SNAPSHOT_HEADER.size:-CRC.size], "utf-8").split(LEGACY_SEPARATOR)
+            self.accounts.update(zip(fields[0::2], fields[1::2]))
+            return covered
+
+        offset = SNAPSHOT_HEADER.size
+        for _ in range(count):
+            username_length, password_length = LENGTHS.unpack_from(view, offset)
+            start = offset + LENGTHS.size
+            offset = start + username_length + password_length
+            username = str(view[start:start + username_length], "utf-8")
+            self.accounts[username] = str(view[start + username_length:offset], "utf-8")
+
+        return covered
+
+    def replay_log(self, sequence):
+        """Applies every intact record of a log, truncating a torn tail"""
+        path = self.log_path(sequence)
+        with open(path, "rb") as log_file:
+            data = log_file.read()
+
+        view = memoryview(data)
+        offset = 0
+        replayed = 0
+        while offset + RECORD_HEADER.size <= len(view):
+            checksum, username_length, password_length = RECORD_HEADER.unpack_from(view, offset)
+            end = offset + RECORD_HEADER.size + username_length + password_length
+            if end > len(view) or zlib.crc32(view[offset + CRC.size:end]) != checksum:
+                break
+
+            start = offset + RECORD_HEADER.size
+            username = str(view[start:start + username_length], "utf-8")
+            self.accounts[username] = str(view[start + username_length:end], "utf-8")
+            offset = end
+            replayed += 1
+
+        # A crash mid-append leaves a partial record that is dropped
+        if offset < len(view):
+            log.warning(f"Dropping {len(view) - offset} torn bytes from {path}")
+            with open(path, "r+b") as log_file:
+                log_file.truncate(offset)
+
+        return replayed
+
+    async def add(self, username, password):
+        """Registers an account, returning once it is durable"""
+        self.accounts[username] = password
+        if self.log_file is None:
+            return
+
+        self.pending.append(encode_record(username.encode("utf-8"), password.encode("utf-8")))
+        if self.committed is None:
+            self.committed = asyncio.get_running_loop().create_future()
+        committed = self.committed
+
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush())
+
+        try:
+            await asyncio.shield(committed)
+        except OSError:
+            # It never made it to disk, so it must not outlive a restart either
+            self.accounts.pop(username, None)
+            raise
+
+    async def flush(self):
+        """Writes pending records in batches, one fsync per batch"""
+        loop = asyncio.get_running_loop()
+        try:
+            # Give concurrent sign ups a moment to join the first batch
+            await asyncio.sleep(self.flush_delay)
+
+            # Records added during a write form the next batch
+            while self.pending:
+                records, committed = self.pending, self.committed
+                self.pending, self.committed = [], None
+
+                try:
+                    await loop.run_in_executor(
+                        self.log_executor, self.write_log, b"".join(records))
+                except OSError as error:
+                    log.error(f"Could not append to the credential log: {error}")
+                    committed.set_exception(error)
+                    continue
+
+                committed.set_result(None)
+                self.appended += len(records)
+
+            if self.appended >= self.snapshot_every and self.snapshotting is None:
+                self.snapshotting = asyncio.ensure_future(self.snapshot())
+        finally:
+            self.flusher = None
+
+    def write_log(self, data):
+        self.log_file.write(data)
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+
+    async def snapshot(self):
+        """Writes every account to a new snapshot and deletes the logs it covers"""
+        loop = asyncio.get_running_loop()
+        try:
+            # Later appends go to a new log so the old one can be deleted
+            covered = self.log_sequence
+            self.log_sequence += 1
+            await loop.run_in_executor(self.log_executor, self.rotate_log, self.log_sequence)
+            self.appended = 0
+
+            # Copied on the event loop, where the accounts are changed
+            accounts = list(self.accounts.items())
+            await loop.run_in_executor(
+                self.snapshot_executor, self.write_snapshot, accounts, covered)
+            log.info(f"Wrote a snapshot of {len(accounts)} accounts")
+        except OSError as error:
+            log.error(f"Could not write a credential snapshot: {error}")
+        finally:
+            self.snapshotting = None
+
+    def rotate_log(self, sequence):
+        self.log_file.close()
+        self.log_file = open(self.log_path(sequence), "ab")
+        fsync_directory(self.directory)
+
+    def write_snapshot(self, accounts, covered):
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, covered, len(accounts))]
+        for username, password in accounts:
+            username, password = username.encode("utf-8"), password.encode("utf-8")
+            parts += (LENGTHS.pack(len(username), len(password)), username, password)
+        data = b"".join(parts)
+
+        # Written aside and renamed over the old one, so a crash never leaves half a snapshot
+        temporary = self.path(SNAPSHOT_NAME + ".tmp")
+        with open(temporary, "wb") as snapshot:
+            snapshot.write(data)
+            snapshot.write(CRC.pack(zlib.crc32(data)))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.path(SNAPSHOT_NAME))
+        fsync_directory(self.directory)
+
+        for name in os.listdir(self.directory):
+            suffix = name[len(LOG_PREFIX):]
+            if name.startswith(LOG_PREFIX) and suffix.isdecimal() and int(suffix) <= covered:
+                os.remove(self.path(name))
+
+    async def close(self):
+        """Waits for pending appends and any snapshot in progress"""
+        if self.flusher is not None:
+            await self.flusher
+        if self.snapshotting is not None:
+            await self.snapshotting
+
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        self.log_executor.shutdown()
+        self.snapshot_executor.shutdown()
@@ -0,0 +1,418 @@
+"""
+Peer to peer file transfer
+
+A file is offered in a file data transfer naming it, then sent as numbered
+chunks that each carry a crc32. The receiver writes every chunk straight to
+its place in the file and acknowledges with the first chunk it is missing and
+a bitmap of the chunks it has after that. It also records which chunks it has
+beside the partial download, so a file offered again after an interruption
+only needs its missing chunks.
+
+The sender reads chunks from a memory map of the file, sending each behind its
+header without copying it, and keeps a congestion window that grows while
+chunks are acknowledged and halves when they are lost.
+"""
+import ipaddress
+import mmap
+import os
+import queue
+import random
+import socket
+import time
+import zlib
+from codec import (
+    FILE_ACK_BITMAP_BYTE_COUNT,
+    FILE_CHUNK_HEADER_BYTE_COUNT,
+    FILE_INFO,
+    decode_file_ack,
+    decode_file_chunk,
+    encode_data_transfer,
+    encode_file_ack,
+    encode_file_chunk_header,
+)
+from fragment import MAX_DATAGRAM_BYTE_COUNT
+from reliable import RoundTripTimer
+
+# Chunks fill a datagram that IP will not fragment on a real network
+CHUNK_BYTE_COUNT = MAX_DATAGRAM_BYTE_COUNT - FILE_CHUNK_HEADER_BYTE_COUNT
+# Loopback has a 64 KiB MTU, where larger chunks mean far fewer system calls
+LOOPBACK_CHUNK_BYTE_COUNT = 60 * 1024
+# The largest datagram a receiver must accept
+MAX_FILE_DATAGRAM_BYTE_COUNT = FILE_CHUNK_HEADER_BYTE_COUNT + LOOPBACK_CHUNK_BYTE_COUNT
+
+# The congestion window in chunks, capped so it fits in the peer's socket buffer
+INITIAL_WINDOW = 16
+MIN_WINDOW = 4
+MAX_WINDOW_BYTE_COUNT = 4 * 1024 * 1024
+
+SOCKET_BUFFER_BYTE_COUNT = 4 * 1024 * 1024
+
+# Acks showing later chunks but not the first missing one before it is resent without waiting
+DUPLICATE_THRESHOLD = 3
+# Timeouts in a row after which the peer is assumed gone
+MAX_TIMEOUTS = 8
+
+# The receiver acknowledges at least this often, and at once when a chunk is out of order
+ACK_EVERY = 8
+# Seconds between saving which chunks have been received
+SAVE_INTERVAL = 1.0
+
+# Acknowledged parts of the memory map are released in steps of this many bytes
+RELEASE_BYTE_COUNT = 16 * 1024 * 1024
+
+PARTIAL_SUFFIX = ".part"
+CHUNKS_SUFFIX = ".part.chunks"
+
+
+def describe_throughput(byte_count, seconds):
+    """Returns a summary such as '12.0 MB in 1.00 s (12.0 MB/s)'"""
+    rate = byte_count / seconds / 1e6 if seconds > 0 else 0.0
+    return f"{byte_count / 1e6:.1f} MB in {seconds:.2f} s ({rate:.1f} MB/s)"
+
+
+def configure_socket(sock):
+    """Gives a peer socket room for a full congestion window in each direction"""
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_BYTE_COUNT)
+
+
+class FileSender:
+    """Sends one file to a peer"""
+    def __init__(self, sock, address, path, chunk_byte_count=None):
+        """
+        sock must be read by another thread, which passes this sender its acknowledgements
+        chunk_byte_count defaults to the largest that will not be fragmented on the way
+        """
+        self.sock = sock
+        self.address = address
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+
+        if chunk_byte_count is None:
+            loopback = ipaddress.ip_address(address[0]).is_loopback
+            chunk_byte_count = LOOPBACK_CHUNK_BYTE_COUNT if loopback else CHUNK_BYTE_COUNT
+        self.chunk_byte_count = chunk_byte_count
+        self.count = -(-self.size // chunk_byte_count)
+
+        self.transfer_id = random.getrandbits(32)
+        # Acknowledgements handed over by the thread reading the socket
+        self.acks = queue.SimpleQueue()
+        self.cancelled = False
+
+        # Every chunk before acked has been received, as have those in received
+        self.acked = 0
+        self.received = set()
+        # Chunk index to (time sent, whether it was resent) for chunks in flight
+        self.in_flight = {}
+        self.next_index = 0
+
+        self.window = INITIAL_WINDOW
+        self.max_window = max(MAX_WINDOW_BYTE_COUNT // chunk_byte_count, MIN_WINDOW)
+        self.threshold = self.max_window
+        self.duplicates = 0
+        self.round_trip = RoundTripTimer()
+        self.timeouts = 0
+
+        self.map = None
+        self.released = 0
+
+        self.bytes_sent = 0
+        self.chunks_sent = 0
+        self.retransmits = 0
+
+    def receive_ack(self, view):
+        """Passes on an acknowledgement, called by the thread reading the socket"""
+        self.acks.put(bytes(view))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        """Sends the whole file, returning how long it took, or None if cancelled"""
+        with open(self.path, "rb") as file:
+            if self.size:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.offer()
+                started = time.perf_counter()
+                while self.acked < self.count:
+                    if self.cancelled:
+                        return None
+                    self.fill_window()
+                    self.wait_for_ack()
+                return time.perf_counter() - started
+            finally:
+                if self.map is not None:
+                    self.map.close()
+
+    def offer(self):
+        """Names the file to the peer, whose first ack says which chunks it already has"""
+        offer = encode_data_transfer(
+            False, self.name.encode("utf-8"),
+            FILE_INFO.pack(self.transfer_id, self.size, self.chunk_byte_count))
+
+        for _ in range(MAX_TIMEOUTS):
+            self.sock.sendto(offer, self.address)
+            try:
+                self.handle_ack(self.acks.get(timeout=self.round_trip.rto))
+            except queue.Empty:
+                self.round_trip.back_off()
+                continue
+            self.next_index = self.acked
+            return
+
+        raise TimeoutError(f"No response to the offer of {self.name}")
+
+    def send_chunk(self, index, retransmit=False):
+        start = index * self.chunk_byte_count
+        chunk = memoryview(self.map)[start:start + self.chunk_byte_count]
+        header = encode_file_chunk_header(self.transfer_id, index, zlib.crc32(chunk))
+        # Gathered by the kernel, so the chunk is never copied into a new datagram
+        self.sock.sendmsg((header, chunk), (), 0, self.address)
+        self.bytes_sent += len(chunk)
+        chunk.release()
+
+        self.in_flight[index] = (time.monotonic(), retransmit)
+        self.chunks_sent += 1
+        if retransmit:
+            self.retransmits += 1
+
+    def fill_window(self):
+        while len(self.in_flight) < self.window and self.next_index < self.count:
+            index = self.next_index
+            self.next_index += 1
+            if index >= self.acked and index not in self.received:
+                self.send_chunk(index)
+
+    def wait_for_ack(self):
+        try:
+            self.handle_ack(self.acks.get(timeout=self.round_trip.rto))
+        except queue.Empty:
+            self.timed_out()
+            return
+
+        # Handle any others that arrived meanwhile before sending more
+        while True:
+            try:
+                self.handle_ack(self.acks.get_nowait())
+            except queue.Empty:
+                break
+
+    def handle_ack(self, ack):
+        transfer_id, missing, received = decode_file_ack(ack)
+        if transfer_id != self.transfer_id or missing > self.count:
+            return
+
+        now = time.monotonic()
+        self.timeouts = 0
+        # Only chunks sent once give a usable round trip time (Karn's algorithm)
+        sample = None
+        newly_acked = 0
+
+        if missing > self.acked:
+            for index in range(self.acked, missing):
+                sent = self.in_flight.pop(index, None)
+                if sent is not None:
+                    newly_acked += 1
+                    if not sent[1]:
+                        sample = now - sent[0]
+            self.received = {index for index in self.received if index >= missing}
+            self.acked = missing
+            self.duplicates = 0
+            self.release()
+        elif received:
+            self.duplicates += 1
+
+        highest = missing
+        while received:
+            lowest = received & -received
+            index = missing + lowest.bit_length()
+            received ^= lowest
+            highest = index
+            if index >= self.count:
+                break
+            self.received.add(index)
+            sent = self.in_flight.pop(index, None)
+            if sent is not None:
+                newly_acked += 1
+                if not sent[1]:
+                    sample = now - sent[0]
+
+        if sample is not None:
+            self.round_trip.observe(sample)
+
+        # Grows exponentially until the first loss, then by one chunk per window
+        if self.window < self.threshold:
+            self.window += newly_acked
+        else:
+            self.window += newly_acked / self.window
+        self.window = min(self.window, self.max_window)
+
+        if self.duplicates == DUPLICATE_THRESHOLD:
+            # Every chunk in flight before the highest one received was lost
+            for index in [index for index in self.in_flight if index < highest]:
+                self.send_chunk(index, retransmit=True)
+            self.lost()
+
+    def timed_out(self):
+        self.timeouts += 1
+        if self.timeouts >= MAX_TIMEOUTS:
+            raise TimeoutError(f"The peer stopped acknowledging {self.name}")
+
+        now = time.monotonic()
+        for index, (sent, _) in list(self.in_flight.items()):
+            if now - sent >= self.round_trip.rto:
+                self.send_chunk(index, retransmit=True)
+        self.round_trip.back_off()
+        self.lost()
+
+    def lost(self):
+        self.window = max(self.window / 2, MIN_WINDOW)
+        self.threshold = self.window
+
+    def release(self):
+        """Drops acknowledged pages of the memory map, so memory stays bounded for large files"""
+        if self.map is None or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+
+        end = self.acked * self.chunk_byte_count // RELEASE_BYTE_COUNT * RELEASE_BYTE_COUNT
+        if end > self.released:
+            self.map.madvise(mmap.MADV_DONTNEED, self.released, end - self.released)
+            self.released = end
+
+
+class FileReceiver:
+    """Receives one offered file, writing chunks straight to their place in it"""
+    def __init__(self, sock, address, directory, name, info):
+        """info is the data of the file data transfer that offered the file"""
+        self.sock = sock
+        self.address = address
+        self.transfer_id, self.size, self.chunk_byte_count = FILE_INFO.unpack_from(info)
+        if self.chunk_byte_count == 0:
+            raise ValueError("A file chunk must not be empty")
+        self.count = -(-self.size // self.chunk_byte_count)
+
+        # Only the last part of the name, so a peer cannot write outside the directory
+        name = os.path.basename(name)
+        self.name = name if name not in ("", ".", "..") else "download"
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, self.name)
+
+        # One bit per chunk, set once it is written
+        self.chunks = bytearray(-(-self.count // 8))
+        self.resumed = 0
+
+        self.file = os.open(self.path + PARTIAL_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+        self.chunks_file = os.open(self.path + CHUNKS_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+        self.load_chunks()
+        os.ftruncate(self.file, self.size)
+
+        # Every chunk before missing has been received
+        self.missing = 0
+        self.advance()
+
+        self.unacknowledged = 0
+        self.saved = time.monotonic()
+        self.started = time.perf_counter()
+        self.bytes_received = 0
+        self.corrupt = 0
+        self.seconds = None
+
+    @property
+    def done(self):
+        return self.missing == self.count
+
+    def load_chunks(self):
+        """Picks up the chunks of an earlier transfer of the same file"""
+        saved = os.pread(self.chunks_file, FILE_INFO.size + len(self.chunks), 0)
+        if len(saved) != FILE_INFO.size + len(self.chunks):
+            return
+
+        _, size, chunk_byte_count = FILE_INFO.unpack_from(saved)
+        if (size, chunk_byte_count) != (self.size, self.chunk_byte_count):
+            return
+
+        self.chunks[:] = saved[FILE_INFO.size:]
+        self.resumed = sum(bin(byte).count("1") for byte in self.chunks)
+
+    def save_chunks(self):
+        """Records the chunks received, once they are durable"""
+        os.fdatasync(self.file)
+        os.pwrite(self.chunks_file, FILE_INFO.pack(
+            self.transfer_id, self.size, self.chunk_byte_count) + self.chunks, 0)
+        self.saved = time.monotonic()
+
+    def has(self, index):
+        return self.chunks[index >> 3] >> (index & 7) & 1
+
+    def advance(self):
+        while self.missing < self.count and self.has(self.missing):
+            self.missing += 1
+
+    def acknowledge(self):
+        """Sends the first missing chunk and a bitmap of the chunks received after it"""
+        start = self.missing + 1
+        window = self.chunks[start >> 3:(start >> 3) + FILE_ACK_BITMAP_BYTE_COUNT + 1]
+        received = int.from_bytes(window, "little") >> (start & 7)
+        received &= (1 << FILE_ACK_BITMAP_BYTE_COUNT * 8) - 1
+
+        self.sock.sendto(
+            encode_file_ack(self.transfer_id, self.missing, received), self.address)
+        self.unacknowledged = 0
+
+    def receive_chunk(self, view):
+        """Handles a chunk, which is a view of the receive buffer that is reused afterwards"""
+        _, index, checksum, chunk = decode_file_chunk(view)
+        if index >= self.count:
+            return
+
+        # A damaged chunk is dropped and resent once the sender times out
+        expected = min(self.chunk_byte_count, self.size - index * self.chunk_byte_count)
+        if len(chunk) != expected or zlib.crc32(chunk) != checksum:
+            self.corrupt += 1
+            return
+
+        if self.done:
+            # The sender missed the last ack
+            self.acknowledge()
+            return
+
+        in_order = index == self.missing
+        if not self.has(index):
+            os.pwrite(self.file, chunk, index * self.chunk_byte_count)
+            self.chunks[index >> 3] |= 1 << (index & 7)
+            self.bytes_received += len(chunk)
+            self.unacknowledged += 1
+            self.advance()
+        else:
+            # The sender missed an ack
+            in_order = False
+
+        if self.done:
+            self.finish()
+        elif not in_order or self.unacknowledged >= ACK_EVERY:
+            self.acknowledge()
+
+        if not self.done and time.monotonic() - self.saved >= SAVE_INTERVAL:
+            self.save_chunks()
+
+    def finish(self):
+        """Moves the finished download into place, acknowledging every chunk"""
+        if self.seconds is None:
+            self.seconds = time.perf_counter() - self.started
+            os.fsync(self.file)
+            os.close(self.file)
+            os.close(self.chunks_file)
+            os.replace(self.path + PARTIAL_SUFFIX, self.path)
+            os.remove(self.path + CHUNKS_SUFFIX)
+            # Only the first missing chunk is needed to answer resent chunks
+            self.chunks = bytearray()
+        self.acknowledge()
+
+    def close(self):
+        """Stops an unfinished transfer, keeping what was received so it can resume"""
+        if self.seconds is None:
+            self.save_chunks()
+            os.close(self.file)
+            os.close(self.chunks_file)
@@ -0,0 +1,91 @@
+"""
+A hashed timing wheel for timeouts that are set far more often than they fire
+
+Timers are kept in a ring of slots, one per tick, and a timer further away than
+one turn of the ring waits out the extra turns in its slot. Scheduling and
+cancelling are a set insert and removal, and each tick only visits the timers
+in one slot, however many timers there are in total. Timers are only as
+precise as the tick, which is plenty for idle sessions measured in seconds.
+"""
+import math
+
+
+class WheelTimer:
+    """A callback waiting in a slot of the wheel"""
+    __slots__ = ("callback", "slot", "rounds")
+
+    def __init__(self, callback, slot, rounds):
+        self.callback = callback
+        self.slot = slot
+        # Turns of the wheel still to wait once the slot comes round
+        self.rounds = rounds
+
+
+class TimerWheel:
+    """Calls back after a whole number of ticks, driven by an asyncio event loop"""
+    def __init__(self, tick=1.0, slot_count=512):
+        """tick is the seconds between ticks, and slot_count how many ticks one turn spans"""
+        self.tick = tick
+        self.slots = [set() for _ in range(slot_count)]
+        # Ticks since the wheel started, which also tells where in the ring it is
+        self.ticks = 0
+        self.count = 0
+
+        self.loop = None
+        self.handle = None
+        self.started = None
+
+    def __len__(self):
+        return self.count
+
+    def ticks_for(self, seconds):
+        """Returns the whole number of ticks covering seconds, at least one"""
+        return max(1, math.ceil(seconds / self.tick))
+
+    def schedule(self, ticks, callback):
+        """Calls callback with no arguments once ticks more ticks have passed"""
+        ticks = max(1, ticks)
+        slot = (self.ticks + ticks) % len(self.slots)
+        timer = WheelTimer(callback, slot, (ticks - 1) // len(self.slots))
+        self.slots[slot].add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer in self.slots[timer.slot]:
+            self.slots[timer.slot].discard(timer)
+            self.count -= 1
+
+    def advance(self):
+        """Moves on one tick, running every timer that is now due"""
+        self.ticks += 1
+        slot = self.slots[self.ticks % len(self.slots)]
+
+        due = []
+        for timer in slot:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                due.append(timer)
+
+        for timer in due:
+            slot.discard(timer)
+        self.count -= len(due)
+        # Callbacks may schedule again, which must not change the slot while it is walked
+        for timer in due:
+            timer.callback()
+
+    def start(self, loop):
+        self.loop = loop
+        self.started = loop.time()
+        self.handle = loop.call_at(self.started + self.tick, self.run)
+
+    def run(self):
+        self.advance()
+        # Kept to the start time so ticks do not drift as the loop runs late
+        self.handle = self.loop.call_at(self.started + (self.ticks + 1) * self.tick, self.run)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None